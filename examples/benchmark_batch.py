@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""Benchmark simulating a batch of copies of a model at once.
+
+Compares the throughput (model steps per second, summed over all copies) of one
+simulator with ``batch_size`` copies (see the ``batch_size`` argument of
+``nengo_ocl.Simulator``) to that of running the copies in separate simulators.
+"""
+
+import time
+
+import click
+import nengo
+
+import nengo_ocl
+
+
+def chain_network(n_ensembles, n_neurons, dimensions):
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(nengo.processes.WhiteSignal(1, high=5), size_out=dimensions)
+        prev = u
+        for _ in range(n_ensembles):
+            ens = nengo.Ensemble(n_neurons, dimensions)
+            nengo.Connection(prev, ens, synapse=0.005)
+            prev = ens
+        nengo.Probe(prev, synapse=0.01)
+
+    return net
+
+
+def time_steps(sim, steps):
+    sim.run_steps(steps, progress_bar=False)  # warmup, sizes probe buffers
+    sim.reset()
+
+    t0 = time.perf_counter()
+    sim.run_steps(steps, progress_bar=False)
+    return time.perf_counter() - t0
+
+
+@click.command()
+@click.option("--batch", default="1,4,16", help="Comma-separated batch sizes")
+@click.option("--ensembles", default=4, type=int, help="Ensembles in chain")
+@click.option("--neurons", default=200, type=int, help="Neurons per ensemble")
+@click.option("--dimensions", default=4, type=int, help="Dimensions per ensemble")
+@click.option("--steps", default=500, type=int, help="Number of steps to time")
+def main(batch, ensembles, neurons, dimensions, steps):
+    """Compare throughput of batched and separate simulators."""
+    net = chain_network(ensembles, neurons, dimensions)
+
+    with nengo_ocl.Simulator(net, progress_bar=False) as sim:
+        single = steps / time_steps(sim, steps)
+    print("single simulator: %8.0f steps/s" % single)
+
+    for batch_size in (int(b) for b in batch.split(",")):
+        with nengo_ocl.Simulator(net, batch_size=batch_size, progress_bar=False) as sim:
+            batched = batch_size * steps / time_steps(sim, steps)
+            assert sim.data[net.probes[0]].shape == (batch_size, steps, dimensions)
+
+        print(
+            "batch_size %4d: %8.0f steps/s (%0.2fx separate simulators)"
+            % (batch_size, batched, batched / single)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""Benchmark the host overhead of dispatching kernels for a tiny model.
+
+For small models, the time per step is dominated by the Python code that enqueues
+the kernels, not by the device. This compares steps per second with and without
+recorded dispatch (see ``nengo_ocl.plan.Plans.record``).
+"""
+
+import time
+
+import click
+import nengo
+import numpy as np
+
+import nengo_ocl
+
+
+def tiny_network(n_ensembles, n_neurons):
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(np.sin)
+        prev = u
+        for _ in range(n_ensembles):
+            ens = nengo.Ensemble(n_neurons, 1)
+            nengo.Connection(prev, ens)
+            prev = ens
+        nengo.Probe(prev, synapse=0.01)
+
+    return net
+
+
+@click.command()
+@click.option("--ensembles", default=2, type=int, help="Number of ensembles in chain")
+@click.option("--neurons", default=10, type=int, help="Neurons per ensemble")
+@click.option("--steps", default=5000, type=int, help="Number of steps to time")
+@click.option("--repeats", default=3, type=int, help="Number of timings to take")
+def main(ensembles, neurons, steps, repeats):
+    """Compare steps per second with plain and recorded dispatch."""
+    net = tiny_network(ensembles, neurons)
+
+    with nengo_ocl.Simulator(net, progress_bar=False) as sim:
+        print("%d plans per step" % len(sim._plans))
+        sim.run_steps(steps)  # warmup (also sizes the probe buffers)
+
+        results = {}
+        for recorded in (False, True):
+            sim._plans.recorded = recorded
+            timings = []
+            for _ in range(repeats):
+                sim.reset()
+                t0 = time.perf_counter()
+                sim.run_steps(steps)
+                timings.append(time.perf_counter() - t0)
+
+            results[recorded] = steps / min(timings)
+            print(
+                "%-8s dispatch: %10.0f steps/s"
+                % ("recorded" if recorded else "plain", results[recorded])
+            )
+
+    print("speedup: %0.2fx" % (results[True] / results[False]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+"""Microbenchmarks of the kernels generated by the ``plan_*`` functions.
+
+Each benchmark creates the plans of one kernel directly (without building a model),
+for a grid of ragged geometries typical of Nengo models, and times the kernels with
+OpenCL profiling events. Results are reported as time per call, GF/s, and GB/s.
+
+Use ``--save`` to store the results as JSON, and ``--baseline`` to compare against
+previously stored results: kernels that are slower than the baseline by more than
+``--tolerance`` are reported as regressions, and the script exits with an error.
+
+Baselines are local only (none are checked in), since they are only comparable on
+the same device and driver (which are stored in the file). To check a change,
+save a baseline before making it, and compare against it afterwards::
+
+    python examples/benchmark_kernels.py --save baseline.json
+    python examples/benchmark_kernels.py --baseline baseline.json
+
+Each benchmark has its own random geometries and data (seeded by ``--seed`` and the
+position of the benchmark in the full list), so results of a benchmark are
+comparable whichever ``--kernels`` are run.
+"""
+
+import json
+import sys
+
+import click
+import numpy as np
+import pyopencl as cl
+import pyopencl.array
+from nengo.utils.numpy import scipy_sparse
+
+import nengo_ocl
+from nengo_ocl.clra_gemv import (
+    plan_block_gemv,
+    plan_ragged_sparse_dot_inc,
+    plan_sparse_dot_inc,
+)
+from nengo_ocl.clra_nonlinearities import (
+    plan_conv2d,
+    plan_lif,
+    plan_linearfilter,
+    plan_probes,
+)
+from nengo_ocl.clraggedarray import CLRaggedArray
+from nengo_ocl.plan import PROFILING_ENABLE
+from nengo_ocl.program_cache import device_key
+from nengo_ocl.raggedarray import RaggedArray
+from nengo_ocl.utils import HostSparseMatrix
+
+
+def ragged(queue, arrays, dtype=np.float32):
+    return CLRaggedArray(queue, RaggedArray(arrays, dtype=dtype))
+
+
+def bench_gemv(queue, rng, n_calls):
+    """Encoders (neurons x dims) and decoders (dims x neurons) of ensembles."""
+    geometries = {
+        "100x(50,1)": [(50, 1)] * 100,
+        "32x(100,16)": [(100, 16)] * 32,
+        "32x(16,100)": [(16, 100)] * 32,
+        "4x(64,1000)": [(64, 1000)] * 4,
+        "ragged": list(zip(rng.randint(1, 500, 64), rng.randint(1, 64, 64))),
+    }
+    for name, shapes in geometries.items():
+        A = ragged(queue, [rng.normal(size=shape) for shape in shapes])
+        X = ragged(queue, [rng.normal(size=n) for _, n in shapes])
+        Y = ragged(queue, [np.zeros(m) for m, _ in shapes])
+        js = RaggedArray([[i] for i in range(len(shapes))], dtype=np.int32)
+        yield name, plan_block_gemv(queue, 1.0, A, js, X, js, 0.0, Y).plans
+
+
+def bench_lif(queue, rng, n_calls):
+    """Leaky integrate-and-fire neurons of many or few ensembles."""
+    geometries = {
+        "200x50": [50] * 200,
+        "10x1000": [1000] * 10,
+        "ragged": rng.randint(10, 2000, 64),
+    }
+    for name, sizes in geometries.items():
+        J = ragged(queue, [rng.normal(size=n) for n in sizes])
+        V, W, S = [ragged(queue, [np.zeros(n) for n in sizes]) for _ in range(3)]
+        tau = ragged(queue, [0.02 * np.ones(n) for n in sizes])
+        yield name, [plan_lif(queue, 0.001, J, V, W, S, 0.002, tau, 1.0)]
+
+
+def bench_probes(queue, rng, n_calls):
+    """Probes of many small signals or a few large ones, sampled every step."""
+    geometries = {
+        "100x1": [1] * 100,
+        "10x64": [64] * 10,
+        "ragged": rng.randint(1, 500, 32),
+    }
+    for name, sizes in geometries.items():
+        X = ragged(queue, [rng.normal(size=n) for n in sizes])
+        Y = ragged(queue, [np.zeros((n_calls, n)) for n in sizes])
+        yield name, [plan_probes(queue, [1] * len(sizes), X, Y)]
+
+
+def bench_linearfilter(queue, rng, n_calls):
+    """Lowpass (first order) and Alpha (second order) synapses."""
+    a = np.exp(-0.001 / 0.005)
+    lowpass = ([-a], [1 - a])
+    alpha = ([-2 * a, a ** 2], [0, (1 - a) ** 2])
+    geometries = {
+        "lowpass 200x1": (lowpass, [1] * 200),
+        "lowpass 20x64": (lowpass, [64] * 20),
+        "lowpass ragged": (lowpass, rng.randint(1, 1000, 64)),
+        "alpha 50x16": (alpha, [16] * 50),
+    }
+    for name, ((den, num), sizes) in geometries.items():
+        A = ragged(queue, [den] * len(sizes))
+        B = ragged(queue, [num] * len(sizes))
+        X = ragged(queue, [rng.normal(size=n) for n in sizes])
+        Y = ragged(queue, [np.zeros(n) for n in sizes])
+        Xbuf = ragged(queue, [np.zeros((len(num), n)) for n in sizes])
+        Ybuf = ragged(queue, [np.zeros((len(den), n)) for n in sizes])
+        yield name, plan_linearfilter(queue, X, Y, A, B, Xbuf, Ybuf)
+
+
+def bench_sparse(queue, rng, n_calls):
+    """Sparse connection weights, with the default algorithm selection."""
+    if scipy_sparse is None:
+        return
+
+    geometries = {
+        "1000x1000 1%": (1000, 1000, 0.01),
+        "4000x2000 0.5%": (4000, 2000, 0.005),
+        "500x5000 5%": (500, 5000, 0.05),
+    }
+    for name, (m, n, density) in geometries.items():
+        A = scipy_sparse.random(m, n, density=density, format="csr", random_state=rng)
+        X = ragged(queue, [rng.normal(size=n)])
+        Y = ragged(queue, [np.zeros(m)])
+        hA = HostSparseMatrix(A.astype(np.float32))
+        yield name, plan_sparse_dot_inc(queue, hA, X, Y).plans
+
+    # many small matrices, combined into ragged plans
+    hAs = [
+        HostSparseMatrix(
+            scipy_sparse.random(
+                50, 50, density=0.1, format="csr", random_state=rng
+            ).astype(np.float32)
+        )
+        for _ in range(300)
+    ]
+    X = ragged(queue, [rng.normal(size=50) for _ in hAs])
+    Y = ragged(queue, [np.zeros(50) for _ in hAs])
+    progs = plan_ragged_sparse_dot_inc(queue, hAs, X, Y)
+    yield "300x(50,50) 10%", [plan for prog in progs for plan in prog.plans]
+
+
+def bench_conv2d(queue, rng, n_calls):
+    """Convolutional layers (channels last, "same" padding)."""
+    geometries = {
+        "28x28x1 3x3x8": ((28, 28, 1), (3, 3), 8),
+        "32x32x16 3x3x16": ((32, 32, 16), (3, 3), 16),
+        "16x16x32 5x5x32": ((16, 16, 32), (5, 5), 32),
+    }
+    for name, (shape_in, kernel_shape, n_filters) in geometries.items():
+        shape_out = shape_in[:2] + (n_filters,)
+        n_weights = np.prod(kernel_shape) * shape_in[2] * n_filters
+        X, Y, filters = [
+            cl.array.to_device(queue, rng.normal(size=size).astype(np.float32))
+            for size in (np.prod(shape_in), np.prod(shape_out), n_weights)
+        ]
+        plan = plan_conv2d(
+            queue,
+            X,
+            Y,
+            filters,
+            shape_in,
+            shape_out,
+            kernel_shape,
+            padding="same",
+        )
+        yield name, [plan]
+
+
+benchmarks = {
+    "gemv": bench_gemv,
+    "lif": bench_lif,
+    "probes": bench_probes,
+    "linearfilter": bench_linearfilter,
+    "sparse": bench_sparse,
+    "conv2d": bench_conv2d,
+}
+
+
+def time_plans(queue, plans, repeats):
+    """Median time of one call of all ``plans`` (in seconds), on the device."""
+    for plan in plans:
+        plan.enqueue()  # warmup
+    queue.finish()
+
+    times = []
+    for _ in range(repeats):
+        events = [plan.enqueue() for plan in plans]
+        queue.finish()
+        times.append(sum(1e-9 * (e.profile.end - e.profile.start) for e in events))
+    return float(np.median(times))
+
+
+def total(plans, attr):
+    values = [getattr(plan, attr) for plan in plans]
+    return None if any(v is None for v in values) else float(sum(values))
+
+
+def compare(results, baseline, tolerance):
+    """Print the change from ``baseline``, and return the regressed kernels."""
+    print(" Baseline comparison ".center(72, "-"))
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            print("%-40s %10s" % (key, "new"))
+            continue
+
+        ratio = result["time_us"] / baseline[key]["time_us"]
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(key)
+        print(
+            "%-40s %9.2fx %s"
+            % (key, ratio, "REGRESSION" if regressed else "faster" if ratio < 1 else "")
+        )
+
+    return regressions
+
+
+@click.command()
+@click.option(
+    "--kernels",
+    default=",".join(benchmarks),
+    help="Comma-separated kernels to benchmark (%s)" % ", ".join(benchmarks),
+)
+@click.option("--repeats", default=20, type=int, help="Number of timed calls")
+@click.option("--seed", default=0, type=int, help="Seed for the random data")
+@click.option("--save", default=None, help="Save the results to this JSON file")
+@click.option("--baseline", default=None, help="Compare against this JSON file")
+@click.option(
+    "--tolerance",
+    default=0.2,
+    type=float,
+    help="Fraction by which kernels may be slower than the baseline",
+)
+def main(kernels, repeats, seed, save, baseline, tolerance):
+    """Time the kernels of the plan functions over a grid of geometries."""
+    context = cl.create_some_context()
+    queue = cl.CommandQueue(context, properties=PROFILING_ENABLE)
+    device = queue.device
+    print("Device: %s" % device.name)
+
+    results = {}
+    print("%-40s %10s %8s %8s" % ("kernel", "us/call", "GF/s", "GB/s"))
+    for kernel in kernels.split(","):
+        rng = np.random.RandomState(seed + list(benchmarks).index(kernel))
+        for name, plans in benchmarks[kernel](queue, rng, n_calls=repeats + 1):
+            t = time_plans(queue, plans, repeats)
+            flops = total(plans, "flops_per_call")
+            nbytes = total(plans, "bw_per_call")
+            key = "%s/%s" % (kernel, name)
+            results[key] = {
+                "time_us": 1e6 * t,
+                "gflops": None if flops is None else 1e-9 * flops / t,
+                "gbps": None if nbytes is None else 1e-9 * nbytes / t,
+                "plans": [str(plan) for plan in plans],
+            }
+            print(
+                "%-40s %10.1f %8.2f %8.2f"
+                % (
+                    key,
+                    1e6 * t,
+                    np.nan if flops is None else 1e-9 * flops / t,
+                    np.nan if nbytes is None else 1e-9 * nbytes / t,
+                )
+            )
+
+    record = {
+        "device": device.name,
+        "device_key": device_key(device),
+        "nengo_ocl": nengo_ocl.__version__,
+        "repeats": repeats,
+        "results": results,
+    }
+    if save is not None:
+        with open(save, "w", encoding="utf-8") as fh:
+            json.dump(record, fh, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        with open(baseline, encoding="utf-8") as fh:
+            base = json.load(fh)
+        if base.get("device_key") != record["device_key"]:
+            print(
+                "WARNING: baseline is from a different device or driver (%s)"
+                % base.get("device")
+            )
+        regressions = compare(results, base["results"], tolerance)
+        if regressions:
+            print("%d kernel(s) regressed" % len(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
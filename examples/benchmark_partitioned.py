@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""Benchmark running a model partitioned across several OpenCL devices.
+
+The model is split into ``--partitions`` partitions (see the ``n_partitions``
+argument of ``nengo_ocl.Simulator``), which are assigned to the devices in the
+context in turn. With ``--subdevices N``, the first device is split into ``N``
+sub-devices (device fission, e.g. with POCL on a multi-core CPU). Alternatively,
+POCL can expose several devices directly, e.g. ``POCL_DEVICES="pthread pthread"``.
+"""
+
+import time
+
+import click
+import nengo
+import numpy as np
+import pyopencl as cl
+
+import nengo_ocl
+
+
+def chains_network(n_chains, n_ensembles, n_neurons, dimensions):
+    with nengo.Network(seed=0) as net:
+        for _ in range(n_chains):
+            u = nengo.Node(nengo.processes.WhiteSignal(1, high=5), size_out=dimensions)
+            prev = u
+            for _ in range(n_ensembles):
+                ens = nengo.networks.EnsembleArray(n_neurons, dimensions)
+                nengo.Connection(prev, ens.input, synapse=0.005)
+                prev = ens.output
+            nengo.Probe(prev, synapse=0.01)
+
+    return net
+
+
+def make_context(subdevices):
+    device = cl.get_platforms()[0].get_devices()[0]
+    if subdevices is None:
+        devices = cl.get_platforms()[0].get_devices()
+    else:
+        units = device.max_compute_units // subdevices
+        if units < 1:
+            raise click.BadParameter(
+                "Device has only %d compute units" % device.max_compute_units
+            )
+        devices = device.create_sub_devices(
+            [cl.device_partition_property.EQUALLY, units]
+        )[:subdevices]
+
+    return cl.Context(devices)
+
+
+@click.command()
+@click.option(
+    "--partitions", default="1,2,4", help="Comma-separated numbers of partitions"
+)
+@click.option("--subdevices", default=None, type=int, help="Split device into N")
+@click.option("--chains", default=4, type=int, help="Number of independent chains")
+@click.option("--ensembles", default=4, type=int, help="Ensemble arrays per chain")
+@click.option("--neurons", default=100, type=int, help="Neurons per ensemble")
+@click.option("--dimensions", default=8, type=int, help="Ensembles per array")
+@click.option("--steps", default=1000, type=int, help="Number of steps to time")
+def main(partitions, subdevices, chains, ensembles, neurons, dimensions, steps):
+    """Compare steps per second for different numbers of partitions."""
+    context = make_context(subdevices)
+    print("Devices: %s" % ", ".join(d.name for d in context.devices))
+
+    net = chains_network(chains, ensembles, neurons, dimensions)
+
+    results = {}
+    for n in (int(p) for p in partitions.split(",")):
+        with nengo_ocl.Simulator(
+            net, context=context, n_partitions=n, progress_bar=False
+        ) as sim:
+            sim.run_steps(steps, progress_bar=False)  # warmup, sizes probe buffers
+            sim.reset()
+
+            t0 = time.perf_counter()
+            sim.run_steps(steps, progress_bar=False)
+            results[n] = steps / (time.perf_counter() - t0)
+
+        print(
+            "%2d partition(s): %8.0f steps/s (%0.2fx)"
+            % (n, results[n], results[n] / next(iter(results.values())))
+        )
+
+
+if __name__ == "__main__":
+    main()
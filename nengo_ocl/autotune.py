@@ -0,0 +1,214 @@
+"""Autotuning of kernel parameters, with a per-device database of results.
+
+Some kernels have parameters (e.g. tile and work-group sizes) whose best values
+depend on the device and on the geometry of the problem. `.autotune` times
+candidate parameters on the actual geometry, and stores the fastest in a
+`.TuningDB`, which keeps one JSON file per device (keyed by `.device_key`), so
+that later builds reuse the results without measuring again.
+
+Autotuning can be configured with environment variables:
+
+``NENGO_OCL_AUTOTUNE``
+    If 1, measure candidate parameters for geometries not yet in the database
+    (defaults to 0). Results already in the database are always used.
+``NENGO_OCL_TUNING_DIR``
+    Directory in which to store the tuning databases
+    (defaults to ``<nengo cache dir>/ocl_tuning``).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pyopencl as cl
+from nengo.cache import safe_makedirs, safe_remove
+from nengo.utils.paths import cache_dir as nengo_cache_dir
+
+from nengo_ocl.program_cache import atomic_dump, device_key
+
+logger = logging.getLogger(__name__)
+
+
+class TuningDB:
+    """Best kernel parameters for each device, kernel, and geometry.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory in which to store the databases, one JSON file per device.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._entries = {}  # device key -> {kernel/geometry key -> entry}
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _load(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as fh:
+                entries = json.load(fh)["entries"]
+        except FileNotFoundError:
+            entries = {}
+        except Exception as e:  # pylint: disable=broad-except
+            logger.debug("Could not load tuning database %r: %s", path, e)
+            safe_remove(path)
+            entries = {}
+        return entries
+
+    def get(self, device, kernel, key):
+        """Get the stored entry for ``kernel`` on geometry ``key``, or None."""
+        dkey = device_key(device)
+        if dkey not in self._entries:
+            self._entries[dkey] = self._load(dkey)
+        return self._entries[dkey].get("%s/%s" % (kernel, key), None)
+
+    def set(self, device, kernel, key, entry):
+        """Store ``entry`` (a JSON-serializable dict) for ``kernel`` on ``key``."""
+        dkey = device_key(device)
+
+        # merge with entries saved in the meantime (e.g. by other processes)
+        entries = self._load(dkey)
+        entries.update(self._entries.get(dkey, {}))
+        entries["%s/%s" % (kernel, key)] = entry
+        self._entries[dkey] = entries
+
+        safe_makedirs(self.cache_dir)
+        try:
+            atomic_dump(
+                {"device": device.name, "entries": entries},
+                self._path(dkey),
+                serializer=json,
+            )
+        except OSError as e:
+            logger.debug("Could not save tuning database: %s", e)
+
+
+_default_tuning_db = None
+
+
+def get_default_tuning_db():
+    """Get the tuning database used by all plans, creating it if necessary."""
+    global _default_tuning_db  # pylint: disable=global-statement
+    if _default_tuning_db is None:
+        _default_tuning_db = TuningDB(
+            os.getenv(
+                "NENGO_OCL_TUNING_DIR", os.path.join(nengo_cache_dir, "ocl_tuning")
+            )
+        )
+    return _default_tuning_db
+
+
+def set_default_tuning_db(db):
+    """Set the tuning database used by all plans (None restores the default)."""
+    global _default_tuning_db  # pylint: disable=global-statement
+    _default_tuning_db = db
+
+
+def autotune_enabled():
+    """Whether to measure parameters for geometries not in the database."""
+    return bool(int(os.getenv("NENGO_OCL_AUTOTUNE", "0")))
+
+
+def geometry_key(*arrays):
+    """A short key identifying the geometry described by ``arrays``."""
+    h = hashlib.sha1()
+    for array in arrays:
+        array = np.asarray(array)
+        h.update(str((array.dtype.str, array.shape)).encode("utf-8"))
+        h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()
+
+
+def time_plans(plans, repeats=5):
+    """Best time (in seconds) of ``repeats`` calls of all ``plans`` in order."""
+    queue = plans[0].queue
+    times = []
+    for _ in range(repeats + 1):  # the first call is a warmup
+        queue.finish()
+        t0 = time.perf_counter()
+        event = None
+        for plan in plans:
+            event = plan.enqueue(wait_for=None if event is None else [event])
+        event.wait()
+        times.append(time.perf_counter() - t0)
+    return min(times[1:])
+
+
+def autotune(
+    queue,
+    kernel,
+    key,
+    candidates,
+    make_plans,
+    outputs=(),
+    db=None,
+    repeats=5,
+    measure=None,
+):
+    """Choose the fastest parameters for ``kernel`` on geometry ``key``.
+
+    If the database has an entry for this kernel and geometry, its parameters are
+    returned. Otherwise, if ``measure`` is True, the
+    plans returned by ``make_plans(**params)`` are timed for each ``params`` in
+    ``candidates``, and the fastest parameters are stored and returned.
+    Candidates that fail to build or run are skipped.
+
+    Parameters
+    ----------
+    queue : pyopencl.CommandQueue
+        Queue on which the plans run.
+    kernel : str
+        Name of the kernel being tuned.
+    key : str
+        Key identifying the geometry of the problem (see `.geometry_key`).
+    candidates : list of dict
+        Candidate parameters (keyword arguments of ``make_plans``).
+    make_plans : callable
+        Function returning the list of plans for given parameters.
+    outputs : list of pyopencl.array.Array
+        Arrays written by the plans, which are restored after timing.
+    db : TuningDB, optional
+        Database to use (defaults to `.get_default_tuning_db`).
+    repeats : int, optional
+        Number of timed calls for each candidate (the best is used).
+    measure : bool, optional
+        Whether to measure parameters not in the database (defaults to
+        `.autotune_enabled`).
+
+    Returns
+    -------
+    dict or None
+        The best parameters, or None if they are not known and not measured.
+    """
+    db = get_default_tuning_db() if db is None else db
+    entry = db.get(queue.device, kernel, key)
+    if entry is not None and entry["params"] in candidates:
+        return entry["params"]
+    if not (autotune_enabled() if measure is None else measure):
+        return None
+
+    backups = [output.get() for output in outputs]
+    best, best_time = None, np.inf
+    for params in candidates:
+        try:
+            t = time_plans(make_plans(**params), repeats=repeats)
+        except (cl.Error, NotImplementedError) as e:
+            logger.debug("Autotuning %s: %s failed: %s", kernel, params, e)
+            continue
+
+        logger.debug("Autotuning %s: %s took %0.1f us", kernel, params, 1e6 * t)
+        if t < best_time:
+            best, best_time = params, t
+    for output, backup in zip(outputs, backups):
+        output.set(backup)
+
+    if best is not None:
+        logger.info("Autotuned %s: %s (%0.1f us)", kernel, best, 1e6 * best_time)
+        db.set(queue.device, kernel, key, {"params": best, "time": best_time})
+    return best
@@ -9,8 +9,10 @@ import numpy as np
 import pyopencl as cl
 from mako.template import Template
 
+from nengo_ocl.autotune import autotune, geometry_key
 from nengo_ocl.clraggedarray import CLRaggedArray, to_device
 from nengo_ocl.plan import Plan
+from nengo_ocl.program_cache import build_program
 from nengo_ocl.utils import HostSparseMatrix, as_ascii, round_up_power_of_2
 
 
@@ -208,6 +210,45 @@ class gemv_prog:
 
         return rval
 
+    def block_params(self, items, measure=None):
+        """Block sizes for `block_impl` on ``items``, tuned for their geometry.
+
+        Tuned block sizes are looked up in the tuning database of the device, and
+        measured if ``measure`` (which defaults to whether autotuning is enabled,
+        see `nengo_ocl.autotune`). Otherwise, the defaults of `block_impl` are used.
+        """
+        dots = [
+            (self.Y.shape0s[n], self.A.shape1s[aj[0]])
+            for n in items
+            for aj in self.A_js[n]
+        ]
+        key = geometry_key(np.array(dots, dtype=np.int64), str(self.Y.dtype))
+        params = autotune(
+            self.queue,
+            "clra_gemv.block_impl",
+            key,
+            block_impl_candidates(self),
+            lambda **params: block_impl(self, items, **params),
+            outputs=[self.Y.cl_buf],
+            measure=measure,
+        )
+        return dict(_block_defaults, **({} if params is None else params))
+
+    def block_plans(self, items):
+        """`block_impl` plans for ``items``, with the tuned block sizes."""
+        return block_impl(self, items, **self.block_params(items))
+
+    def contiguous(self, items):
+        """Whether ``Y``, ``Y_in``, and the ``X`` of ``items`` have unit strides."""
+        return all(
+            self.Y.stride0s[ii] == 1
+            and self.Y_in.stride0s[ii] == 1
+            and all(
+                self.X.stride0s[dot["x_j"]] == 1 for dot in self.geometry[ii]["dots"]
+            )
+            for ii in items
+        )
+
     def cl_geometry_and_textconf(self, items, padding=4):
         p = self
         max_n_dots = max(len(p.geometry[ii]["dots"]) for ii in items)
@@ -284,12 +325,14 @@ def ref_impl(p, items):  # noqa: C901
             print("Falling back on reference implementation")
             p.print_geometry_summary(items)
 
-    assert all(s == 1 for s in p.A.stride1s)
-    assert all(s == 1 for s in p.X.stride1s)
-    assert all(s == 1 for s in p.Y.stride0s)
-    assert all(s == 1 for s in p.Y.stride1s)
-    assert all(s == 1 for s in p.Y_in.stride0s)
-    assert all(s == 1 for s in p.Y_in.stride1s)
+    if not all(s == 1 for s in p.A.stride1s):
+        raise NotImplementedError()
+    if not all(s == 1 for s in p.X.stride1s):
+        raise NotImplementedError()
+    if not all(p.Y.stride0s[i] == 1 and p.Y_in.stride0s[i] == 1 for i in items):
+        raise NotImplementedError()
+    if not all(p.Y.stride1s[i] == 1 and p.Y_in.stride1s[i] == 1 for i in items):
+        raise NotImplementedError()
 
     text = """
         __kernel void gemv_ref(
@@ -391,24 +434,29 @@ def ref_impl(p, items):  # noqa: C901
 
     gsize = (max(p.geometry[ii]["y_len"] for ii in items), len(items))
     lsize = None
-    fn = cl.Program(p.queue.context, text).build().gemv_ref
+    fn = build_program(p.queue.context, text).gemv_ref
     full_args = [cl_items]
     if p.cl_alpha is not None:
         full_args += [p.cl_alpha]
     if p.A_js is not None:
+        # -- the indices may be on the host (as for the other implementations)
+        A_js, X_js = [
+            js if isinstance(js, CLRaggedArray) else CLRaggedArray(p.queue, js)
+            for js in (p.A_js, p.X_js)
+        ]
         full_args += [
             p.A.cl_starts,
             p.A.cl_shape1s,
             p.A.cl_stride0s,
             p.A.cl_buf,
-            p.A_js.cl_starts,
-            p.A_js.cl_shape0s,
-            p.A_js.cl_buf,
+            A_js.cl_starts,
+            A_js.cl_shape0s,
+            A_js.cl_buf,
             p.X.cl_starts,
             p.X.cl_stride0s,
             p.X.cl_buf,
-            p.X_js.cl_starts,
-            p.X_js.cl_buf,
+            X_js.cl_starts,
+            X_js.cl_buf,
         ]
     if p.cl_beta is not None:
         full_args += [p.cl_beta]
@@ -464,6 +512,8 @@ def reduce_impl(p, items, group_size=None, segment_size=None):  # noqa: C901
         raise NotImplementedError()
     if not all(s == 1 for s in p.A.stride1s):
         raise NotImplementedError()
+    if not p.contiguous(items):
+        raise NotImplementedError()
 
     assert p.float_alpha is not None
     assert p.float_gamma is not None
@@ -640,7 +690,7 @@ def reduce_impl(p, items, group_size=None, segment_size=None):  # noqa: C901
 
     text = as_ascii(Template(text, output_encoding="ascii").render(**textconf))
 
-    fn = cl.Program(p.queue.context, text).build().gemv_reduce
+    fn = build_program(p.queue.context, text).gemv_reduce
 
     full_args = [
         cl_gstructure,
@@ -699,6 +749,8 @@ def many_dots_impl(p, items):  # noqa: C901
         raise NotImplementedError()
     if not all(s == 1 for s in p.A.stride1s):
         raise NotImplementedError()
+    if not p.contiguous(items):
+        raise NotImplementedError()
 
     assert p.float_alpha is not None
     assert p.float_gamma is not None
@@ -828,7 +880,7 @@ def many_dots_impl(p, items):  # noqa: C901
         """
 
     text = as_ascii(Template(text, output_encoding="ascii").render(**textconf))
-    fn = cl.Program(p.queue.context, text).build().gemv_many_dots
+    fn = build_program(p.queue.context, text).gemv_many_dots
 
     full_args = [
         cl_gstructure,
@@ -858,7 +910,7 @@ def many_dots_impl(p, items):  # noqa: C901
     return rval
 
 
-def block_impl(p, items):  # noqa: C901
+def block_impl(p, items, block_y=32, block_x=128, lsize0=4):  # noqa: C901
 
     if p.clra_alpha is not None:
         raise NotImplementedError()
@@ -883,12 +935,9 @@ def block_impl(p, items):  # noqa: C901
     # We want to group the dot products into blocks, so that each workgroup
     # is computing a (block_y, block_x) region of a dot product. To do this,
     # we create a temporary output buffer, compute each block to a separate
-    # region of this buffer, then reduce across the buffer in a separate kernel
-
-    # block_y = 8
-    block_y = 32
-    # block_x = 32
-    block_x = 128
+    # region of this buffer, then reduce across the buffer in a separate kernel.
+    # The best block sizes depend on the device (the defaults were chosen for a
+    # GPU); see `block_impl_candidates` and `plan_block_gemv` for autotuning.
 
     shape0s = []
     shape1s = []
@@ -971,10 +1020,8 @@ def block_impl(p, items):  # noqa: C901
     # --- create Y buffer
     clYbuf = to_device(p.queue, np.zeros(Ybufstart, dtype=p.Y.dtype))
 
-    lsize0 = 4
-    # lsize0 = 8
     lsize0_log2 = int(np.log2(lsize0))
-    assert 2 ** lsize0_log2 == lsize0
+    assert 2 ** lsize0_log2 == lsize0 >= 2
 
     lsize = (lsize0, block_y, 1)
     gsize = (lsize[0], lsize[1], gstructure.shape[0])
@@ -1060,7 +1107,7 @@ def block_impl(p, items):  # noqa: C901
     """
 
     text = as_ascii(Template(text, output_encoding="ascii").render(**textconf))
-    kernel = cl.Program(p.queue.context, text).build().fn
+    kernel = build_program(p.queue.context, text).fn
     kernel.set_args(*[arr.data for arr in full_args])
 
     plan = Plan(
@@ -1075,6 +1122,7 @@ def block_impl(p, items):  # noqa: C901
     )
     plan.full_args = full_args  # prevent GC the args
     plan.description = p.geometry_summary(items)
+    plan.params = dict(block_y=block_y, block_x=block_x, lsize0=lsize0)
     plan.Ybuf = clYbuf
 
     # --- Reduce kernel
@@ -1157,7 +1205,7 @@ def block_impl(p, items):  # noqa: C901
     text_reduce = as_ascii(
         Template(text_reduce, output_encoding="ascii").render(**textconf_reduce)
     )
-    kernel_reduce = cl.Program(p.queue.context, text_reduce).build().reduce
+    kernel_reduce = build_program(p.queue.context, text_reduce).reduce
     kernel_reduce.set_args(*[arr.data for arr in full_args_reduce])
 
     plan_reduce = Plan(
@@ -1190,9 +1238,258 @@ class plan_reduce_gemv(gemv_prog):
         return [reduce_impl(self, range(len(self.Y)))]
 
 
+_block_defaults = dict(block_y=32, block_x=128, lsize0=4)  # those of `block_impl`
+
+
+def block_impl_candidates(p):
+    """Block sizes for `block_impl` that fit in the work groups of the device."""
+    device = p.queue.device
+    itemsize = max(p.X.dtype.itemsize, p.Y.dtype.itemsize)
+    candidates = []
+    for block_y in (8, 16, 32, 64):
+        for block_x in (32, 64, 128, 256):
+            for lsize0 in (2, 4, 8, 16):
+                group_size = lsize0 * block_y
+                local_mem = (block_x + block_y * lsize0) * itemsize + 4 * 8
+                if (
+                    block_x <= group_size <= device.max_work_group_size
+                    and lsize0 <= device.max_work_item_sizes[0]
+                    and block_y <= device.max_work_item_sizes[1]
+                    and local_mem <= device.local_mem_size
+                ):
+                    candidates.append(
+                        dict(block_y=block_y, block_x=block_x, lsize0=lsize0)
+                    )
+    return candidates
+
+
 class plan_block_gemv(gemv_prog):
+    """GEMV with `block_impl`, using the block sizes tuned for this geometry.
+
+    Tuned block sizes are looked up in the tuning database of the device, and
+    measured if autotuning is enabled (see `nengo_ocl.autotune`). Otherwise, the
+    defaults of `block_impl` are used.
+    """
+
+    def choose_plans(self):
+        items = list(range(len(self.Y)))
+        if self.A_js is None:
+            return block_impl(self, items)  # raises NotImplementedError
+
+        return self.block_plans(items)
+
+
+_gemv_impls = {
+    "ref": ref_impl,
+    "reduce": reduce_impl,
+    "many_dots": many_dots_impl,
+    "block": gemv_prog.block_plans,
+}
+
+# Costs in the GEMV cost model, in multiply-adds of one lane: launching a kernel,
+# one work item passing a barrier (on CPUs, work items in a group run in turn),
+# and reading A where neighbouring work items read different rows (not coalesced).
+_launch_cost = 5000
+_barrier_cost = {"cpu": 8, "gpu": 1}
+_uncoalesced_cost = 4
+
+
+def gemv_impl_cost(p, impl, items):
+    """Predicted time of implementation ``impl`` for ``items`` of ``p``.
+
+    This is a work-depth model of each kernel: a kernel takes
+    ``max(work / lanes, depth)`` plus a launch cost, where ``work`` is the number of
+    multiply-adds done by all work items (including the padding of the work grid
+    and the cost of barriers), ``depth`` is the longest serial loop of one work
+    item, and ``lanes`` is the number of work items the device runs in parallel.
+    Times are in multiply-adds of one lane; they are only meant to be compared with
+    each other.
+    """
+    device = p.queue.device
+    gpu = bool(device.type & cl.device_type.GPU)
+    lanes = device.max_compute_units * (
+        64 if gpu else max(device.preferred_vector_width_float, 1)
+    )
+    barrier = _barrier_cost["gpu" if gpu else "cpu"]
+
+    def kernel(work, depth):
+        return max(work / lanes, depth) + _launch_cost
+
+    ceil = lambda a, b: -(-a // b)
+    y_lens = np.array([p.geometry[ii]["y_len"] for ii in items])
+    shape1s = [[dot["a_shape1"] for dot in p.geometry[ii]["dots"]] for ii in items]
+    n_dots = np.array([len(s) for s in shape1s])
+    max_y_len = y_lens.max()
+    max_shape1 = max(max(s, default=0) for s in shape1s)
+
+    # work items reading the rows of A read each element of a row in turn
+    row_costs = np.array(
+        [sum(1 if n == 1 else _uncoalesced_cost * n for n in s) for s in shape1s]
+    )
+
+    if impl == "ref":
+        # one work item per output, looping over all dot products
+        return kernel(max_y_len * (row_costs.sum() + len(items)), row_costs.max())
+    if impl == "reduce":
+        # groups of 32 work items reduce over each row, for 2 or 4 rows, with a
+        # tree reduction (6 barriers) for each 32 elements of each dot product
+        segment_size = min(max_y_len, 2 if len(items) < 4 else 4)
+        rows = ceil(max_y_len, segment_size) * segment_size
+        iters = np.array([sum(ceil(n, 32) for n in s) for s in shape1s])
+        work = rows * 32 * ((1 + 6 * barrier) * iters.sum() + len(items))
+        return kernel(work, iters.max() * 6)
+    if impl == "many_dots":
+        # work items for up to 16 rows and a block of the dot products
+        segment_size = min(max_y_len, 16)
+        rows = ceil(max_y_len, segment_size) * segment_size
+        dot_block_size = min(
+            max(n_dots.max(), 1), device.max_work_group_size // segment_size
+        )
+        work = rows * (
+            row_costs.sum() + (1 + 2 * barrier) * dot_block_size * len(items)
+        )
+        return kernel(work, ceil(n_dots.max(), dot_block_size) * max_shape1)
+    if impl == "block":
+        # groups compute (block_y, block_x) blocks of each dot product (with the
+        # block sizes tuned for these items, if known), then a reduction
+        params = p.block_params(items, measure=False)
+        block_y, block_x = params["block_y"], params["block_x"]
+        blocks = np.array(
+            [
+                ceil(y, block_y) * sum(ceil(n, block_x) for n in s)
+                for y, s in zip(y_lens, shape1s)
+            ]
+        )
+        block_cost = kernel(
+            blocks.sum() * block_y * (block_x + 4 * barrier),
+            block_x // params["lsize0"] + 2,
+        )
+        reduce_depth = max(sum(ceil(n, block_x) for n in s) for s in shape1s)
+        return block_cost + kernel(blocks.sum() * block_y, reduce_depth)
+    raise ValueError("Unknown implementation %r" % impl)
+
+
+class plan_dispatch_gemv(gemv_prog):
+    """GEMV that dispatches each kind of geometry to the fastest implementation.
+
+    Items are partitioned by their geometry: the output length, the number of dot
+    products, and the longest dot product (each rounded up to a power of two), and
+    whether their vectors are contiguous. For each partition, the implementation
+    is the one measured fastest, if it is in the tuning database or autotuning is
+    enabled (see `nengo_ocl.autotune`), or else the one predicted fastest by
+    `gemv_impl_cost`. Partitions using the same implementation are then merged
+    into one kernel where that is predicted to be faster.
+
+    The ``NENGO_OCL_GEMV_ALGORITHM`` environment variable can be set to one of
+    ``ref``, ``reduce``, ``many_dots``, or ``block`` to use that implementation
+    wherever possible.
+
+    The implementation chosen for each plan, and why, is in its ``description``
+    (see ``Simulator.print_plans``).
+    """
+
     def choose_plans(self):
-        return block_impl(self, list(range(len(self.Y))))
+        if self.A_js is None:
+            return block_impl(self, list(range(len(self.Y))))  # NotImplementedError
+
+        partitions = defaultdict(list)
+        for ii, gi in enumerate(self.geometry):
+            key = (
+                round_up_power_of_2(gi["y_len"]),
+                round_up_power_of_2(len(gi["dots"])),
+                round_up_power_of_2(max([d["a_shape1"] for d in gi["dots"]] + [0])),
+                self.contiguous([ii]),
+            )
+            partitions[key].append(ii)
+
+        groups = defaultdict(list)  # implementation -> [(items, description)]
+        for key, items in sorted(partitions.items()):
+            impl, reason = self._choose_impl(key, items)
+            groups[impl].append(
+                (items, "yd<=%d, dots<=%d, d<=%d: %s" % (key[:3] + (reason,)))
+            )
+
+        plans = []
+        for impl, parts in groups.items():
+            for items, lines in self._merge(impl, parts):
+                plans.extend(self._impl_plans(impl, items, lines))
+        return plans
+
+    def _choose_impl(self, key, items):
+        _, n_dots, _, contiguous = key
+        names = ["block"]
+        if n_dots > 0 and contiguous:
+            names += ["ref", "reduce", "many_dots"]
+
+        algorithm = os.environ.get("NENGO_OCL_GEMV_ALGORITHM", None)
+        if algorithm:
+            return (algorithm if algorithm in names else "block"), "environment"
+
+        impl = self._measured_impl(items, names)
+        if impl is not None:
+            return impl, "measured"
+
+        costs = {name: gemv_impl_cost(self, name, items) for name in names}
+        return min(names, key=costs.__getitem__), "predicted (%s)" % ", ".join(
+            "%s %0.3g" % (name, costs[name]) for name in names
+        )
+
+    def _merge(self, impl, parts):
+        """Merge partitions using ``impl`` where one kernel is predicted faster."""
+        cost = lambda items: gemv_impl_cost(self, impl, items)
+        merged = []
+        for items, line in parts:
+            for k, (m_items, m_lines) in enumerate(merged):
+                if cost(m_items + items) <= cost(m_items) + cost(items):
+                    merged[k] = (m_items + items, m_lines + [line])
+                    break
+            else:
+                merged.append((items, [line]))
+        return [(sorted(items), lines) for items, lines in merged]
+
+    def _measured_impl(self, items, names):
+        dots = [
+            (self.geometry[ii]["y_len"], dot["a_shape1"])
+            for ii in items
+            for dot in self.geometry[ii]["dots"]
+        ]
+        key = geometry_key(
+            np.array(dots, dtype=np.int64).reshape(-1, 2),
+            np.array([len(self.geometry[ii]["dots"]) for ii in items]),
+            str(self.Y.dtype),
+        )
+
+        def make_plans(impl):
+            plans = _gemv_impls[impl](self, items)
+            return plans if isinstance(plans, list) else [plans]
+
+        params = autotune(
+            self.queue,
+            "clra_gemv.dispatch",
+            key,
+            [dict(impl=name) for name in names],
+            make_plans,
+            outputs=[self.Y.cl_buf],
+        )
+        return None if params is None else params["impl"]
+
+    def _impl_plans(self, impl, items, lines):
+        try:
+            plans = _gemv_impls[impl](self, items)
+        except NotImplementedError:
+            if impl == "block":
+                raise
+            lines = ["%s (not supported by %s)" % (line, impl) for line in lines]
+            impl, plans = "block", self.block_plans(items)
+
+        plans = plans if isinstance(plans, list) else [plans]
+        plans[0].tag += "-%s%d" % (impl, len(items))
+        plans[0].description = "dispatch: %s\n%s\n%s" % (
+            impl,
+            "\n".join("  " + line for line in lines),
+            self.geometry_summary(items),
+        )
+        return plans
 
 
 class plan_ragged_gather_gemv(gemv_prog):
@@ -1254,14 +1551,19 @@ class spmv_prog:
     Children classes define storage format of the sparse matrix on host and device,
     as well as choosing the implementation of the algorithm.
 
+    If ``hA`` is a list of matrices, the program is *ragged*: it computes
+    ``Y[i] += hA[i] * X[i]`` for all matrices at once. The rows of all matrices
+    are concatenated in one sparse structure (as in a block-diagonal matrix), and
+    each row is mapped to its matrix and to the offsets of ``X[i]`` and ``Y[i]``.
+
     Parameters
     ----------
     queue : cl.CommandQueue
         The queue for this plan.
-    hA : HostSparseMatrix
+    hA : HostSparseMatrix or list of HostSparseMatrix
         Matrix to multiply. ``Y = hA.dot(X)``
-    X, Y : CLRaggedArrays of length 1
-        Input/output data.
+    X, Y : CLRaggedArrays
+        Input/output data, with one array per matrix.
     inc : bool
         Whether the plan will increment or set ``Y``.
     tag : str
@@ -1284,7 +1586,13 @@ class spmv_prog:
             - create the plans
         Most often, the caller will use prog_obj.plans after initializing
         """
-        if not isinstance(hA, HostSparseMatrix):
+        self.ragged = isinstance(hA, (list, tuple))
+        if self.ragged:
+            hA = [
+                a if isinstance(a, HostSparseMatrix) else HostSparseMatrix(a)
+                for a in hA
+            ]
+        elif not isinstance(hA, HostSparseMatrix):
             hA = HostSparseMatrix(hA)
 
         self.queue = queue
@@ -1296,13 +1604,44 @@ class spmv_prog:
 
         self.hAstruct = None  # Host array data. Depends on storage format.
         self.dAstruct = None  # Device array data. Mirror of hAstruct.
+        self.A_rowmats = None  # Matrix of each row (ragged programs only)
+        self.A_rowstarts = None  # First row of each matrix (ragged programs only)
 
         self.to_hostdata()
         self.to_device()
+        if self.ragged:
+            self.rows_to_device()
         self.validate_data()
         self.plans = self.choose_plans()
         self.assign_plan_characteristics(self.plans)
 
+    @property
+    def matrices(self):
+        """List of the matrices multiplied by this program."""
+        return self.hA if self.ragged else [self.hA]
+
+    def rows_to_device(self):
+        n_rows = [A.csr.shape[0] for A in self.hA]
+        self.A_rowmats = to_device(
+            self.queue, np.repeat(np.arange(len(n_rows), dtype=np.int32), n_rows)
+        )
+        self.A_rowstarts = to_device(
+            self.queue, np.cumsum([0] + n_rows[:-1]).astype(np.int32)
+        )
+
+    def validate_matrices(self):
+        assert len(self.X) == len(self.Y) == len(self.matrices)
+        for i, A in enumerate(self.matrices):
+            assert A.csr.shape == (self.Y.shape0s[i], self.X.shape0s[i])
+
+        for arr in [self.X, self.Y]:
+            assert (arr.stride1s == 1).all()
+            if not ((arr.shape1s == 1).all() and (arr.stride0s == 1).all()):
+                raise NotImplementedError(
+                    "OCL SparseDot only supports matrix-vector currently, "
+                    "not matrix-matrix."
+                )
+
     def assign_plan_characteristics(self, plans):
         pass
 
@@ -1363,8 +1702,32 @@ class plan_ellpack(spmv_prog):
             else plan_ellpack_tree
         )
 
+    @staticmethod
+    def concat_elldata(elldatas):
+        """Concatenate the rows of several matrices, padded to the largest width."""
+        matwidth = max(d.columns.shape[1] for d in elldatas)
+        columns, entries = [], []
+        for d in elldatas:
+            padding = ((0, 0), (0, matwidth - d.columns.shape[1]))
+            columns.append(np.pad(d.columns, padding))
+            entries.append(np.pad(d.entries, padding))
+
+        return ell_matdata(
+            np.concatenate(columns),
+            np.concatenate(entries),
+            np.concatenate([d.rowlens for d in elldatas]),
+            max(d.ellwidth for d in elldatas),
+            sum(d.nnz for d in elldatas),
+            tuple(np.sum([d.shape for d in elldatas], axis=0)),
+        )
+
     def to_hostdata(self):
-        self.hAstruct = plan_ellpack.scipy2elldata(self.hA)
+        if self.ragged:
+            self.hAstruct = plan_ellpack.concat_elldata(
+                [plan_ellpack.scipy2elldata(A) for A in self.hA]
+            )
+        else:
+            self.hAstruct = plan_ellpack.scipy2elldata(self.hA)
 
     def to_device(self):
         A_columns_host = self.hAstruct.columns
@@ -1379,20 +1742,12 @@ class plan_ellpack(spmv_prog):
         )
 
     def validate_data(self):
-        assert len(self.X) == len(self.Y) == 1
-
-        for arr in [self.X, self.Y]:
-            assert (arr.stride1s == 1).all()
-            if not ((arr.shape1s == 1).all() and (arr.stride0s == 1).all()):
-                raise NotImplementedError(
-                    "OCL SparseDot only supports matrix-vector currently, "
-                    "not matrix-matrix."
-                )
+        self.validate_matrices()
 
         for arr in [self.dAstruct.columns, self.dAstruct.entries]:
             assert len(arr.shape) == 2
-            assert arr.shape[0] == self.Y.shape0s
-            assert arr.shape[1] == self.dAstruct.ellwidth
+            assert arr.shape[0] == self.Y.shape0s.sum()
+            assert arr.shape[1] == max(self.dAstruct.ellwidth, 1)
             # assert arr.strides[-1] == 1  # contiguous
 
         assert self.dAstruct.columns.shape == self.dAstruct.entries.shape
@@ -1420,6 +1775,8 @@ class plan_ellpack_tree(plan_ellpack):
             self.Y,
             inc=self.inc,
             tag=self.tag,
+            A_rowmats=self.A_rowmats,
+            A_rowstarts=self.A_rowstarts,
         )
         return [plan]
 
@@ -1435,7 +1792,7 @@ class plan_ellpack_tree(plan_ellpack):
         plan.description = (
             "groups: %d; shape: (%d, %d); nonzeros: %d; max fan-in: %d"
             % (
-                1,
+                len(self.matrices),
                 *self.dAstruct.shape,
                 self.dAstruct.nnz,
                 self.dAstruct.ellwidth,
@@ -1450,6 +1807,11 @@ class plan_ellpack_twostep(plan_ellpack):
     """
 
     def choose_plans(self):
+        if self.ragged:
+            raise NotImplementedError(
+                "Two-step ELLPACK does not support ragged matrices"
+            )
+
         plans = spmv_ellpacktwostep_impl(
             self.queue,
             self.dAstruct.columns,
@@ -1505,8 +1867,26 @@ class plan_csr(spmv_prog):
             scipy_csr.shape,
         )
 
+    @staticmethod
+    def concat_csrdata(csrdatas):
+        """Concatenate the rows of several matrices."""
+        offsets = np.cumsum([0] + [d.nnz for d in csrdatas])
+        indptr = [d.indptr[:-1] + offset for d, offset in zip(csrdatas, offsets)]
+        return csr_matdata(
+            np.concatenate([d.indices for d in csrdatas]),
+            np.concatenate(indptr + [offsets[-1:]]).astype(np.int32),
+            np.concatenate([d.data for d in csrdatas]),
+            offsets[-1],
+            tuple(np.sum([d.shape for d in csrdatas], axis=0)),
+        )
+
     def to_hostdata(self):
-        self.hAstruct = plan_csr.scipy2csrdata(self.hA)
+        if self.ragged:
+            self.hAstruct = plan_csr.concat_csrdata(
+                [plan_csr.scipy2csrdata(A) for A in self.hA]
+            )
+        else:
+            self.hAstruct = plan_csr.scipy2csrdata(self.hA)
 
     def to_device(self):
         self.dAstruct = csr_matdata(
@@ -1518,15 +1898,7 @@ class plan_csr(spmv_prog):
         )
 
     def validate_data(self):
-        assert len(self.X) == len(self.Y) == 1
-
-        for arr in [self.X, self.Y]:
-            assert (arr.stride1s == 1).all()
-            if not ((arr.shape1s == 1).all() and (arr.stride0s == 1).all()):
-                raise NotImplementedError(
-                    "OCL SparseDot only supports matrix-vector currently, "
-                    "not matrix-matrix"
-                )
+        self.validate_matrices()
 
         for arr in [self.dAstruct.indices, self.dAstruct.indptr, self.dAstruct.data]:
             assert len(arr.shape) == 1
@@ -1547,6 +1919,8 @@ class plan_csr(spmv_prog):
             self.Y,
             inc=self.inc,
             tag=self.tag,
+            A_rowmats=self.A_rowmats,
+            A_rowstarts=self.A_rowstarts,
         )
         return [plan]
 
@@ -1561,13 +1935,24 @@ class plan_csr(spmv_prog):
             + self.Y.nbytes
         )
         plan.description = "groups: %d; shape: (%d, %d); nonzeros: %d" % (
-            1,
+            len(self.matrices),
             *self.dAstruct.shape,
             self.dAstruct.nnz,
         )
 
 
-def spmv_csr_impl(queue, A_indices, A_indptr, A_data, X, Y, inc=False, tag=None):
+def spmv_csr_impl(
+    queue,
+    A_indices,
+    A_indptr,
+    A_data,
+    X,
+    Y,
+    inc=False,
+    tag=None,
+    A_rowmats=None,
+    A_rowstarts=None,
+):
     """SPMV kernel with the CSR format.
 
     Parameters
@@ -1576,10 +1961,13 @@ def spmv_csr_impl(queue, A_indices, A_indptr, A_data, X, Y, inc=False, tag=None)
         Column sparse row index specifications
     A_data : PyOpenCL array
         Matrix values at those indices
-    X, Y : CLRaggedArrays of length 1
-        Input/output data.
+    X, Y : CLRaggedArrays
+        Input/output data, with one array per matrix.
     inc : bool
         Whether to increment ``Y`` (True), or set it (False).
+    A_rowmats, A_rowstarts : PyOpenCL array, optional
+        For several (concatenated) matrices, the matrix of each row and the first
+        row of each matrix. If not given, there is one matrix.
 
     Returns
     -------
@@ -1595,35 +1983,51 @@ def spmv_csr_impl(queue, A_indices, A_indptr, A_data, X, Y, inc=False, tag=None)
         __global const int *Xstarts,
         __global const ${dtype} *Xdata,
         __global const int *Ystarts,
-        __global ${dtype} *Ydata
+        __global ${dtype} *Ydata${", " if ragged else ""}
+    %if ragged:
+        __global const int *A_rowmats,
+        __global const int *A_rowstarts
+    %endif
     )
     {
-        // n can later be used to keep track of multiple arrays
-        const int n = 0;
-        const int irow = get_global_id(0);
-
-        if (irow >= ${Y_size}) {
+        const int i = get_global_id(0);  // row in all matrices
+        if (i >= ${n_rows}) {
             return;
         }
 
+    %if ragged:
+        const int n = A_rowmats[i];
+        const int irow = i - A_rowstarts[n];
+    %else:
+        const int n = 0;
+        const int irow = i;
+    %endif
+
         __global const ${dtype} *x = Xdata + Xstarts[n];
         __global ${dtype} *y = Ydata + Ystarts[n];
 
     %if not inc:
         y[irow] = 0;
     %endif
-        const int end = A_indptr[irow + 1];
-        for (int k = A_indptr[irow]; k < end; k++) {
+        const int end = A_indptr[i + 1];
+        for (int k = A_indptr[i]; k < end; k++) {
             y[irow] += A_data[k] * x[A_indices[k]];
         }
     }
     """
 
     # --- dimensioning
-    gsize = (Y.sizes[0], 1)
+    ragged = A_rowmats is not None
+    n_rows = A_indptr.size - 1
+    assert n_rows == Y.sizes.sum()
+    gsize = (n_rows, 1)
     lsize = None
     textconf = dict(
-        dtype=A_data.ctype, IndType=A_indices.ctype, inc=inc, Y_size=Y.sizes[0]
+        dtype=A_data.ctype,
+        IndType=A_indices.ctype,
+        inc=inc,
+        n_rows=n_rows,
+        ragged=ragged,
     )
 
     # --- make the program
@@ -1637,7 +2041,9 @@ def spmv_csr_impl(queue, A_indices, A_indptr, A_data, X, Y, inc=False, tag=None)
         Y.cl_starts.data,
         Y.cl_buf.data,
     )
-    _fn = cl.Program(queue.context, text).build().sparsedot_inc
+    if ragged:
+        full_args += (A_rowmats.base_data, A_rowstarts.base_data)
+    _fn = build_program(queue.context, text).sparsedot_inc
     _fn.set_args(*full_args)
 
     plan = Plan(queue, _fn, gsize, lsize=lsize, name="cl_sparsedot", tag=tag)
@@ -1646,7 +2052,17 @@ def spmv_csr_impl(queue, A_indices, A_indptr, A_data, X, Y, inc=False, tag=None)
     return plan
 
 
-def spmv_ellpack_impl(queue, A_columns, A_entries, X, Y, inc=False, tag=None):
+def spmv_ellpack_impl(
+    queue,
+    A_columns,
+    A_entries,
+    X,
+    Y,
+    inc=False,
+    tag=None,
+    A_rowmats=None,
+    A_rowstarts=None,
+):
     """SPMV kernel with the ELLPACK format.
 
     Parameters
@@ -1655,10 +2071,13 @@ def spmv_ellpack_impl(queue, A_columns, A_entries, X, Y, inc=False, tag=None):
         ELLPACK format of specifying nonzero connection indices
     A_entries : PyOpenCL array
         Matrix values at those indices
-    X, Y : CLRaggedArrays of length 1
-        Input/output data.
+    X, Y : CLRaggedArrays
+        Input/output data, with one array per matrix.
     inc : bool
         Whether to increment ``Y`` (True), or set it (False).
+    A_rowmats, A_rowstarts : PyOpenCL array, optional
+        For several (concatenated) matrices, the matrix of each row and the first
+        row of each matrix. If not given, there is one matrix.
 
     Returns
     -------
@@ -1673,13 +2092,22 @@ def spmv_ellpack_impl(queue, A_columns, A_entries, X, Y, inc=False, tag=None):
         __global const int *Xstarts,
         __global const ${dtype} *Xdata,
         __global const int *Ystarts,
-        __global ${dtype} *Ydata
+        __global ${dtype} *Ydata${", " if ragged else ""}
+    %if ragged:
+        __global const int *A_rowmats,
+        __global const int *A_rowstarts
+    %endif
     )
     {
-        // n can later be used to keep track of multiple arrays
-        const int n = 0;
-        const int irow = get_group_id(0);
+        const int i = get_group_id(0);  // row in all matrices
         const int iellcol = get_local_id(1);
+    %if ragged:
+        const int n = A_rowmats[i];
+        const int irow = i - A_rowstarts[n];
+    %else:
+        const int n = 0;
+        const int irow = i;
+    %endif
 
         __global const ${dtype} *x = Xdata + Xstarts[n];
         __global ${dtype} *y = Ydata + Ystarts[n];
@@ -1688,8 +2116,8 @@ def spmv_ellpack_impl(queue, A_columns, A_entries, X, Y, inc=False, tag=None):
 
         // Load into individual products, doing multiplication along the way
         if (iellcol < ${ellwidth}) {
-            const ${dtype} weight = A_entries[irow * ${ellwidth} + iellcol];
-            const ${IndType} jdatacol = A_columns[irow * ${ellwidth} + iellcol];
+            const ${dtype} weight = A_entries[i * ${ellwidth} + iellcol];
+            const ${IndType} jdatacol = A_columns[i * ${ellwidth} + iellcol];
             products[iellcol] =  weight * x[jdatacol];
         } else {
             products[iellcol] = 0;
@@ -1730,12 +2158,14 @@ def spmv_ellpack_impl(queue, A_columns, A_entries, X, Y, inc=False, tag=None):
         )
 
     # --- make the program
+    ragged = A_rowmats is not None
     textconf = dict(
         dtype=A_entries.ctype,
         IndType=A_columns.ctype,
         inc=inc,
         ellwidth=A_ellwidth,
         wg_size=wg_size,
+        ragged=ragged,
     )
     text = as_ascii(Template(kern, output_encoding="ascii").render(**textconf))
     full_args = (
@@ -1746,7 +2176,9 @@ def spmv_ellpack_impl(queue, A_columns, A_entries, X, Y, inc=False, tag=None):
         Y.cl_starts.data,
         Y.cl_buf.data,
     )
-    _fn = cl.Program(queue.context, text).build().ellpack_inc
+    if ragged:
+        full_args += (A_rowmats.base_data, A_rowstarts.base_data)
+    _fn = build_program(queue.context, text).ellpack_inc
     _fn.set_args(*full_args)
 
     plan = Plan(queue, _fn, gsize, lsize=lsize, name="cl_ellpack", tag=tag)
@@ -1887,7 +2319,7 @@ def spmv_ellpacktwostep_impl(queue, A_columns, A_entries, X, Y, inc=False, tag=N
     )
     full_args_gblreduce = (Y.cl_starts.data, Y.cl_buf.data, accumulator.data)
 
-    clprog = cl.Program(queue.context, text).build()
+    clprog = build_program(queue.context, text)
     _fn1_lcl = clprog.ellpack_lclreduce
     _fn1_lcl.set_args(*full_args_lclreduct)
     _fn2_gbl = clprog.ellpack_gblreduce
@@ -1920,14 +2352,17 @@ def plan_sparse_dot_inc(queue, hA, X, Y, inc=False, tag=None, algorithm=None):
     """Determines which planner to use for sparse matrix-vector multiplication.
 
     First, checks the "NENGO_OCL_SPMV_ALGORITHM" environment variable. If it is unset,
-    uses `spmv_algorithm_heuristic` to determine the algorithm.
+    uses the algorithm measured fastest for matrices with the same structure, if it
+    is in the tuning database (see `spmv_measured_prog`), and otherwise uses
+    `spmv_algorithm_heuristic` to determine the algorithm. If it is "auto", the
+    algorithms are measured for matrices not in the tuning database.
 
     For full parameter details, see ``spmv_prog.__init__``
 
     Parameters
     ----------
     algorithm : str
-        String argument converted to a planner via algostr_to_planner
+        String argument converted to a planner via algostr_to_planner, or "auto"
 
     Returns
     -------
@@ -1940,12 +2375,184 @@ def plan_sparse_dot_inc(queue, hA, X, Y, inc=False, tag=None, algorithm=None):
         # Get from an environment variable
         algorithm = os.environ.get("NENGO_OCL_SPMV_ALGORITHM", None)
 
-    if algorithm is None:
+    if algorithm is None or algorithm == "auto":
+        # Get the fastest measured for this structure
+        prog = spmv_measured_prog(
+            queue,
+            hA,
+            X,
+            Y,
+            inc=inc,
+            tag=tag,
+            measure=True if algorithm == "auto" else None,
+        )
+        if prog is not None:
+            return prog
+
         # Get from CSR vs. ELLPACK heuristic.
         algorithm = spmv_algorithm_heuristic(queue, hA)
 
     planner_type = algostr_to_planner[algorithm]
-    return planner_type(queue, hA, X, Y, inc=False, tag=None)
+    return planner_type(queue, hA, X, Y, inc=inc, tag=tag)
+
+
+def plan_ragged_sparse_dot_inc(queue, hAs, X, Y, inc=False, tag=None, algorithm=None):
+    """Plans for the sparse matrix-vector multiplications ``Y[i] += hAs[i] * X[i]``.
+
+    The algorithm for each matrix is chosen as in `plan_sparse_dot_inc` (see
+    `spmv_algorithm`). Matrices using the same algorithm are then combined into
+    ragged programs (see `spmv_prog`), so that many small matrices use one kernel:
+    all CSR matrices are combined, and ELLPACK matrices are combined with others
+    whose maximum row lengths round up to the same power of two (so that rows are
+    padded to at most twice their length). ELLPACK matrices with rows longer than
+    a work group need the two-step reduction, and are planned individually.
+
+    Parameters
+    ----------
+    hAs : list of HostSparseMatrix
+        Matrices to multiply.
+    X, Y : CLRaggedArrays
+        Input/output data, with one array per matrix.
+
+    For other parameters, see `plan_sparse_dot_inc`.
+
+    Returns
+    -------
+    list of spmv_prog
+        Initialized spmv_prog objects from which to get plans
+    """
+    assert len(hAs) == len(X) == len(Y)
+    max_wg_size = queue.device.max_work_group_size
+
+    groups = defaultdict(list)
+    for i, hA in enumerate(hAs):
+        algo = spmv_algorithm(queue, hA, X[[i]], Y[[i]], algorithm=algorithm)
+        ellwidth = np.diff(hA.csr.indptr).max(initial=0)
+        if algo == "CSR":
+            key = (algo,)
+        elif algo in ("ELLPACK", "ELLPACK-tree") and ellwidth <= max_wg_size:
+            key = ("ELLPACK-tree", round_up_power_of_2(max(ellwidth, 1)))
+        else:
+            key = (algo, i)  # two-step reductions are not combined
+        groups[key].append(i)
+
+    progs = []
+    for key, idxs in groups.items():
+        planner_type = algostr_to_planner[key[0]]
+        if len(idxs) == 1:
+            (i,) = idxs
+            progs.append(planner_type(queue, hAs[i], X[[i]], Y[[i]], inc=inc, tag=tag))
+        else:
+            hA = [hAs[i] for i in idxs]
+            progs.append(planner_type(queue, hA, X[idxs], Y[idxs], inc=inc, tag=tag))
+    return progs
+
+
+def spmv_algorithm(queue, hA, X, Y, algorithm=None):
+    """Name of the algorithm to use for ``hA``, chosen as in `plan_sparse_dot_inc`.
+
+    Unlike `plan_sparse_dot_inc`, the program is not built (except to measure the
+    algorithms, if ``algorithm`` is "auto").
+    """
+    if algorithm is None:
+        algorithm = os.environ.get("NENGO_OCL_SPMV_ALGORITHM", None)
+
+    if algorithm is None or algorithm == "auto":
+        measured = spmv_measured_algorithm(
+            queue, hA, X, Y, measure=True if algorithm == "auto" else None
+        )
+        if measured is not None:
+            return measured
+
+        algorithm = spmv_algorithm_heuristic(queue, hA)
+
+    return algorithm
+
+
+def spmv_measured_prog(queue, hA, X, Y, inc=False, tag=None, measure=None):
+    """SPMV program with the algorithm measured fastest for the structure of ``hA``.
+
+    See `spmv_measured_algorithm` for how the algorithm is chosen.
+
+    Returns
+    -------
+    spmv_prog or None
+        An initialized spmv_prog object with the fastest algorithm, or None if it is
+        not known and not measured.
+    """
+    progs = {}
+    algorithm = spmv_measured_algorithm(
+        queue, hA, X, Y, measure=measure, progs=progs, inc=inc, tag=tag
+    )
+    if algorithm is None:
+        return None
+
+    if algorithm not in progs:
+        planner_type = algostr_to_planner[algorithm]
+        progs[algorithm] = planner_type(queue, hA, X, Y, inc=inc, tag=tag)
+    for plan in progs[algorithm].plans:
+        if hasattr(plan, "description"):
+            plan.description += "; algorithm: %s (measured)" % algorithm
+    return progs[algorithm]
+
+
+def spmv_measured_algorithm(queue, hA, X, Y, measure=None, progs=None, **kwargs):
+    """Name of the SPMV algorithm measured fastest for the structure of ``hA``.
+
+    The candidates are CSR and the ELLPACK variants (tree and two-step), where
+    ELLPACK is only a candidate if its memory footprint is within the limits of
+    `spmv_algorithm_heuristic`. The fastest is stored in the tuning database (see
+    `nengo_ocl.autotune`), keyed by the shape of the matrix and the columns of the
+    nonzeros in each row, so that matrices with the same structure use it without
+    measuring.
+
+    Parameters
+    ----------
+    measure : bool
+        Whether to measure the algorithms if the structure is not in the tuning
+        database (defaults to ``nengo_ocl.autotune.autotune_enabled()``).
+    progs : dict, optional
+        Programs built to measure the algorithms are stored here, by algorithm.
+    **kwargs
+        Passed to the programs built to measure the algorithms.
+
+    Returns
+    -------
+    str or None
+        The fastest algorithm, or None if it is not known and not measured.
+    """
+    csr = hA.csr
+    if not csr.has_sorted_indices:
+        csr = csr.sorted_indices()
+
+    candidates = ["CSR"]
+    if spmv_algorithm_heuristic(queue, hA) == "ELLPACK":
+        if np.diff(csr.indptr).max(initial=0) <= queue.device.max_work_group_size:
+            candidates.append("ELLPACK-tree")
+        candidates.append("ELLPACK-twostep")
+
+    progs = {} if progs is None else progs
+
+    def make_plans(algorithm):
+        planner_type = algostr_to_planner[algorithm]
+        progs[algorithm] = planner_type(queue, hA, X, Y, **kwargs)
+        return progs[algorithm].plans
+
+    key = geometry_key(
+        np.array(csr.shape, dtype=np.int64),
+        np.asarray(csr.indptr, dtype=np.int64),
+        np.asarray(csr.indices, dtype=np.int64),
+    )
+    params = autotune(
+        queue,
+        "clra_gemv.spmv",
+        key,
+        [dict(algorithm=algorithm) for algorithm in candidates],
+        make_plans,
+        outputs=[Y.cl_buf],
+        measure=measure,
+    )
+    return None if params is None else params["algorithm"]
 
 
 def spmv_algorithm_heuristic(
@@ -1995,3 +2602,170 @@ algostr_to_planner = {
     "ELLPACK-twostep": plan_ellpack_twostep,
     "CSR": plan_csr,
 }
+
+
+def plan_bsr_dot_inc(
+    queue, A, A_shapes, A_indices, A_indptr, X, Y, inc=False, tag=None
+):
+    """Plan for block sparse row (BSR) matrix-vector multiplications.
+
+    Computes ``Y[i] += A[i] * X[i]`` (or ``Y[i] = A[i] * X[i]`` if not ``inc``)
+    for all matrices in one kernel, where each ``A[i]`` is a BSR matrix (see
+    ``scipy.sparse.bsr_matrix``). Only the nonzero blocks are stored, and each
+    work item computes one row of ``Y`` as the dot products of the rows of the
+    dense blocks in its block row.
+
+    Parameters
+    ----------
+    queue : cl.CommandQueue
+        The queue for this plan.
+    A : CLRaggedArray
+        The nonzero blocks of each matrix, stored contiguously (in C order).
+    A_shapes : list of tuple
+        The shape ``(k, r, c)`` of the blocks of each matrix, where ``k`` is the
+        number of blocks, and each block has ``r`` rows and ``c`` columns.
+    A_indices, A_indptr : list of ndarray
+        The block column indices, and the pointers into them for each block row,
+        for each matrix (as in ``scipy.sparse.bsr_matrix``).
+    X, Y : CLRaggedArrays
+        Input/output data, with one array per matrix. The arrays of ``Y`` must not
+        overlap, since each row is written without atomic operations.
+    inc : bool
+        Whether to increment ``Y`` (True), or set it (False).
+    tag : str
+        Tag for the plan.
+
+    Returns
+    -------
+    Plan
+        Executable Plan object
+    """
+    assert len(A) == len(A_shapes) == len(A_indices) == len(A_indptr)
+    assert len(A) == len(X) == len(Y)
+
+    for arr in [X, Y]:
+        assert (arr.stride1s == 1).all()
+        if not ((arr.shape1s == 1).all() and (arr.stride0s == 1).all()):
+            raise NotImplementedError(
+                "OCL BsrDotInc only supports matrix-vector currently, "
+                "not matrix-matrix."
+            )
+    if not ((A.stride1s == 1).all() and (A.stride0s == A.shape1s).all()):
+        raise NotImplementedError("BSR blocks must be stored contiguously")
+
+    nonempty = np.flatnonzero(Y.sizes > 0)
+    order = nonempty[np.argsort(Y.starts[nonempty], kind="stable")]
+    Y_ends = (Y.starts + Y.sizes)[order]
+    assert (Y.starts[order][1:] >= Y_ends[:-1]).all(), "Y arrays overlap"
+
+    for i, ((k, r, c), indices, indptr) in enumerate(
+        zip(A_shapes, A_indices, A_indptr)
+    ):
+        assert A.sizes[i] == k * r * c
+        assert len(indices) == indptr[-1] == k
+        assert Y.sizes[i] == r * (len(indptr) - 1)
+        assert len(indices) == 0 or 0 <= min(indices) <= max(indices) < X.sizes[i] // c
+
+    kern = """
+    __kernel void bsr_dot_inc(
+        __global const int *A_indices,
+        __global const int *A_indptr,
+        __global const int *A_rowmats,
+        __global const int *A_info,
+        __global const int *Astarts,
+        __global const ${dtype} *Adata,
+        __global const int *Xstarts,
+        __global const ${dtype} *Xdata,
+        __global const int *Ystarts,
+        __global ${dtype} *Ydata
+    )
+    {
+        const int i = get_global_id(0);  // row in all matrices
+        if (i >= ${n_rows}) {
+            return;
+        }
+
+        // first row, first block row pointer, first block, block shape
+        const int n = A_rowmats[i];
+        __global const int *info = A_info + 5 * n;
+        const int irow = i - info[0];
+        const int r = info[3];
+        const int c = info[4];
+        const int ib = irow / r;  // block row
+        const int rr = irow - ib * r;  // row in the block
+
+        __global const int *indptr = A_indptr + info[1];
+        __global const int *indices = A_indices + info[2];
+        __global const ${dtype} *a = Adata + Astarts[n] + rr * c;
+        __global const ${dtype} *x = Xdata + Xstarts[n];
+
+        ${dtype} sum = 0;
+        const int end = indptr[ib + 1];
+        for (int k = indptr[ib]; k < end; k++) {
+            __global const ${dtype} *ak = a + k * r * c;
+            __global const ${dtype} *xk = x + indices[k] * c;
+            for (int j = 0; j < c; j++) {
+                sum += ak[j] * xk[j];
+            }
+        }
+
+    %if inc:
+        Ydata[Ystarts[n] + irow] += sum;
+    %else:
+        Ydata[Ystarts[n] + irow] = sum;
+    %endif
+    }
+    """
+
+    # --- host data: concatenate the structures, and map rows to matrices
+    n_rows = [r * (len(indptr) - 1) for (_, r, _), indptr in zip(A_shapes, A_indptr)]
+    ptrstarts = np.cumsum([0] + [len(indptr) for indptr in A_indptr[:-1]])
+    blockstarts = np.cumsum([0] + [len(indices) for indices in A_indices[:-1]])
+    A_info = np.column_stack(
+        [
+            np.cumsum([0] + n_rows[:-1]),
+            ptrstarts,
+            blockstarts,
+            [r for _, r, _ in A_shapes],
+            [c for _, _, c in A_shapes],
+        ]
+    )
+    A_rowmats = np.repeat(np.arange(len(A), dtype=np.int32), n_rows)
+    cl_indices, cl_indptr, cl_rowmats, cl_info = [
+        # (padded, since buffers cannot be empty)
+        to_device(queue, np.concatenate(list(arrays) + [[0]]).astype(np.int32))
+        for arrays in (A_indices, A_indptr, [A_rowmats], [A_info.ravel()])
+    ]
+
+    # --- make the program
+    textconf = dict(dtype=A.ctype, inc=inc, n_rows=sum(n_rows))
+    text = as_ascii(Template(kern, output_encoding="ascii").render(**textconf))
+    full_args = (
+        cl_indices.data,
+        cl_indptr.data,
+        cl_rowmats.data,
+        cl_info.data,
+        A.cl_starts.data,
+        A.cl_buf.data,
+        X.cl_starts.data,
+        X.cl_buf.data,
+        Y.cl_starts.data,
+        Y.cl_buf.data,
+    )
+    _fn = build_program(queue.context, text).bsr_dot_inc
+    _fn.set_args(*full_args)
+
+    plan = Plan(
+        queue, _fn, (max(sum(n_rows), 1), 1), lsize=None, name="cl_bsr", tag=tag
+    )
+    plan.full_args = full_args  # prevent garbage-collection
+    plan.flops_per_call = 2 * int(A.sizes.sum())
+    plan.bw_per_call = (
+        A.nbytes + X.nbytes + Y.nbytes * (2 if inc else 1) + cl_indices.nbytes
+    )
+    plan.description = "groups: %d; blocks: %d; block shapes: %s" % (
+        len(A),
+        sum(k for k, _, _ in A_shapes),
+        ", ".join(sorted({"(%d, %d)" % (r, c) for _, r, c in A_shapes})),
+    )
+    return plan
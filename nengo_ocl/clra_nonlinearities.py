@@ -11,6 +11,7 @@ from nengo.utils.numpy import is_number
 from nengo_ocl import ast_conversion
 from nengo_ocl.clraggedarray import CLRaggedArray, to_device
 from nengo_ocl.plan import Plan
+from nengo_ocl.program_cache import build_program
 from nengo_ocl.raggedarray import RaggedArray
 from nengo_ocl.utils import as_ascii, indent, nonelist, round_up
 
@@ -134,7 +135,7 @@ def plan_timeupdate(queue, step, time, dt):
 
     text = as_ascii(Template(text, output_encoding="ascii").render(dt=dt))
     full_args = (step.cl_starts, step.cl_buf, time.cl_starts, time.cl_buf)
-    _fn = cl.Program(queue.context, text).build().timeupdate
+    _fn = build_program(queue.context, text).timeupdate
     _fn.set_args(*[arr.data for arr in full_args])
 
     gsize = (1,)
@@ -198,7 +199,7 @@ def plan_reset(queue, Y, values, tag=None):
         clYstarts,
         Y.cl_buf,
     )
-    _fn = cl.Program(queue.context, text).build().reset
+    _fn = build_program(queue.context, text).reset
     _fn.set_args(*[arr.data for arr in full_args])
 
     plan = Plan(queue, _fn, gsize, lsize=lsize, name="cl_reset", tag=tag)
@@ -288,7 +289,7 @@ def plan_copy(queue, X, Y, incs, tag=None):
         full_args.insert(0, to_device(queue, incs[inds].astype(np.int32)))
 
     text = as_ascii(Template(text, output_encoding="ascii").render(**textconf))
-    _fn = cl.Program(queue.context, text).build().copy
+    _fn = build_program(queue.context, text).copy
     _fn.set_args(*[arr.data for arr in full_args])
 
     plan = Plan(queue, _fn, gsize, lsize=lsize, name="cl_copy", tag=tag)
@@ -395,7 +396,7 @@ def plan_slicedcopy(queue, X, Y, Xinds, Yinds, incs, tag=None):
         full_args.insert(0, to_device(queue, incs[inds].astype(np.int32)))
 
     text = as_ascii(Template(text, output_encoding="ascii").render(**textconf))
-    _fn = cl.Program(queue.context, text).build().slicedcopy
+    _fn = build_program(queue.context, text).slicedcopy
     _fn.set_args(*[arr.data for arr in full_args])
 
     plan = Plan(queue, _fn, gsize, lsize=lsize, name="cl_slicedcopy", tag=tag)
@@ -554,7 +555,7 @@ def plan_elementwise_inc(queue, A, X, Y, alpha=None, outer=False, inc=True, tag=
         to_device(queue, Y.starts[inds]),
         Y.cl_buf,
     ]
-    _fn = cl.Program(queue.context, text).build().elementwise_inc
+    _fn = build_program(queue.context, text).elementwise_inc
     _fn.set_args(*[arr.data for arr in full_args])
 
     gsize = (lsize0, len(sizes))
@@ -574,6 +575,184 @@ def plan_elementwise_inc(queue, A, X, Y, alpha=None, outer=False, inc=True, tag=
     return plan
 
 
+def plan_fused_elementwise(
+    queue, data, Yinds, Tstarts, Ainds, Xinds, alphas, incs, tag=None
+):
+    """Implements chains of element-wise operations on views of ``data``
+
+    Chain ``k`` applies the terms ``t`` in ``range(Tstarts[k], Tstarts[k + 1])``
+    in order to ``Y = data[Yinds[k]]``::
+
+        Y = (Y if incs[t] else 0) + alphas[t] * data[Ainds[t]] * data[Xinds[t]]
+
+    where the operands are broadcast against ``Y``. Each element of ``Y`` is only
+    read and written once, no matter how many terms there are. Operands must not
+    overlap any destination.
+
+    Parameters
+    ----------
+    data : CLRaggedArray
+        Array containing all destinations and operands.
+    Yinds : np.ndarray
+        Index into ``data`` of the destination of each chain.
+    Tstarts : np.ndarray
+        Index of the first term of each chain (with one extra entry at the end).
+    Ainds, Xinds : np.ndarray
+        Index into ``data`` of the operands of each term, or -1 for the constant 1.
+    alphas : np.ndarray
+        Scalar for each term.
+    incs : np.ndarray
+        Whether each term increments ``Y`` (1), or sets it (0).
+    """
+    Yinds, Ainds, Xinds = (
+        np.asarray(inds, dtype=np.int32) for inds in (Yinds, Ainds, Xinds)
+    )
+    Tstarts = np.asarray(Tstarts, dtype=np.int32)
+    alphas = np.asarray(alphas, dtype=data.dtype)
+    incs = np.asarray(incs, dtype=np.int32)
+
+    n_terms = len(alphas)
+    assert len(Tstarts) == len(Yinds) + 1
+    assert Tstarts[0] == 0 and Tstarts[-1] == n_terms
+    assert (np.diff(Tstarts) > 0).all()
+    assert len(Ainds) == len(Xinds) == len(incs) == n_terms
+    used = np.concatenate([Yinds, Ainds[Ainds >= 0], Xinds[Xinds >= 0]])
+    assert (data.stride1s[used] == 1).all()
+
+    Y = data[Yinds]
+    Tchains = np.repeat(np.arange(len(Y)), np.diff(Tstarts))
+    for inds in (Ainds, Xinds):
+        has = inds >= 0
+        assert (
+            (data.shape0s[inds[has]] == 1)
+            | (data.shape0s[inds[has]] == Y.shape0s[Tchains[has]])
+        ).all()
+        assert (
+            (data.shape1s[inds[has]] == 1)
+            | (data.shape1s[inds[has]] == Y.shape1s[Tchains[has]])
+        ).all()
+
+    text = """
+        inline ${Ytype} get_element(
+            __global const ${Ytype} *data,
+            const int shape0, const int shape1, const int stride0,
+            const int i, const int j
+        )
+        {
+            if (shape0 == 0)
+                return 1;  // no operand
+            else if (shape0 == 1 && shape1 == 1)
+                return data[0];
+            else if (shape0 == 1)
+                return data[j];
+            else if (shape1 == 1)
+                return data[i * stride0];
+            else
+                return data[i * stride0 + j];
+        }
+
+        ////////// MAIN FUNCTION //////////
+        __kernel void fused_elementwise(
+            __global const int *offsets,
+            __global const int *Yshape0s,
+            __global const int *Yshape1s,
+            __global const int *Ystride0s,
+            __global const int *Ystarts,
+            __global const int *Tstarts,
+            __global const int *Tends,
+            __global const ${Ytype} *alphas,
+            __global const int *incs,
+            __global const int *Ashape0s,
+            __global const int *Ashape1s,
+            __global const int *Astride0s,
+            __global const int *Astarts,
+            __global const int *Xshape0s,
+            __global const int *Xshape1s,
+            __global const int *Xstride0s,
+            __global const int *Xstarts,
+            __global ${Ytype} *data
+        )
+        {
+            const int n = get_global_id(1);
+            const int ij = get_global_id(0) + offsets[n];
+
+            const int Yshape1 = Yshape1s[n];
+            const int i = ij / Yshape1;
+            const int j = ij % Yshape1;
+            if (i >= Yshape0s[n])
+                return;
+
+            __global ${Ytype} *y = data + Ystarts[n] + i*Ystride0s[n] + j;
+            const int t0 = Tstarts[n];
+            const int t1 = Tends[n];
+
+            ${Ytype} yy = incs[t0] ? *y : 0;
+            for (int t = t0; t < t1; t++) {
+                const ${Ytype} aa = get_element(
+                    data + Astarts[t], Ashape0s[t], Ashape1s[t], Astride0s[t], i, j);
+                const ${Ytype} xx = get_element(
+                    data + Xstarts[t], Xshape0s[t], Xshape1s[t], Xstride0s[t], i, j);
+                const ${Ytype} axx = alphas[t] * aa * xx;
+                yy = incs[t] ? yy + axx : axx;
+            }
+            *y = yy;
+        }
+        """
+
+    # --- blockify
+    lsize0 = get_mwgs(queue, cap=256)
+    sizes, inds, offsets = blockify_ij(lsize0, Y)
+
+    textconf = dict(Ytype=data.ctype)
+    text = as_ascii(Template(text, output_encoding="ascii").render(**textconf))
+
+    def operand_args(inds):
+        has = inds >= 0
+        shape0s = np.where(has, data.shape0s[inds], 0)  # shape 0 marks no operand
+        return [
+            to_device(queue, shape0s.astype(np.int32)),
+            to_device(queue, np.where(has, data.shape1s[inds], 0).astype(np.int32)),
+            to_device(queue, np.where(has, data.stride0s[inds], 0).astype(np.int32)),
+            to_device(queue, np.where(has, data.starts[inds], 0).astype(np.int32)),
+        ]
+
+    full_args = (
+        [
+            to_device(queue, offsets),
+            to_device(queue, Y.shape0s[inds]),
+            to_device(queue, Y.shape1s[inds]),
+            to_device(queue, Y.stride0s[inds]),
+            to_device(queue, Y.starts[inds]),
+            to_device(queue, Tstarts[:-1][inds]),
+            to_device(queue, Tstarts[1:][inds]),
+            to_device(queue, alphas),
+            to_device(queue, incs),
+        ]
+        + operand_args(Ainds)
+        + operand_args(Xinds)
+        + [data.cl_buf]
+    )
+    _fn = build_program(queue.context, text).fused_elementwise
+    _fn.set_args(*[arr.data for arr in full_args])
+
+    gsize = (lsize0, len(sizes))
+    plan = Plan(queue, _fn, gsize, lsize=None, name="cl_fused_elementwise", tag=tag)
+    plan.full_args = tuple(full_args)  # prevent garbage-collection
+    n_operands = (Ainds >= 0).astype(int) + (Xinds >= 0)
+    term_sizes = Y.sizes[Tchains]
+    plan.flops_per_call = 2 * term_sizes.sum()
+    plan.bw_per_call = data.dtype.itemsize * (
+        2 * Y.sizes.sum() + (n_operands * term_sizes).sum()
+    )
+    plan.description = "chains: %d; terms: %d; items: %d; terms/chain: %0.1f" % (
+        len(Y),
+        n_terms,
+        Y.sizes.sum(),
+        n_terms / len(Y),
+    )
+    return plan
+
+
 def plan_linearfilter(queue, X, Y, A, B, Xbuf, Ybuf, tag=None):
     """
     Implements a filter of the form
@@ -767,7 +946,7 @@ def plan_linearfilter(queue, X, Y, A, B, Xbuf, Ybuf, tag=None):
     #     options=['-cl-nv-maxrregcount=55', '-cl-nv-verbose'])
     # print(program.get_build_info(queue.device, cl.program_build_info.LOG))
 
-    program = cl.Program(queue.context, text).build()
+    program = build_program(queue.context, text)
     _fn = program.linearfilter
     _fn.set_args(*[arr.data for arr in full_args])
 
@@ -775,6 +954,8 @@ def plan_linearfilter(queue, X, Y, A, B, Xbuf, Ybuf, tag=None):
     gsize = (lsize0, n)
     plan = Plan(queue, _fn, gsize, lsize=lsize, name="cl_linearfilter", tag=tag)
     plan.full_args = full_args  # prevent garbage-collection
+    plan.Xbufpos = Xbufpos
+    plan.Ybufpos = Ybufpos
     plan.bw_per_call = (
         X.nbytes + Y.nbytes + A.nbytes + B.nbytes + Xbuf.nbytes + Ybuf.nbytes
     )
@@ -809,7 +990,16 @@ def plan_probes(queue, periods, X, Y, tag=None):
     ----------
     P : raggedarray of ints
         The period (in time-steps) of each probe
+    Y : CLRaggedArray or list of CLRaggedArray
+        Buffers to write probed values into. If a list is given, each element is
+        a separate "bank" with its own buffer positions, and ``plan.set_bank(i)``
+        selects the bank written by subsequent calls. This allows the host to read
+        one bank while the device fills another.
     """
+    Ys = list(Y) if isinstance(Y, (list, tuple)) else [Y]
+    Y = Ys[0]
+    assert all(len(Yi) == len(Y) for Yi in Ys)
+    assert all((Yi.shape0s == Y.shape0s).all() for Yi in Ys)
     assert len(X) == len(Y)
     assert len(X) == len(periods)
     assert X.ctype == Y.ctype
@@ -826,7 +1016,7 @@ def plan_probes(queue, periods, X, Y, tag=None):
     periods = np.asarray(periods, dtype="float32")
     cl_periods = to_device(queue, periods)
     cl_countdowns = to_device(queue, periods - 1)
-    cl_bufpositions = to_device(queue, np.zeros(N, dtype="int32"))
+    cl_bufpositions = [to_device(queue, np.zeros(N, dtype="int32")) for _ in Ys]
 
     text = """
         ////////// MAIN FUNCTION //////////
@@ -912,21 +1102,25 @@ def plan_probes(queue, periods, X, Y, tag=None):
     )
     text = as_ascii(Template(text, output_encoding="ascii").render(**textconf))
 
-    full_args = (
-        cl_countdowns,
-        cl_bufpositions,
-        cl_periods,
-        X.cl_starts,
-        X.cl_shape0s,
-        X.cl_shape1s,
-        X.cl_stride0s,
-        X.cl_stride1s,
-        X.cl_buf,
-        Y.cl_starts,
-        Y.cl_buf,
-    )
-    _fn = cl.Program(queue.context, text).build().probes
-    _fn.set_args(*[arr.data for arr in full_args])
+    program = build_program(queue.context, text)
+    banks = []
+    for Yi, cl_bufpositions_i in zip(Ys, cl_bufpositions):
+        full_args = (
+            cl_countdowns,
+            cl_bufpositions_i,
+            cl_periods,
+            X.cl_starts,
+            X.cl_shape0s,
+            X.cl_shape1s,
+            X.cl_stride0s,
+            X.cl_stride1s,
+            X.cl_buf,
+            Yi.cl_starts,
+            Yi.cl_buf,
+        )
+        _fn = program.probes  # each access creates a new kernel object
+        _fn.set_args(*[arr.data for arr in full_args])
+        banks.append((_fn, cl_bufpositions_i, Yi, full_args))
 
     max_len = min(max(X.shape0s), get_mwgs(queue))
     gsize = (
@@ -934,12 +1128,22 @@ def plan_probes(queue, periods, X, Y, tag=None):
         N,
     )
     lsize = (max_len, 1)
-    plan = Plan(queue, _fn, gsize, lsize=lsize, name="cl_probes", tag=tag)
-    plan.full_args = full_args  # prevent garbage-collection
-    plan.cl_bufpositions = cl_bufpositions
-    plan.Y = Y
+    plan = Plan(queue, banks[0][0], gsize, lsize=lsize, name="cl_probes", tag=tag)
+    plan.banks = banks  # also prevents garbage-collection of the arguments
+    plan.cl_countdowns = cl_countdowns
+    plan.cl_periods = cl_periods
+
+    def set_bank(i):
+        plan.bank = i
+        plan.kern, plan.cl_bufpositions, plan.Y, plan.full_args = banks[i]
+
+    plan.set_bank = set_bank
+    plan.set_bank(0)
     plan.bw_per_call = (
-        2 * X.nbytes + cl_periods.nbytes + cl_countdowns.nbytes + cl_bufpositions.nbytes
+        2 * X.nbytes
+        + cl_periods.nbytes
+        + cl_countdowns.nbytes
+        + cl_bufpositions[0].nbytes
     )
     plan.description = "groups: %d; items: %d; items/group: %0.1f [%d, %d]" % (
         len(X),
@@ -1009,7 +1213,7 @@ ${code}
     for x in inputs:
         full_args.extend([x.cl_starts, x.cl_buf])
     full_args.extend([output.cl_starts, output.cl_buf])
-    _fn = cl.Program(queue.context, text).build().direct
+    _fn = build_program(queue.context, text).direct
     _fn.set_args(*[arr.data for arr in full_args])
 
     gsize = (N,)
@@ -1466,7 +1670,7 @@ def _plan_template(  # noqa: C901
 
     textconf["N"] = gsize[1]
     text = as_ascii(Template(text, output_encoding="ascii").render(**textconf))
-    fns = cl.Program(queue.context, text).build()
+    fns = build_program(queue.context, text)
     _fn = getattr(fns, fn_name)
     _fn.set_args(*[arr.data for arr in full_args])
 
@@ -1492,38 +1696,34 @@ def create_rngs(queue, n):
     return rngs
 
 
-_init_rng_kernel = None
-
-
 def init_rngs(queue, rngs, seeds):
     assert len(seeds) == len(rngs)
     assert np.all(rngs.shape0s == rngs.shape0s[0])
     assert np.all(rngs.shape1s == 28)
 
-    global _init_rng_kernel  # pylint: disable=global-statement
-    if _init_rng_kernel is None:
-        text = """
-            #define RANLUXCL_LUX 2  // do not need highest quality
-            #include "pyopencl-ranluxcl.cl"
-
-            ////////// MAIN FUNCTION //////////
-            __kernel void init_rng(
-                __global const uint *seeds,
-                __global const int *rng_starts,
-                __global int *rng_data
-            )
-            {
-                const int i = get_global_id(0);
-                const int k = get_global_id(1);
+    text = """
+        #define RANLUXCL_LUX 2  // do not need highest quality
+        #include "pyopencl-ranluxcl.cl"
 
-                // scale seed by 2**32 (see pyopencl-ranluxcl.cl)
-                ulong x = (ulong)i + (ulong)seeds[k] * ((ulong)UINT_MAX + 1);
-                __global ranluxcl_state_t *rng = rng_data + rng_starts[k];
-                ranluxcl_init(x, rng + i);
-            }
-            """
-        text = as_ascii(Template(text, output_encoding="ascii").render())
-        _init_rng_kernel = cl.Program(queue.context, text).build().init_rng
+        ////////// MAIN FUNCTION //////////
+        __kernel void init_rng(
+            __global const uint *seeds,
+            __global const int *rng_starts,
+            __global int *rng_data
+        )
+        {
+            const int i = get_global_id(0);
+            const int k = get_global_id(1);
+
+            // scale seed by 2**32 (see pyopencl-ranluxcl.cl)
+            ulong x = (ulong)i + (ulong)seeds[k] * ((ulong)UINT_MAX + 1);
+            __global ranluxcl_state_t *rng = rng_data + rng_starts[k];
+            ranluxcl_init(x, rng + i);
+        }
+        """
+    text = as_ascii(Template(text, output_encoding="ascii").render())
+    # the program cache makes this cheap after the first build for each context
+    init_rng_kernel = build_program(queue.context, text).init_rng
 
     cl_seeds = to_device(queue, np.array(seeds, dtype=np.uint32))
     args = (cl_seeds, rngs.cl_starts, rngs.cl_buf)
@@ -1531,7 +1731,7 @@ def init_rngs(queue, rngs, seeds):
     rng_items = rngs.shape0s[0]
     gsize = (int(rng_items), len(rngs))
     lsize = None
-    e = _init_rng_kernel(queue, gsize, lsize, *[arr.data for arr in args])
+    e = init_rng_kernel(queue, gsize, lsize, *[arr.data for arr in args])
     e.wait()
 
 
@@ -1664,7 +1864,7 @@ def plan_whitenoise(queue, Y, dist_enums, dist_params, scale, inc, dt, rngs, tag
         rngs.cl_starts,
         rngs.cl_buf,
     )
-    _fn = cl.Program(queue.context, text).build().whitenoise
+    _fn = build_program(queue.context, text).whitenoise
     _fn.set_args(*[arr.data for arr in full_args])
 
     max_len = min(min(rngs.shape0s), max(Y.shape0s))
@@ -1748,7 +1948,7 @@ def plan_presentinput(queue, Y, t, signals, dt, pres_t=None, tag=None):
         signals.cl_starts,
         signals.cl_buf,
     )
-    _fn = cl.Program(queue.context, text).build().presentinput
+    _fn = build_program(queue.context, text).presentinput
     _fn.set_args(*[arr.data for arr in full_args])
 
     max_len = min(max(Y.shape0s), get_mwgs(queue))
@@ -1951,7 +2151,7 @@ def plan_conv2d(
         + ([] if biases is None else [biases.base_data])
         + [Y.base_data]
     )
-    _fn = cl.Program(queue.context, text).build().conv2d
+    _fn = build_program(queue.context, text).conv2d
     _fn.set_args(*full_args)
 
     plan = Plan(queue, _fn, gsize, lsize=lsize, name="cl_conv2d", tag=tag)
@@ -2069,7 +2269,7 @@ def plan_pool2d(queue, X, Y, shape, pool_size, strides, tag=None):
     text = as_ascii(Template(text, output_encoding="ascii").render(**textconf))
 
     full_args = (X.base_data, Y.base_data)
-    _fn = cl.Program(queue.context, text).build().pool2d
+    _fn = build_program(queue.context, text).pool2d
     _fn.set_args(*full_args)
 
     plan = Plan(queue, _fn, gsize, lsize=lsize, name="cl_pool2d", tag=tag)
@@ -2155,7 +2355,7 @@ def plan_bcm(queue, pre, post, theta, delta, alpha, tag=None):
         delta.cl_buf,
         alpha,
     )
-    _fn = cl.Program(queue.context, text).build().bcm
+    _fn = build_program(queue.context, text).bcm
     _fn.set_args(*[arr.data for arr in full_args])
 
     lsize = None
@@ -2258,7 +2458,7 @@ def plan_oja(queue, pre, post, weights, delta, alpha, beta, tag=None):
         alpha,
         beta,
     )
-    _fn = cl.Program(queue.context, text).build().oja
+    _fn = build_program(queue.context, text).oja
     _fn.set_args(*[arr.data for arr in full_args])
 
     lsize = None
@@ -2385,7 +2585,7 @@ def plan_voja(queue, pre, post, enc, delta, learn, scale, alpha, tag=None):
         scale.cl_buf,
         alpha,
     )
-    _fn = cl.Program(queue.context, text).build().voja
+    _fn = build_program(queue.context, text).voja
     _fn.set_args(*[arr.data for arr in full_args])
 
     lsize = None
@@ -39,27 +39,41 @@ def to_host(queue, data, dtype, start, shape, elemstrides, is_blocking=True):
     If the requested array is discontiguous, the whole block is copied off
     the device, and a view is created to show the appropriate part.
     """
+    array, _ = _to_host(queue, data, dtype, start, shape, elemstrides, is_blocking)
+    return array
+
+
+def _to_host(
+    queue, data, dtype, start, shape, elemstrides, is_blocking=True, wait_for=None
+):
+    """Like `.to_host`, but also returns the event of the copy (or ``None``)."""
     if min(elemstrides) < 0:
         raise NotImplementedError()
 
     m, n = shape
     sm, sn = elemstrides
     if m * n == 0:
-        return np.zeros(shape, dtype=dtype)
+        return np.zeros(shape, dtype=dtype), None
 
     itemsize = dtype.itemsize
     bytestart = itemsize * start
     bytelen = itemsize * ((m - 1) * sm + (n - 1) * sn + 1)
 
     temp_buf = np.zeros(bytelen, dtype=np.int8)
-    cl.enqueue_copy(
-        queue, temp_buf, data, device_offset=bytestart, is_blocking=is_blocking
+    event = cl.enqueue_copy(
+        queue,
+        temp_buf,
+        data,
+        device_offset=bytestart,
+        wait_for=wait_for,
+        is_blocking=is_blocking,
     )
 
     bytestrides = (itemsize * sm, itemsize * sn)
-    return np.ndarray(
+    array = np.ndarray(
         shape=(m, n), dtype=dtype, buffer=temp_buf.data, offset=0, strides=bytestrides
     )
+    return array, event
 
 
 class CLRaggedArray:
@@ -216,17 +230,35 @@ class CLRaggedArray:
         if is_iterable(item):
             return self.getitem_device(item)
         else:
-            buf = to_host(
-                self.queue,
-                self.cl_buf.data,
-                self.dtype,
-                self.starts[item],
-                (self.shape0s[item], self.shape1s[item]),
-                (self.stride0s[item], self.stride1s[item]),
-            )
-            buf.setflags(write=False)
+            buf, _ = self.getitem_host(item)
             return buf
 
+    def getitem_host(self, item, queue=None, wait_for=None, is_blocking=True):
+        """Copy one item to the host.
+
+        The copy is done on ``queue`` (defaults to ``self.queue``), after the
+        events ``wait_for``. Returns the (read-only) host array and the event of
+        the copy. If ``is_blocking`` is False, the array is only filled once the
+        event is complete.
+        """
+        buf, event = _to_host(
+            self.queue if queue is None else queue,
+            self.cl_buf.data,
+            self.dtype,
+            self.starts[item],
+            (self.shape0s[item], self.shape1s[item]),
+            (self.stride0s[item], self.stride1s[item]),
+            is_blocking=is_blocking,
+            wait_for=wait_for,
+        )
+        buf.setflags(write=False)
+        return buf, event
+
+    def is_contiguous(self, item):
+        """Whether the elements of one item are contiguous in memory."""
+        m, n = self.shape0s[item], self.shape1s[item]
+        return (self.stride0s[item], self.stride1s[item]) in [(1, m), (n, 1)]
+
     def getitem_device(self, item):
         if isinstance(item, slice):
             item = np.arange(len(self))[item]
@@ -253,50 +285,182 @@ class CLRaggedArray:
                 offset=self.starts[item] * s,
             )
 
+    def get_sub_region(self, start, stop, queue=None):
+        """A ragged array using only elements ``start:stop`` of the buffer.
+
+        The returned array has the same items, but stores them in a sub-buffer of
+        ``self.cl_buf``, so that several devices can write to separate regions of
+        one buffer concurrently. Only items that lie within the region can be used.
+        ``start`` must be a multiple of the ``mem_base_addr_align`` of the device.
+        """
+        queue = self.queue if queue is None else queue
+        itemsize = self.dtype.itemsize
+        cl_buf = Array(
+            queue,
+            (stop - start,),
+            self.dtype,
+            data=self.cl_buf.base_data.get_sub_region(
+                self.cl_buf.offset + start * itemsize, (stop - start) * itemsize
+            ),
+        )
+        return CLRaggedArray.from_buffer(
+            queue,
+            cl_buf,
+            self.starts - start,
+            self.shape0s,
+            self.shape1s,
+            self.stride0s,
+            self.stride1s,
+            names=self.names,
+        )
+
     def __setitem__(self, item, new_value):
         if isinstance(item, slice) or is_iterable(item):
             raise NotImplementedError("TODO")
         else:
-            m, n = self.shape0s[item], self.shape1s[item]
-            sm, sn = self.stride0s[item], self.stride1s[item]
+            self.setitem_host(item, new_value)
+
+    def setitem_host(
+        self, item, new_value, queue=None, wait_for=None, is_blocking=True
+    ):
+        """Copy ``new_value`` from the host into one item.
+
+        The copy is done on ``queue`` (defaults to ``self.queue``), after the
+        events ``wait_for``. Returns the event of the copy. If ``is_blocking`` is
+        False and ``new_value`` is a C-contiguous array with the shape and dtype of
+        the item, it is copied directly, so it can still be filled until the
+        ``wait_for`` events are complete.
 
-            if (sm, sn) in [(1, m), (n, 1)]:
-                # contiguous
-                clarray = self.getitem_device(item)
-                if isinstance(new_value, np.ndarray):
-                    array = np.asarray(new_value, order="C", dtype=self.dtype)
-                else:
-                    array = np.zeros(clarray.shape, dtype=clarray.dtype)
-                    array[...] = new_value
-
-                array.shape = clarray.shape  # reshape to avoid warning
-                assert equal_strides(array.strides, clarray.strides, clarray.shape)
-                clarray.set(array)
+        Discontiguous items are always copied synchronously (reading the
+        surrounding block first), so they do not support ``wait_for``, and
+        ``is_blocking`` has no effect; for these, returns ``None``.
+        """
+        queue = self.queue if queue is None else queue
+        m, n = self.shape0s[item], self.shape1s[item]
+
+        if self.is_contiguous(item):
+            # contiguous
+            clarray = self.getitem_device(item)
+            if isinstance(new_value, np.ndarray):
+                array = np.asarray(new_value, order="C", dtype=self.dtype)
             else:
-                # discontiguous
-                #   Copy a contiguous region off the device that surrounds the
-                #   discontiguous, set the appropriate values, and copy back
-                s = self.starts[item]
-                array = to_host(
-                    self.queue,
-                    self.cl_buf.data,
-                    self.dtype,
-                    s,
-                    (m, n),
-                    (sm, sn),
-                    is_blocking=True,
-                )
+                array = np.zeros(clarray.shape, dtype=clarray.dtype)
                 array[...] = new_value
 
-                buf = array.base if array.base is not None else array
-                bytestart = self.dtype.itemsize * s
-                cl.enqueue_copy(
-                    self.queue,
-                    self.cl_buf.data,
-                    buf,
-                    device_offset=bytestart,
-                    is_blocking=True,
-                )
+            array.shape = clarray.shape  # reshape to avoid warning
+            assert equal_strides(array.strides, clarray.strides, clarray.shape)
+            return cl.enqueue_copy(
+                queue,
+                clarray.base_data,
+                array,
+                dst_offset=clarray.offset,
+                wait_for=wait_for,
+                is_blocking=is_blocking,
+            )
+        else:
+            assert wait_for is None
+            # discontiguous
+            #   Copy a contiguous region off the device that surrounds the
+            #   discontiguous, set the appropriate values, and copy back
+            s = self.starts[item]
+            sm, sn = self.stride0s[item], self.stride1s[item]
+            array = to_host(
+                queue,
+                self.cl_buf.data,
+                self.dtype,
+                s,
+                (m, n),
+                (sm, sn),
+                is_blocking=True,
+            )
+            array[...] = new_value
+
+            buf = array.base if array.base is not None else array
+            bytestart = self.dtype.itemsize * s
+            cl.enqueue_copy(
+                queue,
+                self.cl_buf.data,
+                buf,
+                device_offset=bytestart,
+                is_blocking=True,
+            )
+            return None
+
+    def get_rows(
+        self, n_rows, queue=None, wait_for=None, is_blocking=True, skip_rows=None
+    ):
+        """Copy the first ``n_rows[i]`` rows of each array ``i`` to the host.
+
+        Only the requested rows are transferred. The rows of all arrays are stored
+        one after the other in a single flat host array, and copies of regions
+        that are adjacent on the device are merged into one transfer.
+
+        Parameters
+        ----------
+        n_rows : (len(self),) array_like of int
+            Number of leading rows to copy from each array.
+        queue : `pyopencl.CommandQueue` (optional)
+            Queue on which to copy (defaults to ``self.queue``).
+        wait_for : list of `pyopencl.Event` (optional)
+            Events that must complete before copying.
+        is_blocking : bool (optional)
+            Whether to wait for the copies to complete before returning.
+        skip_rows : (len(self),) array_like of int (optional)
+            Number of leading rows of each array not to copy, i.e. only rows
+            ``skip_rows[i]`` to ``n_rows[i]`` of array ``i`` are copied.
+
+        Returns
+        -------
+        out : ndarray
+            Flat host array with the rows of all arrays.
+        offsets : (len(self) + 1,) ndarray
+            The rows of array ``i`` are ``out[offsets[i]:offsets[i + 1]]``.
+        event : `pyopencl.Event`
+            Event marking the completion of all copies.
+        """
+        n_rows = np.asarray(n_rows)
+        skip_rows = np.zeros_like(n_rows) if skip_rows is None else skip_rows
+        assert n_rows.shape == (len(self),)
+        assert (n_rows <= self.shape0s).all()
+        assert (0 <= skip_rows).all() and (skip_rows <= n_rows).all()
+
+        # rows must be contiguous
+        assert (self.stride0s == self.shape1s).all()
+        assert (self.stride1s == 1).all()
+
+        sizes = (n_rows - skip_rows) * self.shape1s
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        out = np.empty(offsets[-1], dtype=self.dtype)
+
+        ranges = []  # [device start, host start, size] of each copy
+        starts = self.starts + skip_rows * self.stride0s
+        for start, offset, size in zip(starts, offsets, sizes):
+            if size == 0:
+                continue
+            if ranges and ranges[-1][0] + ranges[-1][2] == start:
+                ranges[-1][2] += size  # adjacent on the device and on the host
+            else:
+                ranges.append([start, offset, size])
+
+        queue = self.queue if queue is None else queue
+        itemsize = self.dtype.itemsize
+        events = [
+            cl.enqueue_copy(
+                queue,
+                out[offset : offset + size],
+                self.cl_buf.data,
+                src_offset=itemsize * start,
+                wait_for=wait_for,
+                is_blocking=False,
+            )
+            for start, offset, size in ranges
+        ]
+        event = cl.enqueue_marker(queue, wait_for=events if events else wait_for)
+        if is_blocking:
+            event.wait()
+
+        return out, offsets, event
 
     def to_host(self):
         """Copy the whole object to a host RaggedArray"""
@@ -2,14 +2,16 @@
 
 # pylint: disable=missing-function-docstring
 
+import copy
+
 import numpy as np
 from nengo.builder.operator import (
-    BsrDotInc,
     Copy,
     DotInc,
     ElementwiseInc,
     Operator,
     Reset,
+    TimeUpdate,
 )
 from nengo.builder.signal import Signal
 from nengo.builder.transforms import ConvInc
@@ -49,11 +51,7 @@ class MultiDotInc(Operator):
 
     @classmethod
     def convert_to(cls, op):
-        if isinstance(op, BsrDotInc):
-            raise NotImplementedError(
-                "Optimized BsrDotInc operations not yet supported by NengoOCL"
-            )
-        elif type(op) == DotInc:
+        if type(op) == DotInc:  # BsrDotInc is planned separately
             rval = cls(op.Y, op.Y, beta=1, gamma=0, tag=op.tag)
             rval.add_AX(op.A, op.X)
         else:
@@ -330,6 +328,85 @@ def remove_zero_incs(operators):
     return new_operators
 
 
+def batch_operators(operators, batch_size):
+    """Replicate operators to simulate ``batch_size`` copies of a model at once.
+
+    Signals that are modified by the operators (the state of the model) are
+    replicated, so that each copy has its own state. All other signals (e.g.
+    connection weights and encoders) are shared between the copies, as are the
+    simulation time and step signals. The copies of each operator are placed
+    directly after it, so that planners can run them in the same kernel.
+
+    Parameters
+    ----------
+    operators : list of `~nengo.builder.Operator`
+        Operators in the model
+    batch_size : int
+        Number of copies of the model
+
+    Returns
+    -------
+    new_operators : list of `~nengo.builder.Operator`
+        Operators for all copies (the first copy uses the original operators)
+    get_copies : callable
+        ``get_copies(sig)`` returns a list of the ``batch_size`` copies of signal
+        ``sig`` (the first copy is ``sig`` itself)
+    """
+    time_bases = {s.base for op in operators if type(op) is TimeUpdate for s in op.sets}
+    state_bases = {
+        s.base
+        for op in operators
+        if type(op) is not TimeUpdate
+        for s in op.sets + op.incs + op.updates
+    }
+    copies = {}  # map from signal to its copies
+
+    def get_copies(sig):
+        if sig.base not in state_bases or sig.base in time_bases:
+            return [sig] * batch_size
+
+        if sig not in copies:
+            if sig.is_view:
+                copies[sig] = [
+                    Signal(
+                        np.ndarray(
+                            sig.shape,
+                            dtype=sig.dtype,
+                            buffer=base.initial_value,
+                            offset=sig.offset,
+                            strides=sig.initial_value.strides,
+                        ),
+                        name=sig.name,
+                        base=base,
+                        offset=sig.offset,
+                    )
+                    for base in get_copies(sig.base)[1:]
+                ]
+            else:
+                copies[sig] = [
+                    Signal(np.array(sig.initial_value), name=sig.name)
+                    for _ in range(1, batch_size)
+                ]
+
+        return [sig] + copies[sig]
+
+    new_operators = []
+    for op in operators:
+        new_operators.append(op)
+        if type(op) is TimeUpdate:
+            continue
+
+        for i in range(1, batch_size):
+            new_op = copy.copy(op)
+            new_op.sets = [get_copies(s)[i] for s in op.sets]
+            new_op.incs = [get_copies(s)[i] for s in op.incs]
+            new_op.reads = [get_copies(s)[i] for s in op.reads]
+            new_op.updates = [get_copies(s)[i] for s in op.updates]
+            new_operators.append(new_op)
+
+    return new_operators, get_copies
+
+
 def simplify_operators(operators):
     """Apply simplifications to a list of operators, returning a simplified list.
 
@@ -2,11 +2,61 @@
 
 # pylint: disable=missing-class-docstring,missing-function-docstring
 
+import os
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import pyopencl as cl
 
+from nengo_ocl.utils import nonelist
+
 PROFILING_ENABLE = cl.command_queue_properties.PROFILING_ENABLE
+TRACE_LENGTH = 10000  # number of profiled calls kept in the trace of each plan
+
+
+class TimingStats:
+    """Streaming statistics of a series of durations (in seconds).
+
+    Keeps the count, sum, minimum, and maximum of the durations, and a histogram
+    with one bin per power of two nanoseconds (bin ``i`` counts durations from
+    ``2**i`` to ``2**(i + 1)`` ns), so memory use does not grow with the number
+    of durations.
+    """
+
+    n_bins = 48
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self.histogram = [0] * self.n_bins
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count > 0 else float("nan")
+
+    def add(self, duration):
+        self.count += 1
+        self.sum += duration
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+        i = int(1e9 * duration).bit_length() - 1
+        self.histogram[min(max(i, 0), self.n_bins - 1)] += 1
+
+    def quantile(self, q):
+        """Upper bound on the ``q`` quantile of the durations (from the histogram)."""
+        target = q * self.count
+        total = 0
+        for i, n in enumerate(self.histogram):
+            total += n
+            if n > 0 and total >= target:
+                return min(1e-9 * 2 ** (i + 1), self.max)
+        return float("nan")
 
 
 class BasePlan:
@@ -14,11 +64,17 @@ class BasePlan:
         self.name = name
         self.tag = tag
 
-        self.atimes = []
-        self.btimes = []
-        self.ctimes = []
+        # time queued, time submitted, and run time of profiled calls
+        self.atimes = TimingStats()
+        self.btimes = TimingStats()
+        self.ctimes = TimingStats()
         self.n_calls = 0
 
+        # (queued, start, end, queue) of the last profiled calls, with times in ns
+        # on the device clock for kernels (on ``queue``), or the host clock
+        # (`time.perf_counter_ns`) for Python plans (with ``queue=None``)
+        self.trace = deque(maxlen=TRACE_LENGTH)
+
         self.flops_per_call = flops_per_call  # floating-point ops per call
         self.bw_per_call = bw_per_call  # bandwidth requirement per call
 
@@ -37,19 +93,37 @@ class BasePlan:
 
 
 class PythonPlan(BasePlan):
-    def __init__(self, function, **kwargs):
+    """A plan that runs a Python function on the host.
+
+    Plans that copy data to and from the device can also provide the function in
+    three parts, so that the copies can be enqueued ahead of time, in order with
+    the kernels, while the computation runs on a thread pool (see `.Plans`):
+
+    - ``read(queue, wait_for)`` enqueues the copies of the inputs to the host on
+      ``queue`` after the events ``wait_for``, and returns the host inputs and
+      the events of the copies.
+    - ``compute(inputs)`` computes the outputs from the host inputs.
+    - ``write(queue, wait_for)`` enqueues the copies of the outputs to the device
+      on ``queue`` after the events ``wait_for``, and returns their events.
+    """
+
+    def __init__(self, function, read=None, compute=None, write=None, **kwargs):
         super().__init__(**kwargs)
         self.function = function
+        self.read = read
+        self.compute = compute
+        self.write = write
 
     def __call__(self, profiling=False):
         if profiling:
-            t0 = time.time()
+            t0 = time.perf_counter_ns()
         self.function()
         if profiling:
-            t1 = time.time()
-            self.atimes.append(0)
-            self.btimes.append(0)
-            self.ctimes.append(t1 - t0)
+            t1 = time.perf_counter_ns()
+            self.atimes.add(0)
+            self.btimes.add(0)
+            self.ctimes.add(1e-9 * (t1 - t0))
+            self.trace.append((t0, t0, t1, None))
             self.n_calls += 1
 
 
@@ -75,16 +149,23 @@ class Plan(BasePlan):
 
     def update_profiling(self):
         for ev in self._events_to_profile:
-            self.atimes.append(1e-9 * (ev.profile.submit - ev.profile.queued))
-            self.btimes.append(1e-9 * (ev.profile.start - ev.profile.submit))
-            self.ctimes.append(1e-9 * (ev.profile.end - ev.profile.start))
+            self.atimes.add(1e-9 * (ev.profile.submit - ev.profile.queued))
+            self.btimes.add(1e-9 * (ev.profile.start - ev.profile.submit))
+            self.ctimes.add(1e-9 * (ev.profile.end - ev.profile.start))
+            self.trace.append(
+                (ev.profile.queued, ev.profile.start, ev.profile.end, ev.command_queue)
+            )
             self.n_calls += 1
 
         self._events_to_profile[:] = []
 
-    def enqueue(self, wait_for=None, profiling=False):
+    def enqueue(self, wait_for=None, profiling=False, queue=None):
         ev = cl.enqueue_nd_range_kernel(
-            self.queue, self.kern, self.gsize, self.lsize, wait_for=wait_for
+            self.queue if queue is None else queue,
+            self.kern,
+            self.gsize,
+            self.lsize,
+            wait_for=wait_for,
         )
         if profiling:
             self._events_to_profile.append(ev)
@@ -109,9 +190,54 @@ class Plan(BasePlan):
 
 
 class Plans:
-    def __init__(self, planlist, profiling):
+    """A list of plans, executed in order once per timestep.
+
+    Parameters
+    ----------
+    planlist : list of `.BasePlan`
+        The plans to execute.
+    profiling : bool
+        Whether to record profiling information when executing plans.
+    recorded : bool
+        Whether to use recorded dispatch for steps that are not profiled (see
+        `.Plans.record`), which minimizes the Python overhead of each step.
+    dependencies : list of list of int (optional)
+        For each plan, the indices of the plans it waits for (see
+        `nengo_ocl.planners.plan_dependencies`). With recorded dispatch, Python
+        plans then only wait for the plans they depend on, rather than for all
+        plans before them. By default, each plan depends on all others.
+    profiling_every : int
+        When profiling, only profile every ``profiling_every``-th step, so that
+        profiling has little effect on the timing of the other steps. The steps
+        that were profiled are kept in ``profiled_steps``.
+
+    Notes
+    -----
+    With recorded dispatch, Python plans run on a thread pool, so that they
+    overlap with the kernels they do not depend on, and with each other. Kernels
+    after a Python plan wait for it to finish. Once a Python plan raises an
+    error, no more Python plans are run, and the error is raised by
+    `.Plans.finish`, which is called as soon as the next step is enqueued.
+    """
+
+    def __init__(
+        self, planlist, profiling, recorded=True, dependencies=None, profiling_every=1
+    ):
         self.plans = planlist
         self.profiling = profiling
+        self.profiling_every = profiling_every
+        self.profiled_steps = deque(maxlen=TRACE_LENGTH)
+        self.recorded = recorded
+        self.dependencies = dependencies
+        self._n_steps = 0  # number of steps enqueued
+        self._recording = None
+        self._events = [None] * len(planlist)  # last event of each plan
+        self._queue = None  # queue of the kernels (set by `record`)
+        self._executor = None
+        self._futures = []
+        self._failed = False  # whether a Python plan on the thread pool has failed
+        self._host_queues = {}  # queue for the copies of each Python plan
+        self._copy_events = []  # copies of Python plans that may not be done
 
     def __call__(self):
         return self.call_n_times(1)
@@ -129,21 +255,393 @@ class Plans:
         last_event = self.enqueue_n_times(n)
         if last_event is not None:
             last_event.wait()
+        self.finish()
 
         if self.profiling:
-            for p in self.plans:
-                p.update_profiling()
+            self.update_profiling()
+
+    def update_profiling(self):
+        for p in self.plans:
+            p.update_profiling()
+
+    def _profile_step(self):
+        """Count the next step, and return whether to profile it."""
+        step = self._n_steps
+        self._n_steps += 1
+        if self.profiling and step % self.profiling_every == 0:
+            self.profiled_steps.append(step)
+            return True
+        return False
+
+    def finish(self):
+        """Wait for the Python plans running on the thread pool.
+
+        If any of them raised an error, the first error is raised here.
+        """
+        futures, self._futures = self._futures, []
+        errors = [future.exception() for future in futures]
+
+        if self._copy_events:
+            cl.wait_for_events(self._copy_events)
+            self._copy_events = []
+
+        self._failed = False
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def close(self):
+        """Shut down the thread pool used to run Python plans."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def record(self):
+        """Freeze the kernels, sizes, and arguments of all plans for dispatch.
+
+        Consecutive OpenCL plans are grouped into segments of
+        ``(queue, kernel, gsize, lsize, slot)`` tuples, separated by the Python
+        plans that have to run between them. Kernel arguments are already bound
+        when plans are created, so each step only has to enqueue the recorded
+        kernels. The event of a kernel is kept (in ``slot``) only if a Python plan
+        has to wait for it.
+
+        The recording is made automatically when needed; call
+        `.Plans.invalidate` after changing the kernel or sizes of a plan.
+        """
+        n = len(self.plans)
+        dependencies = self.dependencies or [range(n)] * n
+        is_python = [not hasattr(plan, "enqueue") for plan in self.plans]
+
+        # Kernels on an in-order queue finish in order, so Python plans only have
+        # to wait for the last kernel they depend on (in this step, if any, or else
+        # in the previous step), as well as for the Python plans they depend on.
+        waits = {}
+        for k in (k for k in range(n) if is_python[k]):
+            kernels = [j for j in dependencies[k] if not is_python[j]]
+            last = max((j for j in kernels if j < k), default=max(kernels, default=-1))
+            pythons = {j for j in dependencies[k] if is_python[j]} | {k}
+            waits[k] = ([last] if last >= 0 else []) + sorted(pythons)
+        slots = {j for js in waits.values() for j in js}
+
+        segments = []
+        calls = []
+        for k, plan in enumerate(self.plans):
+            if is_python[k]:
+                segments.append((tuple(calls), plan, k, waits[k]))
+                calls = []
+            else:
+                slot = k if k in slots else None
+                calls.append((plan.queue, plan.kern, plan.gsize, plan.lsize, slot))
+        segments.append((tuple(calls), None, None, None))
+        self._recording = tuple(segments)
+        self._queue = next(plan.queue for plan in self.plans if hasattr(plan, "queue"))
+
+    def invalidate(self):
+        """Discard the recording made by `.Plans.record`."""
+        self._recording = None
+
+    def replace(self, old, new):
+        """Replace the plan ``old`` with ``new``."""
+        self.plans[self.plans.index(old)] = new
+        self.invalidate()
 
     def enqueue_n_times(self, n):
+        if not self.recorded:
+            return self._enqueue_n_times_plans(n)
+        if not self.profiling:
+            return self._enqueue_n_times_recorded(n)
+
+        # profiled steps run plan by plan, and the others from the recording
+        last_event = None
+        while n > 0:
+            m = min(-self._n_steps % self.profiling_every, n)
+            if m == 0:
+                # the Python plans of the recorded steps have to be done before
+                # they run again, and the next recorded steps wait for this one
+                self.finish()
+                last_event = self._enqueue_n_times_plans(1, last_event)
+                self._events[:] = [last_event] * len(self._events)
+                n -= 1
+            else:
+                last_event = self._enqueue_n_times_recorded(m)
+                n -= m
+
+        return last_event
+
+    def _enqueue_n_times_recorded(self, n):
+        if self._recording is None:
+            self.record()
+        self._n_steps += n
+
+        if len(self._recording) == 1:
+            # no Python plans
+            ((calls, _, _, _),) = self._recording
+            return self._enqueue_kernels_n_times(calls, n)
+
+        last_event = self._enqueue_segments_n_times(n)
+        self._prune_futures()
+        return last_event
+
+    @staticmethod
+    def _enqueue_kernels_n_times(calls, n):
+        """Enqueue the recorded kernel ``calls`` ``n`` times."""
+        enqueue = cl.enqueue_nd_range_kernel
         last_event = None
         for _ in range(n):
+            for queue, kern, gsize, lsize, _ in calls:
+                last_event = enqueue(queue, kern, gsize, lsize)
+        return last_event
+
+    def _enqueue_segments_n_times(self, n):
+        """Enqueue the recorded kernels and Python plans ``n`` times."""
+        enqueue = cl.enqueue_nd_range_kernel
+        events = self._events
+        last_event = None
+        for _ in range(n):
+            if self._failed:
+                self.finish()  # raise the error, rather than enqueueing more steps
+
+            for calls, python_plan, k, waits in self._recording:
+                for queue, kern, gsize, lsize, slot in calls:
+                    last_event = enqueue(queue, kern, gsize, lsize)
+                    if slot is not None:
+                        events[slot] = last_event
+                if python_plan is not None:
+                    wait_for = [events[j] for j in waits if events[j] is not None]
+                    events[k] = self._submit_python(python_plan, wait_for)
+
+                    # the following kernels wait for the Python plan
+                    if events[k] is not None:
+                        last_event = cl.enqueue_barrier(
+                            self._queue, wait_for=[events[k]]
+                        )
+        return last_event
+
+    def _submit_python(self, plan, wait_for):
+        """Run the Python ``plan`` once the events ``wait_for`` are complete.
+
+        The copies of the plan's inputs and outputs are enqueued right away (on
+        the plan's own queue), so that they are in order with the kernels that use
+        the same buffers. The computation runs on the thread pool once the inputs
+        have arrived, and the outputs are copied when it is done. Returns the
+        event of the last copy, which completes when the plan is done.
+
+        Plans that do not provide their function in parts run right away, on the
+        host, and return ``None``.
+        """
+        if plan.compute is None:
+            if wait_for:
+                cl.wait_for_events(wait_for)
+            plan()
+            return None
+
+        if self._executor is None:
+            n_python = sum(not hasattr(plan, "enqueue") for plan in self.plans)
+            self._executor = ThreadPoolExecutor(
+                max_workers=max(min(n_python, os.cpu_count() or 1), 1),
+                thread_name_prefix="nengo_ocl python plans",
+            )
+        if plan not in self._host_queues:
+            self._host_queues[plan] = cl.CommandQueue(
+                self._queue.context, device=self._queue.device
+            )
+
+        queue = self._host_queues[plan]
+        inputs, reads = plan.read(queue, wait_for or None)
+        computed = cl.UserEvent(self._queue.context)
+
+        def run():
+            try:
+                if reads:
+                    cl.wait_for_events(reads)
+                if not self._failed:  # after an error, plans are no longer run
+                    plan.compute(inputs)
+            except BaseException:
+                self._failed = True
+                raise
+            finally:
+                computed.set_status(cl.command_execution_status.COMPLETE)
+
+        self._futures.append(self._executor.submit(run))
+        writes = plan.write(queue, [computed])
+
+        # Copies involving host memory wait for completion (holding the GIL) when
+        # their events are deleted, so keep the events until they are complete.
+        self._copy_events.extend(reads + writes)
+        return writes[-1] if writes else computed  # the queue is in-order
+
+    def _prune_futures(self):
+        """Forget Python plans that are done (keeping those that raised errors)."""
+        self._futures = [
+            f for f in self._futures if not f.done() or f.exception() is not None
+        ]
+        complete = cl.command_execution_status.COMPLETE
+        self._copy_events = [
+            e for e in self._copy_events if e.command_execution_status != complete
+        ]
+
+    def _enqueue_n_times_plans(self, n, last_event=None):
+        for _ in range(n):
+            profiling = self._profile_step()
             for plan in self.plans:
                 if hasattr(plan, "enqueue"):
-                    last_event = plan.enqueue(profiling=self.profiling)
+                    last_event = plan.enqueue(profiling=profiling)
                 else:
                     # wait for last event and call
                     if last_event is not None:
                         last_event.wait()
-                    plan(profiling=self.profiling)
+                    plan(profiling=profiling)
+
+        return last_event
+
+
+class PartitionedPlans(Plans):
+    """Plans for a model partitioned across several command queues.
+
+    Each step, the ``exchange`` plans run first (to refresh the signals that
+    partitions read from each other). Then the plans of each partition run in order
+    on their own queue, concurrently with the other partitions. Finally, the
+    ``final`` plans (e.g. probes) run once all partitions are done. Queues are
+    synchronized with events, so the host never waits unless it runs Python plans.
+
+    Parameters
+    ----------
+    exchange : list of `.Plan`
+        Plans that run at the start of each step, on ``queue``.
+    partitions : list of list of `.BasePlan`
+        Plans for each partition.
+    final : list of `.BasePlan`
+        Plans that run at the end of each step, on ``queue``.
+    queue : `pyopencl.CommandQueue`
+        Queue of the exchange and final plans.
+    profiling : bool
+        Whether to record profiling information when executing plans.
+    profiling_every : int
+        When profiling, only profile every ``profiling_every``-th step.
+    """
+
+    def __init__(
+        self, exchange, partitions, final, queue, profiling, profiling_every=1
+    ):
+        planlist = exchange + [p for plans in partitions for p in plans] + final
+        super().__init__(
+            planlist, profiling, recorded=False, profiling_every=profiling_every
+        )
+        self.exchange = exchange
+        self.partitions = partitions
+        self.final = final
+        self.queue = queue
+
+    def replace(self, old, new):
+        super().replace(old, new)
+        for plans in [self.exchange, self.final] + self.partitions:
+            if old in plans:
+                plans[plans.index(old)] = new
+
+    def enqueue_n_times(self, n):
+        last_event = None
+        for _ in range(n):
+            profiling = self._profile_step()
+            start = self._enqueue_in_order(
+                self.exchange, nonelist(last_event), profiling
+            )
+            ends = [
+                self._enqueue_in_order(plans, start, profiling)
+                for plans in self.partitions
+            ]
+            ends = self._enqueue_in_order(
+                self.final, [e for evs in ends for e in evs], profiling
+            )
+            last_event = (
+                ends[0]
+                if len(ends) == 1
+                else cl.enqueue_marker(self.queue, wait_for=ends or None)
+            )
 
         return last_event
+
+    def _enqueue_in_order(self, plans, wait_for, profiling):
+        """Enqueue ``plans`` after ``wait_for``; return the events to wait for."""
+        for plan in plans:
+            if hasattr(plan, "enqueue"):
+                ev = plan.enqueue(wait_for=wait_for or None, profiling=profiling)
+                wait_for = [ev]
+            else:
+                if wait_for:
+                    cl.wait_for_events(wait_for)
+                plan(profiling=profiling)
+                wait_for = []
+
+        return wait_for
+
+
+class DependencyPlans(Plans):
+    """Plans that each wait only for the plans they depend on.
+
+    Rather than running all plans in order on one in-order queue, each kernel is
+    enqueued with the events of the plans it depends on (see
+    `nengo_ocl.planners.plan_dependencies`), so independent kernels (e.g. GEMVs,
+    neurons, and synapses of separate parts of a model) can run concurrently on
+    devices that support it. Kernels are enqueued on an out-of-order queue, or
+    spread over several in-order queues. Python plans run on a thread pool (see
+    `.Plans`) once the plans they depend on are done, and only the plans that
+    depend on them wait for them.
+
+    Parameters
+    ----------
+    planlist : list of `.BasePlan`
+        The plans to execute.
+    dependencies : list of list of int
+        For each plan, the indices of the plans it waits for.
+    queues : list of `pyopencl.CommandQueue`
+        Queues on which to enqueue kernels. Plan ``k`` uses queue
+        ``k % len(queues)``.
+    profiling : bool
+        Whether to record profiling information when executing plans.
+    profiling_every : int
+        When profiling, only profile every ``profiling_every``-th step.
+    """
+
+    def __init__(self, planlist, dependencies, queues, profiling, profiling_every=1):
+        super().__init__(
+            planlist,
+            profiling,
+            recorded=False,
+            dependencies=dependencies,
+            profiling_every=profiling_every,
+        )
+        assert len(dependencies) == len(planlist)
+        self.queues = queues
+        self._queue = queues[0]
+
+    def enqueue_n_times(self, n):
+        events = self._events
+        steps = [
+            (k, plan, deps, self.queues[k % len(self.queues)])
+            for k, (plan, deps) in enumerate(zip(self.plans, self.dependencies))
+        ]
+        for _ in range(n):
+            if self._failed:
+                self.finish()  # raise the error, rather than enqueueing more steps
+
+            profiling = self._profile_step()
+            for k, plan, deps, queue in steps:
+                wait_for = [events[j] for j in deps if events[j] is not None]
+                if hasattr(plan, "enqueue"):
+                    events[k] = plan.enqueue(
+                        wait_for=wait_for or None, profiling=profiling, queue=queue
+                    )
+                elif profiling:
+                    if wait_for:
+                        cl.wait_for_events(wait_for)
+                    plan(profiling=profiling)
+                    events[k] = None  # the plan is done when it returns
+                else:
+                    events[k] = self._submit_python(plan, wait_for)
+
+        self._prune_futures()
+        wait_for = [ev for ev in events if ev is not None]
+        return (
+            cl.enqueue_marker(self.queues[0], wait_for=wait_for) if wait_for else None
+        )
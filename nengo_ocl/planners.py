@@ -1,10 +1,29 @@
 """Planners for scheduling operator execution order."""
 
+import hashlib
+import heapq
+import logging
+import os
+import pickle
 from collections import defaultdict
 
-from nengo.builder.operator import Operator
+from nengo.builder.operator import (
+    Copy,
+    ElementwiseInc,
+    Operator,
+    Reset,
+    TimeUpdate,
+)
+from nengo.builder.probe import SimProbe
+from nengo.cache import safe_makedirs, safe_remove
+from nengo.utils.paths import cache_dir as nengo_cache_dir
 from nengo.utils.simulator import operator_dependency_graph
 
+from nengo_ocl.program_cache import atomic_dump
+from nengo_ocl.utils import stable_unique
+
+logger = logging.getLogger(__name__)
+
 
 def greedy_planner(operators):  # noqa: C901
     """Plan operator execution order in a greedy manner.
@@ -93,3 +112,467 @@ def greedy_planner(operators):  # noqa: C901
     assert len(operators) == sum(len(p[1]) for p in rval)
     # print('greedy_planner: Program len:', len(rval))
     return rval
+
+
+class CachedPlanner:
+    """Planner that caches the operator order found by another planner on disk.
+
+    Planning depends only on the structure of the operator graph (which signals
+    each operator reads and writes), not on the values in those signals. The
+    cache key is therefore a fingerprint of that structure, and a cached plan is
+    reused for any model with the same structure (e.g. the same network built
+    with a different seed, or with different connection weights).
+
+    Parameters
+    ----------
+    planner : callable
+        The planner whose results are cached.
+    cache_dir : str or None
+        Directory in which to store plans. Defaults to the environment variable
+        ``NENGO_OCL_PLANNER_CACHE_DIR``, or ``<nengo cache dir>/ocl_plans``.
+
+    Attributes
+    ----------
+    hits : int
+        Number of plans loaded from the cache.
+    misses : int
+        Number of plans computed by ``planner``.
+    """
+
+    _suffix = ".plan"
+
+    def __init__(self, planner=greedy_planner, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.getenv(
+                "NENGO_OCL_PLANNER_CACHE_DIR",
+                os.path.join(nengo_cache_dir, "ocl_plans"),
+            )
+
+        self.planner = planner
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+        safe_makedirs(self.cache_dir)
+
+    def __call__(self, operators):
+        key = self.fingerprint(operators)
+        path = os.path.join(self.cache_dir, key + self._suffix)
+
+        op_groups = self._load(path, operators)
+        if op_groups is not None:
+            self.hits += 1
+            logger.info("Loaded operator plan %s from cache", key)
+            return op_groups
+
+        self.misses += 1
+        op_groups = self.planner(operators)
+        self._save(path, operators, op_groups)
+        return op_groups
+
+    def fingerprint(self, operators):
+        """Key identifying the structure of ``operators`` (and the planner)."""
+        base_index = {}
+
+        def sig_key(sig):
+            i = base_index.setdefault(sig.base, len(base_index))
+            return (i, sig.base.shape, sig.shape, sig.elemoffset, sig.elemstrides)
+
+        h = hashlib.sha1()
+        h.update(getattr(self.planner, "__qualname__", repr(self.planner)).encode())
+        for op in operators:
+            key = (type(op).__name__,) + tuple(
+                tuple(sig_key(s) for s in sigs)
+                for sigs in (op.sets, op.incs, op.reads, op.updates)
+            )
+            h.update(repr(key).encode())
+
+        return h.hexdigest()
+
+    def clear(self):
+        """Remove all plans from the cache."""
+        for f in os.listdir(self.cache_dir):
+            if f.endswith(self._suffix):
+                safe_remove(os.path.join(self.cache_dir, f))
+
+    @staticmethod
+    def _load(path, operators):
+        try:
+            with open(path, "rb") as fh:
+                groups = pickle.load(fh)
+            op_groups = []
+            for type_name, inds in groups:
+                ops = [operators[i] for i in inds]
+                op_type = type(ops[0])
+                if op_type.__name__ != type_name or any(
+                    type(op) is not op_type for op in ops
+                ):
+                    raise ValueError("Operator types do not match")
+                op_groups.append((op_type, ops))
+            if sum(len(ops) for _, ops in op_groups) != len(operators):
+                raise ValueError("Plan does not cover all operators")
+        except FileNotFoundError:
+            return None
+        except Exception as e:  # pylint: disable=broad-except
+            logger.debug("Could not load cached plan %r: %s", path, e)
+            safe_remove(path)
+            return None
+
+        return op_groups
+
+    def _save(self, path, operators, op_groups):
+        index = {op: i for i, op in enumerate(operators)}
+        groups = [
+            (op_type.__name__, [index[op] for op in ops]) for op_type, ops in op_groups
+        ]
+
+        try:
+            atomic_dump(groups, path)
+        except OSError as e:
+            logger.debug("Could not save plan to cache: %s", e)
+
+
+class FusedElementwise:
+    """Op group type for several elementwise op groups fused into one kernel.
+
+    The ops of a fused group are listed in the order in which they are executed.
+    See `.fuse_elementwise`.
+    """
+
+
+def elementwise_term(op):
+    """The destination and operands of an op that can be fused, or None.
+
+    Returns ``(Y, A, X)`` such that the op computes ``Y = A * X`` (or ``Y += A * X``
+    if the op increments ``Y``), where ``A`` and ``X`` are broadcast against ``Y``,
+    and an operand of None stands for a constant.
+    """
+    if type(op) is Reset:
+        return op.dst, None, None
+    if type(op) is Copy and op.src_slice is None and op.dst_slice is None:
+        return op.dst, None, op.src
+    if type(op) is ElementwiseInc:
+        return op.Y, op.A, op.X
+    return None
+
+
+def _same_view(a, b):
+    return (
+        a.base is b.base
+        and a.elemoffset == b.elemoffset
+        and a.shape == b.shape
+        and a.elemstrides == b.elemstrides
+    )
+
+
+class _ElementwiseRun:
+    """A run of adjacent elementwise op groups to fuse (see `.fuse_elementwise`)."""
+
+    def __init__(self):
+        self.groups = []
+        self.dsts = defaultdict(list)  # views written, for each base
+        self.reads = defaultdict(list)  # views read, for each base
+
+    def add(self, op_type, ops, terms):
+        self.groups.append((op_type, ops))
+        for y, a, x in terms:
+            self.dsts[y.base].append(y)
+            for s in (a, x):
+                if s is not None:
+                    self.reads[s.base].append(s)
+
+    def conflicts(self, terms):
+        """Whether ops with elementwise ``terms`` cannot be fused into this run."""
+        return any(self._conflicts(term) for term in terms)
+
+    def _conflicts(self, term):
+        y, a, x = term
+        if any(
+            y.may_share_memory(s) and not _same_view(y, s) for s in self.dsts[y.base]
+        ):
+            return True
+        if any(y.may_share_memory(s) for s in self.reads[y.base]):
+            return True
+        return any(
+            s is not None and any(s.may_share_memory(y2) for y2 in self.dsts[s.base])
+            for s in (a, x)
+        )
+
+    @classmethod
+    def self_conflicts(cls, op_type, ops, terms):
+        """Whether a group of ops conflicts with itself (so it cannot be fused)."""
+        run = cls()
+        run.add(op_type, ops, terms)
+        return run.conflicts(terms)
+
+    def end(self):
+        """Return the op groups of this run (fused, if more than one) and clear it."""
+        groups = self.groups
+        self.__init__()
+        if len(groups) > 1:
+            return [(FusedElementwise, [op for _, ops in groups for op in ops])]
+        return groups
+
+
+def fuse_elementwise(op_groups):
+    """Fuse runs of adjacent elementwise op groups, so they execute in one kernel.
+
+    Resets, (unsliced) copies, and elementwise increments all operate on their
+    destination signal one element at a time. Adjacent groups of these ops are
+    fused if each signal written by the run is only ever written through the same
+    view, and is not read by any op in the run. Each element of a destination can
+    then be computed by a single work item, which applies all ops on that
+    destination in order, keeping the intermediate value in a register. If only
+    some ops in a group conflict with the run, the group is split.
+
+    Parameters
+    ----------
+    op_groups : list of (type, list of Operator)
+        Op groups in the order they are executed, as returned by a planner.
+
+    Returns
+    -------
+    list of (type, list of Operator)
+        The op groups, with fused runs replaced by groups of type
+        `.FusedElementwise`.
+    """
+
+    rval = []
+    run = _ElementwiseRun()
+    for op_type, ops in op_groups:
+        if op_type is SimProbe:
+            rval.append((op_type, ops))  # does nothing on the device
+            continue
+
+        # a group that conflicts with itself (e.g. reads its own output) is not fused
+        terms = [elementwise_term(op) for op in ops]
+        if any(term is None for term in terms) or _ElementwiseRun.self_conflicts(
+            op_type, ops, terms
+        ):
+            rval.extend(run.end())
+            rval.append((op_type, ops))
+            continue
+
+        if run.conflicts(terms):
+            # ops in a group are independent, so the ops that do not conflict can
+            # finish the current run, and the others start the next one
+            ok = [not run.conflicts([term]) for term in terms]
+            if any(ok):
+                run.add(
+                    op_type,
+                    [op for op, k in zip(ops, ok) if k],
+                    [term for term, k in zip(terms, ok) if k],
+                )
+                ops = [op for op, k in zip(ops, ok) if not k]
+                terms = [term for term, k in zip(terms, ok) if not k]
+            rval.extend(run.end())
+
+        run.add(op_type, ops, terms)
+
+    rval.extend(run.end())
+    assert sum(len(ops) for _, ops in rval) == sum(len(ops) for _, ops in op_groups)
+    return rval
+
+
+def partition_operators(operators, n_partitions):
+    """Split operators into partitions that can run on separate devices.
+
+    Within a timestep, partitions only depend on each other through signals that
+    are *updated* (i.e. written at the end of the step, and read on the next step,
+    like the state of a synapse). Each partition reads its own copy of the updated
+    signals it needs from other partitions, which only has to be refreshed once per
+    step. All other signals that are written during a step stay within one
+    partition, along with all ops that read them. The resulting components are
+    assigned to partitions so as to balance the sizes of the signals they use.
+
+    The `.TimeUpdate` op is replicated in all partitions, so that each partition
+    can keep its own copy of the time, rather than having to share it. Signals
+    that are never written (e.g. connection weights) but are read in several
+    partitions are also copied, so that no signal is used by more than one
+    partition, and each partition can keep its signals in its own buffer.
+
+    Parameters
+    ----------
+    operators : list of Operator
+        All operators in the model.
+    n_partitions : int
+        Number of partitions.
+
+    Returns
+    -------
+    partitions : list of list of Operator
+        The operators in each partition.
+    exchanged : list of list of Signal
+        For each partition, the bases updated in other partitions that it reads
+        (and therefore needs a copy of, refreshed at the start of each step).
+    private : list of list of Signal
+        For each partition, the bases of which it needs a copy that is never
+        refreshed (the time signals of replicated ops, in all but the first
+        partition, and the signals that are never written, in all but the first
+        partition that reads them).
+    """
+    if n_partitions < 1:
+        raise ValueError("Must have at least one partition (got %d)" % n_partitions)
+
+    replicated = [op for op in operators if type(op) is TimeUpdate]
+    ops = [op for op in operators if type(op) is not TimeUpdate]
+    replicated_bases = stable_unique(
+        s.base for op in replicated for s in op.sets + op.incs + op.updates
+    )
+
+    components = _connected_components(ops, replicated_bases)
+    partitions = _balance_components(components, n_partitions)
+
+    # keep ops in their original order within each partition
+    index = {op: i for i, op in enumerate(operators)}
+    partitions = [sorted(part + replicated, key=index.get) for part in partitions]
+
+    exchanged = _exchanged_bases(partitions, replicated_bases)
+    private = _private_bases(partitions, replicated_bases)
+    return partitions, exchanged, private
+
+
+def _connected_components(ops, replicated_bases):
+    """Group ``ops`` that share signals written during a step (by union-find).
+
+    Components are returned in the order of their first op.
+    """
+    parent = list(range(len(ops)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    writers, updaters, readers = _base_accesses(ops)
+    for base in stable_unique(list(writers) + list(updaters)):
+        if base in replicated_bases:
+            continue  # every partition has its own copy
+
+        # signals written during the step cannot be shared with other partitions
+        group = writers[base] + updaters[base]
+        if writers[base]:
+            group = group + readers[base]
+        for i in group[1:]:
+            parent[find(i)] = find(group[0])
+
+    components = defaultdict(list)
+    for i, op in enumerate(ops):
+        components[find(i)].append(op)
+    return list(components.values())
+
+
+def _base_accesses(ops):
+    """The indices of the ops writing, updating, and reading each base."""
+    writers = defaultdict(list)  # ops setting or incrementing each base
+    updaters = defaultdict(list)
+    readers = defaultdict(list)
+    for i, op in enumerate(ops):
+        for s in op.sets + op.incs:
+            writers[s.base].append(i)
+        for s in op.updates:
+            updaters[s.base].append(i)
+        for s in op.reads:
+            readers[s.base].append(i)
+    return writers, updaters, readers
+
+
+def _balance_components(components, n_partitions):
+    """Assign components to partitions, largest first, to the least loaded."""
+
+    def cost(component):
+        return sum(s.size for op in component for s in op.all_signals)
+
+    partitions = [[] for _ in range(n_partitions)]
+    loads = [(0, p) for p in range(n_partitions)]
+    for component in sorted(components, key=cost, reverse=True):
+        load, p = heapq.heappop(loads)
+        partitions[p].extend(component)
+        heapq.heappush(loads, (load + cost(component), p))
+    return partitions
+
+
+def _exchanged_bases(partitions, replicated_bases):
+    """For each partition, the bases it reads that other partitions update."""
+    owner = {}
+    for p, part in enumerate(partitions):
+        for op in part:
+            for s in op.updates:
+                if s.base not in replicated_bases:
+                    owner[s.base] = p
+
+    return [
+        stable_unique(
+            s.base
+            for op in part
+            for s in op.reads
+            if owner.get(s.base, p) != p and s.base not in replicated_bases
+        )
+        for p, part in enumerate(partitions)
+    ]
+
+
+def _private_bases(partitions, replicated_bases):
+    """For each partition, the bases it needs a copy of that is never refreshed."""
+    written = {s.base for part in partitions for op in part for s in op.sets + op.incs}
+    written.update(s.base for part in partitions for op in part for s in op.updates)
+
+    users = defaultdict(list)  # partitions reading each unwritten base, in order
+    for p, part in enumerate(partitions):
+        for base in stable_unique(s.base for op in part for s in op.all_signals):
+            if base not in written and not base.sparse:
+                users[base].append(p)
+
+    private = [[]] + [list(replicated_bases) for _ in partitions[1:]]
+    for base, ps in users.items():
+        for p in ps[1:]:
+            private[p].append(base)
+    return private
+
+
+def plan_dependencies(accesses):
+    """Find the plans that each plan has to wait for when the plans run repeatedly.
+
+    This is the dependency graph of the plans (like `.operator_dependency_graph`
+    for operators), including the ordering that follows from running the list of
+    plans once per step: a plan waits for the last plan that wrote a signal it
+    reads or writes, and a plan that writes a signal also waits for all plans that
+    read it since. Dependencies that follow from these transitively are omitted.
+    A plan always waits for its own previous call.
+
+    Parameters
+    ----------
+    accesses : list of (set, set)
+        For each plan (in the order in which it runs), the bases it reads and the
+        bases it writes. Any hashable can stand in for a base.
+
+    Returns
+    -------
+    dependencies : list of list of int
+        For each plan ``k``, the indices of the plans it waits for. An index
+        ``j < k`` refers to plan ``j`` in the same step, and ``j >= k`` to plan
+        ``j`` in the previous step.
+    """
+    n = len(accesses)
+    by_base = defaultdict(list)  # (plan index, writes) for each access of a base
+    for k, (reads, writes) in enumerate(accesses):
+        for base in reads | writes:
+            by_base[base].append((k, base in writes))
+
+    dependencies = [{k} for k in range(n)]
+    for base_accesses in by_base.values():
+        if not any(writes for _, writes in base_accesses):
+            continue  # read-only bases impose no order
+
+        m = len(base_accesses)
+        for i, (k, writes) in enumerate(base_accesses):
+            # go back through the accesses, wrapping around to the previous step
+            for di in range(1, m + 1):
+                j, j_writes = base_accesses[(i - di) % m]
+                if j_writes or writes:
+                    dependencies[k].add(j)
+                if j_writes:
+                    break
+
+    return [sorted(deps) for deps in dependencies]
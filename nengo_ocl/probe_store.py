@@ -0,0 +1,217 @@
+"""Host-side storage for probe data.
+
+Probe data is read off the device in blocks of several timesteps. A `.ProbeStore`
+appends these blocks to one contiguous array, so that ``sim.data[probe]`` is a view
+of that array rather than a stack of many small per-timestep arrays. The array can
+optionally live in a memory-mapped ``.npy`` file, so that long runs with large
+probes do not need to keep all probe data in host memory. For open-ended runs, a
+`.RingProbeStore` keeps only the most recent samples.
+"""
+
+import numpy as np
+
+
+class ProbeStore:
+    """Contiguous, growable storage for the data of one probe.
+
+    Blocks of samples are appended to the end of a preallocated array. When the
+    array is full, its capacity is doubled, so appending is amortized O(1) per
+    sample.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of one sample.
+    dtype : np.dtype
+        Data type of the samples.
+    path : str or None
+        If given, samples are stored in a memory-mapped ``.npy`` file at this path
+        (any existing file is overwritten). The file can be loaded with `numpy.load`
+        (at any time after `.ProbeStore.flush`).
+    """
+
+    _header_len = 128  # fixed .npy header length, so the header can be rewritten
+
+    def __init__(self, shape, dtype=np.float32, path=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.path = path
+
+        self._buf = None
+        self._len = 0
+
+        if self.path is not None:
+            with open(self.path, "wb"):
+                pass
+            self.flush()
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def capacity(self):
+        """(int) Number of samples that fit before the store has to grow."""
+        return 0 if self._buf is None else len(self._buf)
+
+    @property
+    def data(self):
+        """(ndarray) Read-only view of all samples stored so far."""
+        if self._buf is None:
+            data = np.zeros((0,) + self.shape, dtype=self.dtype)
+        else:
+            data = self._buf[: self._len]
+        data.setflags(write=False)
+        return data
+
+    def append(self, block):
+        """Append a block of samples with shape ``(n,) + self.shape``."""
+        block = np.asarray(block, dtype=self.dtype).reshape((-1,) + self.shape)
+        n = len(block)
+        if self._len + n > self.capacity:
+            self._grow(max(self._len + n, 2 * self.capacity))
+
+        self._buf[self._len : self._len + n] = block
+        self._len += n
+
+    def clear(self):
+        """Remove all samples.
+
+        Arrays previously returned by `.ProbeStore.data` are not modified, except
+        when storing to a file: then the file is reused, and overwritten by new
+        samples.
+        """
+        self._len = 0
+        if self.path is None:
+            self._buf = None
+        else:
+            self.flush()
+
+    def flush(self):
+        """Write all samples and an up-to-date header to the ``.npy`` file."""
+        if self.path is None:
+            return
+
+        if self._buf is not None:
+            self._buf.flush()
+        with open(self.path, "r+b") as fh:
+            fh.write(self._npy_header((self._len,) + self.shape))
+
+    def _grow(self, capacity):
+        shape = (capacity,) + self.shape
+        if self.path is None:
+            buf = np.empty(shape, dtype=self.dtype)
+            if self._buf is not None:
+                buf[: self._len] = self._buf[: self._len]
+        else:
+            # views of the old mapping (e.g. from `data`) stay valid
+            nbytes = int(np.prod(shape)) * self.dtype.itemsize
+            with open(self.path, "r+b") as fh:
+                fh.truncate(self._header_len + nbytes)
+            buf = np.memmap(
+                self.path,
+                dtype=self.dtype,
+                mode="r+",
+                offset=self._header_len,
+                shape=shape,
+            )
+
+        self._buf = buf
+
+    def _npy_header(self, shape):
+        header = repr(
+            {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": False,
+                "shape": shape,
+            }
+        ).encode("latin1")
+        magic = np.lib.format.magic(1, 0)
+        n_pad = self._header_len - len(magic) - 2 - len(header) - 1
+        assert n_pad >= 0, "Probe shape %s too long for .npy header" % (shape,)
+        header = header + b" " * n_pad + b"\n"
+        return magic + len(header).to_bytes(2, "little") + header
+
+
+class RingProbeStore:
+    """Storage that keeps only the last ``n`` samples of a probe.
+
+    Samples are written to a ring buffer of length ``n``, which is stored twice
+    back to back, so the current window of samples is always a contiguous view
+    of the buffer (no copying needed to access it). Appending is O(1) per sample,
+    and memory use does not grow with the length of the simulation.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of one sample.
+    n : int
+        Number of most recent samples to keep.
+    dtype : np.dtype
+        Data type of the samples.
+
+    Attributes
+    ----------
+    n_total : int
+        Total number of samples appended (since the last `.RingProbeStore.clear`).
+        The current window holds samples ``n_total - len(self)`` to ``n_total``.
+    """
+
+    def __init__(self, shape, n, dtype=np.float32):
+        if n < 1:
+            raise ValueError("Must keep at least one sample (got %d)" % n)
+
+        self.shape = tuple(shape)
+        self.n = n
+        self.dtype = np.dtype(dtype)
+
+        self._buf = np.zeros((2 * n,) + self.shape, dtype=self.dtype)
+        self._pos = 0  # index of the next sample to write
+        self.n_total = 0
+
+    def __len__(self):
+        return min(self.n_total, self.n)
+
+    @property
+    def capacity(self):
+        """(int) Number of samples kept."""
+        return self.n
+
+    @property
+    def data(self):
+        """(ndarray) Read-only view of the last ``n`` samples, oldest first.
+
+        Appending new samples overwrites the buffer that this view refers to, so
+        copy the view to keep the values from a particular time.
+        """
+        n_kept = len(self)
+        start = (self._pos - n_kept) % self.n
+        data = self._buf[start : start + n_kept]
+        data.setflags(write=False)
+        return data
+
+    def append(self, block, n_skipped=0):
+        """Append a block of samples with shape ``(m,) + self.shape``.
+
+        ``n_skipped`` samples before the block are counted as appended without
+        being stored. This is only possible if the block fills the whole buffer,
+        since it would overwrite those samples anyway.
+        """
+        block = np.asarray(block, dtype=self.dtype).reshape((-1,) + self.shape)
+        m = len(block)
+        assert n_skipped == 0 or m >= self.n
+        self.n_total += n_skipped + m
+        if m > self.n:
+            block = block[-self.n :]  # only the last samples are kept
+
+        inds = (self._pos + np.arange(len(block))) % self.n
+        self._buf[inds] = block
+        self._buf[inds + self.n] = block
+        self._pos = (self._pos + len(block)) % self.n
+
+    def clear(self):
+        """Remove all samples."""
+        self._pos = 0
+        self.n_total = 0
+
+    def flush(self):
+        """Does nothing (samples are only kept in memory)."""
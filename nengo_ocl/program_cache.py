@@ -0,0 +1,321 @@
+"""Caching of compiled OpenCL programs.
+
+Every ``plan_*`` function renders a kernel and compiles it. Compiling is by far the
+most expensive part of creating a plan, and the same kernels are compiled over and
+over again when the same (or a similar) model is built several times. The
+`.ProgramCache` avoids this by storing compiled programs both in memory (for the
+current process) and on disk (as device binaries, shared between processes).
+
+The default cache used by all plans can be configured with environment variables:
+
+``NENGO_OCL_PROGRAM_CACHE``
+    Set to ``0`` to disable program caching entirely.
+``NENGO_OCL_PROGRAM_CACHE_DIR``
+    Directory in which to store program binaries
+    (defaults to ``<nengo cache dir>/ocl_programs``).
+``NENGO_OCL_PROGRAM_CACHE_SIZE``
+    Maximum size of the on-disk cache, e.g. ``"512 MB"`` (defaults to ``"256 MB"``).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+import pyopencl as cl
+from nengo.cache import safe_makedirs, safe_remove, safe_stat
+from nengo.utils.cache import bytes2human, human2bytes
+from nengo.utils.paths import cache_dir as nengo_cache_dir
+
+logger = logging.getLogger(__name__)
+
+
+def device_key(device):
+    """Unique key for ``device`` (including its platform and driver versions)."""
+    h = hashlib.sha1()
+    for info in (
+        device.platform.name,
+        device.platform.version,
+        device.name,
+        device.version,
+        device.driver_version,
+        device.max_compute_units,
+    ):
+        h.update(str(info).encode("utf-8"))
+    return h.hexdigest()
+
+
+def atomic_dump(obj, path, serializer=pickle):
+    """Save ``obj`` to ``path`` with ``serializer.dump`` (`pickle` or `json`).
+
+    The object is written to a temporary file first, which then replaces ``path``,
+    so that readers never see partial files. Raises ``OSError`` if the file cannot
+    be written.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        if serializer is json:
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                json.dump(obj, fh)
+        else:
+            with os.fdopen(fd, "wb") as fh:
+                serializer.dump(obj, fh)
+        os.replace(tmppath, path)
+    except BaseException:
+        safe_remove(tmppath)
+        raise
+
+
+class ProgramCache:
+    """Cache of compiled OpenCL programs, keyed on source, device, and options.
+
+    Programs are first looked up in memory, then on disk. Programs found on disk are
+    rebuilt from their binaries, which is much faster than compiling the source.
+    Both layers are least-recently-used (LRU) caches: when a layer grows past its
+    limit, the entries that have gone unused the longest are evicted first.
+
+    Parameters
+    ----------
+    cache_dir : str or None
+        Directory in which to store program binaries. If None, programs are only
+        cached in memory.
+    max_size : int or str
+        Maximum size of the on-disk cache in bytes (strings like ``"256 MB"`` are
+        also accepted).
+    max_memory_items : int
+        Maximum number of programs to keep in memory.
+
+    Attributes
+    ----------
+    memory_hits : int
+        Number of programs found in the memory cache.
+    disk_hits : int
+        Number of programs built from binaries in the on-disk cache.
+    misses : int
+        Number of programs that had to be compiled from source.
+    """
+
+    _suffix = ".clbin"
+
+    def __init__(self, cache_dir=None, max_size="256 MB", max_memory_items=1024):
+        self.cache_dir = cache_dir
+        self.max_size = human2bytes(max_size) if isinstance(max_size, str) else max_size
+        self.max_memory_items = max_memory_items
+
+        self._memory = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.cache_dir is not None:
+            safe_makedirs(self.cache_dir)
+
+    def __str__(self):
+        return "%s(memory_hits=%d, disk_hits=%d, misses=%d)" % (
+            type(self).__name__,
+            self.memory_hits,
+            self.disk_hits,
+            self.misses,
+        )
+
+    @property
+    def hits(self):
+        """(int) Total number of programs found in either cache layer."""
+        return self.memory_hits + self.disk_hits
+
+    @staticmethod
+    def key(context, text, options=()):
+        """Unique key for a program built from ``text`` on ``context``."""
+        h = hashlib.sha1()
+        h.update(text.encode("utf-8"))
+        h.update(repr(tuple(options)).encode("utf-8"))
+        h.update(cl.VERSION_TEXT.encode("utf-8"))
+        for device in context.devices:
+            h.update(device_key(device).encode("utf-8"))
+        return h.hexdigest()
+
+    def build(self, context, text, options=()):
+        """Get the program for ``text`` from the cache, or build it.
+
+        Parameters
+        ----------
+        context : `pyopencl.Context`
+            Context on which to build the program.
+        text : str
+            Program source.
+        options : sequence of str
+            Build options passed to `pyopencl.Program.build`.
+
+        Returns
+        -------
+        `pyopencl.Program`
+            The built program.
+        """
+        options = tuple(options)
+        key = self.key(context, text, options)
+
+        mkey = (context.int_ptr, key)
+        program = self._memory.get(mkey, None)
+        if program is not None:
+            self._memory.move_to_end(mkey)
+            self.memory_hits += 1
+            return program
+
+        program = self._load(context, key, options)
+        if program is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            program = cl.Program(context, text).build(options=list(options))
+            self._save(program, key)
+
+        self._memory[mkey] = program
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+        return program
+
+    def clear(self):
+        """Remove all programs from the cache (both in memory and on disk)."""
+        self._memory.clear()
+        for path in self.get_files():
+            safe_remove(path)
+
+    def get_files(self):
+        """Paths of all program binaries in the on-disk cache."""
+        if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+            return []
+
+        return [
+            os.path.join(self.cache_dir, f)
+            for f in os.listdir(self.cache_dir)
+            if f.endswith(self._suffix)
+        ]
+
+    def get_size(self):
+        """Total size of the on-disk cache in bytes."""
+        stats = (safe_stat(path) for path in self.get_files())
+        return sum(stat.st_size for stat in stats if stat is not None)
+
+    def shrink(self, limit=None):
+        """Evict least-recently-used binaries until the disk cache is under ``limit``.
+
+        Parameters
+        ----------
+        limit : int or str, optional
+            Maximum size of the on-disk cache. Defaults to ``self.max_size``.
+        """
+        limit = self.max_size if limit is None else limit
+        if isinstance(limit, str):
+            limit = human2bytes(limit)
+
+        fileinfo = []
+        excess = -limit
+        for path in self.get_files():
+            stat = safe_stat(path)
+            if stat is not None:
+                excess += stat.st_size
+                fileinfo.append((stat.st_mtime, stat.st_size, path))
+
+        # remove the least recently used first (`mtime` is updated on each hit)
+        fileinfo.sort()
+        for _, size, path in fileinfo:
+            if excess <= 0:
+                break
+
+            excess -= size
+            safe_remove(path)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self._suffix)
+
+    def _load(self, context, key, options):
+        if self.cache_dir is None:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                binaries = pickle.load(fh)
+            program = cl.Program(context, context.devices, binaries)
+            program.build(options=list(options))
+        except FileNotFoundError:
+            return None
+        except Exception as e:  # pylint: disable=broad-except
+            logger.debug("Could not load cached program %r: %s", path, e)
+            safe_remove(path)
+            return None
+
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        return program
+
+    def _save(self, program, key):
+        if self.cache_dir is None:
+            return
+
+        binaries = program.get_info(cl.program_info.BINARIES)
+        if not all(binaries):
+            return  # some devices/platforms do not provide binaries
+
+        try:
+            atomic_dump([bytes(b) for b in binaries], self._path(key))
+        except OSError as e:
+            logger.debug("Could not save program to cache: %s", e)
+            return
+
+        if self.get_size() > self.max_size:
+            self.shrink()
+
+    def log_stats(self):
+        """Log the hit/miss counts and disk usage of the cache."""
+        logger.info(
+            "%s; disk usage %s",
+            self,
+            bytes2human(self.get_size()) if self.cache_dir is not None else "n/a",
+        )
+
+
+class NoProgramCache(ProgramCache):
+    """A program cache that does not cache anything (always compiles)."""
+
+    def build(self, context, text, options=()):
+        self.misses += 1
+        return cl.Program(context, text).build(options=list(options))
+
+
+_default_program_cache = None
+
+
+def get_default_program_cache():
+    """Get the program cache used by all plans, creating it if necessary."""
+    global _default_program_cache  # pylint: disable=global-statement
+    if _default_program_cache is None:
+        if int(os.getenv("NENGO_OCL_PROGRAM_CACHE", "1")):
+            _default_program_cache = ProgramCache(
+                cache_dir=os.getenv(
+                    "NENGO_OCL_PROGRAM_CACHE_DIR",
+                    os.path.join(nengo_cache_dir, "ocl_programs"),
+                ),
+                max_size=os.getenv("NENGO_OCL_PROGRAM_CACHE_SIZE", "256 MB"),
+            )
+        else:
+            _default_program_cache = NoProgramCache()
+
+    return _default_program_cache
+
+
+def set_default_program_cache(cache):
+    """Set the program cache used by all plans (None restores the default)."""
+    global _default_program_cache  # pylint: disable=global-statement
+    _default_program_cache = cache
+
+
+def build_program(context, text, options=()):
+    """Build ``text`` on ``context`` using the default program cache."""
+    return get_default_program_cache().build(context, text, options=options)
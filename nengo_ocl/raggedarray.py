@@ -234,3 +234,32 @@ class RaggedArray:
             self.names = self.names + tuple(names)
         else:
             self.names = self.names + tuple([""] * len(starts))
+
+    def align_regions(self, regions, n_regions, align):
+        """Move the arrays so that each region starts at a multiple of ``align``.
+
+        ``regions[i]`` is the region of array ``i``. The arrays must be contiguous
+        (as created by the constructor, without ``align``), and sorted by region.
+        Views must be added afterwards. Returns the ``(start, stop)`` of each region
+        in the buffer (each region has at least one element).
+        """
+        regions = np.asarray(regions)
+        assert len(regions) == len(self.starts) and (np.diff(regions) >= 0).all()
+        starts = self.starts.copy()
+        buf = np.zeros(0, dtype=self.dtype)
+        bounds = []
+        for r in range(n_regions):
+            items = np.flatnonzero(regions == r)
+            lo = self.starts[items[0]] if len(items) > 0 else 0
+            hi = self.starts[items[-1]] + self.sizes[items[-1]] if len(items) > 0 else 0
+            start = round_up(buf.size, align)
+            starts[items] += start - lo
+            bounds.append((start, start + max(hi - lo, 1)))
+            buf = np.concatenate(
+                [buf, np.zeros(bounds[-1][1] - buf.size, dtype=self.dtype)]
+            )
+            buf[start : start + hi - lo] = self.buf[lo:hi]
+
+        self.starts = starts
+        self.buf = buf
+        return bounds
@@ -0,0 +1,208 @@
+"""Device characterization and roofline analysis of plans.
+
+Plans know how many floating-point operations (``flops_per_call``) and bytes
+(``bw_per_call``) each call needs, and profiling measures how long calls take.
+To know how far each plan is from what the device can do, `.get_device_peaks`
+measures the peak memory bandwidth and floating-point throughput of a device with
+two small microbenchmarks. `.roofline` then compares each plan to the roofline
+``min(peak_flops, intensity * peak_bandwidth)``, classifies it as compute- or
+bandwidth-bound, and ranks plans by the time that could be saved by making them
+run at the roofline.
+
+Measured peaks are cached in memory and on disk, keyed by the device and driver.
+The on-disk cache can be configured with environment variables:
+
+``NENGO_OCL_DEVICE_CACHE_DIR``
+    Directory in which to store measured device peaks
+    (defaults to ``<nengo cache dir>/ocl_devices``).
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+import pyopencl as cl
+from mako.template import Template
+from nengo.cache import safe_makedirs, safe_remove
+from nengo.utils.paths import cache_dir as nengo_cache_dir
+
+from nengo_ocl.plan import PROFILING_ENABLE
+from nengo_ocl.program_cache import atomic_dump, build_program, device_key
+from nengo_ocl.utils import as_ascii
+
+logger = logging.getLogger(__name__)
+
+_peaks_source = """
+__kernel void copy(__global const float4 *x, __global float4 *y)
+{
+    const int i = get_global_id(0);
+    y[i] = x[i];
+}
+
+__kernel void multiply_add(__global float *y, const float a, const float b)
+{
+    // independent chains of multiply-adds, which the compiler cannot remove
+    float x0 = get_global_id(0), x1 = x0 + 1, x2 = x0 + 2, x3 = x0 + 3;
+    float x4 = x0 + 4, x5 = x0 + 5, x6 = x0 + 6, x7 = x0 + 7;
+    for (int k = 0; k < ${n_iters}; k++) {
+        x0 = x0 * a + b;  x1 = x1 * a + b;  x2 = x2 * a + b;  x3 = x3 * a + b;
+        x4 = x4 * a + b;  x5 = x5 * a + b;  x6 = x6 * a + b;  x7 = x7 * a + b;
+    }
+    y[get_global_id(0)] = x0 + x1 + x2 + x3 + x4 + x5 + x6 + x7;
+}
+"""
+
+_madd_iters = 256
+_madd_flops_per_item = 2 * 8 * _madd_iters + 7
+
+
+def _best_time(queue, kernel, gsize, args, repeats):
+    kernel.set_args(*args)
+    cl.enqueue_nd_range_kernel(queue, kernel, gsize, None).wait()  # warmup
+    times = []
+    for _ in range(repeats):
+        ev = cl.enqueue_nd_range_kernel(queue, kernel, gsize, None)
+        ev.wait()
+        times.append(1e-9 * (ev.profile.end - ev.profile.start))
+    return min(times)
+
+
+def measure_device_peaks(device, nbytes=32 * 1024 ** 2, repeats=5):
+    """Measure the peak bandwidth and floating-point throughput of ``device``.
+
+    Bandwidth is measured with a kernel that copies ``nbytes`` between two buffers
+    (counting both the reads and the writes), and throughput with a kernel of
+    independent single-precision multiply-adds. The best of ``repeats`` runs is
+    used.
+
+    Returns
+    -------
+    dict
+        ``"bandwidth"`` in bytes per second, and ``"flops"`` in floating-point
+        operations per second.
+    """
+    context = cl.Context([device])
+    queue = cl.CommandQueue(context, properties=PROFILING_ENABLE)
+    text = Template(_peaks_source, output_encoding="ascii").render(n_iters=_madd_iters)
+    program = build_program(context, as_ascii(text))
+
+    nbytes = int(min(nbytes, device.max_mem_alloc_size // 4)) // 16 * 16
+    x = cl.Buffer(context, cl.mem_flags.READ_ONLY, nbytes)
+    y = cl.Buffer(context, cl.mem_flags.WRITE_ONLY, nbytes)
+    cl.enqueue_fill_buffer(queue, x, np.float32(1), 0, nbytes)
+    t_copy = _best_time(queue, program.copy, (nbytes // 16,), [x, y], repeats)
+
+    n_items = device.max_compute_units * 16384
+    y = cl.Buffer(context, cl.mem_flags.WRITE_ONLY, 4 * n_items)
+    args = [y, np.float32(0.999), np.float32(0.001)]
+    t_madd = _best_time(queue, program.multiply_add, (n_items,), args, repeats)
+
+    return {
+        "bandwidth": 2 * nbytes / t_copy,
+        "flops": n_items * _madd_flops_per_item / t_madd,
+    }
+
+
+_device_peaks = {}
+
+
+def get_device_peaks(device, cache_dir=None):
+    """Get the measured peaks of ``device``, measuring them if necessary.
+
+    Peaks are looked up in memory, then in ``cache_dir`` (which defaults to the
+    ``NENGO_OCL_DEVICE_CACHE_DIR`` environment variable, or
+    ``<nengo cache dir>/ocl_devices``), and are only measured (with
+    `.measure_device_peaks`) if not found.
+    """
+    key = device_key(device)
+    if key in _device_peaks:
+        return _device_peaks[key]
+
+    if cache_dir is None:
+        cache_dir = os.getenv(
+            "NENGO_OCL_DEVICE_CACHE_DIR", os.path.join(nengo_cache_dir, "ocl_devices")
+        )
+    path = os.path.join(cache_dir, key + ".json")
+
+    try:
+        with open(path, encoding="utf-8") as fh:
+            peaks = json.load(fh)
+        peaks = {"bandwidth": float(peaks["bandwidth"]), "flops": float(peaks["flops"])}
+    except FileNotFoundError:
+        peaks = None
+    except Exception as e:  # pylint: disable=broad-except
+        logger.debug("Could not load device peaks %r: %s", path, e)
+        safe_remove(path)
+        peaks = None
+
+    if peaks is None:
+        logger.info("Measuring peaks of device %r", device.name)
+        peaks = measure_device_peaks(device)
+
+        safe_makedirs(cache_dir)
+        try:
+            atomic_dump(dict(peaks, device=device.name), path, serializer=json)
+        except OSError as e:
+            logger.debug("Could not save device peaks to cache: %s", e)
+
+    _device_peaks[key] = peaks
+    return peaks
+
+
+def roofline(plans, peaks):
+    """Compare profiled plans to the roofline of a device.
+
+    Parameters
+    ----------
+    plans : list of `.BasePlan`
+        Plans with profiling information (see ``Simulator(profiling=True)``).
+    peaks : dict
+        The ``"bandwidth"`` (bytes/s) and ``"flops"`` (flops/s) of the device
+        (see `.get_device_peaks`).
+
+    Returns
+    -------
+    list of dict
+        For each profiled plan with a known ``flops_per_call`` or ``bw_per_call``,
+        the ``plan``, the arithmetic ``intensity`` (flops per byte), whether it is
+        ``"compute"`` or ``"bandwidth"`` ``bound``, the achieved ``gflops`` and
+        ``gbps``, the ``efficiency`` (the time per call at the roofline, divided
+        by the measured time per call), and the ``headroom`` (the total time in
+        seconds that would be saved at the roofline). Sorted by decreasing
+        headroom.
+    """
+    ridge = peaks["flops"] / peaks["bandwidth"]
+
+    rows = []
+    for plan in plans:
+        flops, nbytes = plan.flops_per_call, plan.bw_per_call
+        if plan.n_calls == 0 or (flops is None and nbytes is None):
+            continue
+
+        t_call = plan.ctimes.mean
+        t_min = max(
+            0 if flops is None else flops / peaks["flops"],
+            0 if nbytes is None else nbytes / peaks["bandwidth"],
+        )
+        intensity = (
+            np.inf
+            if nbytes is None or nbytes == 0
+            else 0
+            if flops is None
+            else flops / nbytes
+        )
+        rows.append(
+            dict(
+                plan=plan,
+                intensity=intensity,
+                bound="compute" if intensity >= ridge else "bandwidth",
+                gflops=np.nan if flops is None else 1e-9 * flops / t_call,
+                gbps=np.nan if nbytes is None else 1e-9 * nbytes / t_call,
+                efficiency=t_min / t_call if t_call > 0 else np.nan,
+                headroom=max(plan.ctimes.sum - plan.n_calls * t_min, 0),
+            )
+        )
+
+    rows.sort(key=lambda row: row["headroom"], reverse=True)
+    return rows
@@ -3,10 +3,14 @@
 # pylint: disable=missing-class-docstring,missing-function-docstring
 
 import inspect
+import json
 import logging
 import os
+import queue
+import threading
+import time
 import warnings
-from collections import defaultdict
+from collections import defaultdict, deque
 from collections.abc import Mapping
 from io import StringIO
 
@@ -17,8 +21,8 @@ import numpy as np
 import pyopencl as cl
 from nengo.builder.builder import Model
 from nengo.builder.operator import Reset
-from nengo.builder.signal import SignalDict
-from nengo.cache import get_default_decoder_cache
+from nengo.builder.signal import Signal, SignalDict
+from nengo.cache import get_default_decoder_cache, safe_makedirs
 from nengo.exceptions import ReadonlyError, SimulatorClosed, ValidationError
 from nengo.simulator import SimulationData
 from nengo.utils.filter_design import ss2tf
@@ -28,7 +32,11 @@ from nengo.utils.stdlib import Timer, groupby
 
 from nengo_ocl.ast_conversion import OclFunction
 from nengo_ocl.builder import Builder
-from nengo_ocl.clra_gemv import plan_block_gemv, plan_sparse_dot_inc
+from nengo_ocl.clra_gemv import (
+    plan_bsr_dot_inc,
+    plan_dispatch_gemv,
+    plan_ragged_sparse_dot_inc,
+)
 from nengo_ocl.clra_nonlinearities import (
     create_rngs,
     get_dist_enums_params,
@@ -38,6 +46,7 @@ from nengo_ocl.clra_nonlinearities import (
     plan_copy,
     plan_direct,
     plan_elementwise_inc,
+    plan_fused_elementwise,
     plan_lif,
     plan_lif_rate,
     plan_linearfilter,
@@ -54,10 +63,27 @@ from nengo_ocl.clra_nonlinearities import (
     plan_whitenoise,
 )
 from nengo_ocl.clraggedarray import CLRaggedArray, to_device
-from nengo_ocl.operators import MultiDotInc, simplify_operators
-from nengo_ocl.plan import BasePlan, Plans, PythonPlan
-from nengo_ocl.planners import greedy_planner
+from nengo_ocl.operators import MultiDotInc, batch_operators, simplify_operators
+from nengo_ocl.plan import (
+    TRACE_LENGTH,
+    BasePlan,
+    DependencyPlans,
+    PartitionedPlans,
+    Plans,
+    PythonPlan,
+)
+from nengo_ocl.planners import (
+    FusedElementwise,
+    elementwise_term,
+    fuse_elementwise,
+    greedy_planner,
+    partition_operators,
+    plan_dependencies,
+)
+from nengo_ocl.probe_store import ProbeStore, RingProbeStore
+from nengo_ocl.program_cache import get_default_program_cache
 from nengo_ocl.raggedarray import RaggedArray
+from nengo_ocl.roofline import get_device_peaks, roofline
 from nengo_ocl.utils import HostSparseMatrix, get_closures, indent, split, stable_unique
 from nengo_ocl.version import (
     bad_nengo_versions,
@@ -67,6 +93,12 @@ from nengo_ocl.version import (
 
 logger = logging.getLogger(__name__)
 PROFILING_ENABLE = cl.command_queue_properties.PROFILING_ENABLE
+OUT_OF_ORDER_EXEC_MODE_ENABLE = (
+    cl.command_queue_properties.OUT_OF_ORDER_EXEC_MODE_ENABLE
+)
+
+_state_magic = b"NENGOOCL"  # identifies files written by `Simulator.save_state`
+_state_align = 64  # byte alignment of arrays in state files
 
 
 class ViewBuilder:
@@ -98,8 +130,11 @@ class ViewBuilder:
             # -- it is not a view, and not OK. All non-views should already be in `sidx`
             raise ValueError("can only append views of known signals", sig)
 
+        self.sidx[sig] = self._add_view(sig, self.sidx[sig.base])
+
+    def _add_view(self, sig, idx):
+        """Add a view like ``sig`` onto item ``idx``, and return its index."""
         assert sig.size and sig.ndim <= 2
-        idx = self.sidx[sig.base]
         shape0 = sig.shape[0] if sig.ndim > 0 else 1
         shape1 = sig.shape[1] if sig.ndim > 1 else 1
         self.starts.append(self.rarray.starts[idx] + sig.elemoffset)
@@ -108,7 +143,29 @@ class ViewBuilder:
         self.stride0s.append(sig.elemstrides[0] if shape0 > 1 else 1)
         self.stride1s.append(sig.elemstrides[1] if shape1 > 1 else 1)
         self.names.append(getattr(sig, "name", ""))
-        self.sidx[sig] = len(self.sidx)
+        return len(self.rarray.starts) + len(self.starts) - 1
+
+    def shadow_views(self, sigs, shadows):
+        """Add views like ``sigs`` onto the copies of their bases in ``shadows``.
+
+        Returns a map from each signal in ``sigs`` whose base is in ``shadows``
+        to the index of the corresponding view of the copy.
+        """
+        sidx = {}
+        for sig in sigs:
+            if sig in sidx or sig.base not in shadows:
+                continue
+            idx = self.sidx[shadows[sig.base]]
+            sidx[sig] = self._add_view(sig, idx) if sig.is_view else idx
+        return sidx
+
+    def op_signals(self, op):
+        """All signals used by ``op``, including the views used by MultiDotInc."""
+        sigs = list(op.all_signals)
+        if op in self._A_views:
+            sigs.extend(self._A_views[op] + self._X_views[op])
+            sigs.extend(v for v in self._YYB_views[op] if v is not None)
+        return sigs
 
     def add_views_to(self, rarray):
         rarray.add_views(
@@ -153,17 +210,64 @@ class Simulator:
         OpenCL context specifying which device(s) to run on. By default, we
         will create a context by calling `pyopencl.create_some_context`
         and use this context as the default for all subsequent instances.
-    n_prealloc_probes : int (optional)
+    n_prealloc_probes : int or "auto" (optional)
         Number of timesteps to buffer when probing. Larger numbers mean less
         data transfer with the device (faster), but use more device memory.
+        Probe buffers are double-buffered, so that the host reads one buffer
+        while the device fills the other. If ``"auto"`` (default), the buffers
+        grow as needed to fit each run, up to 1024 samples (and limited by the
+        available device memory), so that longer runs alternate between buffers.
     profiling : boolean (optional)
         If ``True``, ``print_profiling()`` will show profiling information.
         By default, will check the environment variable ``NENGO_OCL_PROFILING``
+    profiling_every : int (optional)
+        When profiling, only profile every ``profiling_every``-th step. The other
+        steps run at full speed, and statistics are kept in constant memory, so
+        profiling can stay enabled for long runs. By default, will check the
+        environment variable ``NENGO_OCL_PROFILING_EVERY`` (default 1).
     if_python_code : 'none' | 'warn' | 'error'
         How the simulator should react if a Python function cannot be converted
         to OpenCL code.
     planner : callable
         A function to plan operator order. See ``nengo_ocl.planners``.
+    progress_bar : bool or `nengo.utils.progress.ProgressBar` (optional)
+        Progress bar for displaying build and simulation progress.
+    probe_dir : str (optional)
+        Directory in which to store probe data, as memory-mapped ``.npy`` files
+        (``probe0.npy``, ``probe1.npy``, etc., in the order of ``model.probes``).
+        This allows long runs with large probes without keeping all probe data in
+        host memory. By default, probe data is stored in memory.
+    probe_keep_last : int or dict (optional)
+        Only keep the last ``probe_keep_last`` samples of each probe, so that memory
+        use stays constant for open-ended simulations. A dict maps individual probes
+        to the number of samples to keep (probes not in the dict keep all samples).
+        ``sim.data[probe]`` is then a view of the current window of samples, which
+        is overwritten as the simulation continues. Only the kept samples are read
+        from the device. Cannot be used with ``probe_dir``.
+    n_partitions : int (optional)
+        Split the model into this many partitions, which run concurrently on
+        separate command queues. Partitions are assigned to the devices in
+        ``context`` in turn, so to use several devices (e.g. sub-devices created
+        with `pyopencl.Device.create_sub_devices`), create a context containing all
+        of them. Each partition uses its own sub-buffer of the signal data, and
+        partitions copy the signals they need from each other once per step. See
+        `nengo_ocl.planners.partition_operators`.
+    batch_size : int (optional)
+        Simulate this many independent copies of the model at once. Each copy has
+        its own state (e.g. neuron voltages and filter states), while connection
+        weights and other constant signals are shared. Copies of the same operator
+        run in the same kernel, so a batch runs much faster than the same number
+        of separate simulators. Probe data then has shape
+        ``(batch_size, n_samples) + probe shape``. Nodes and processes are run
+        once for each copy; processes with a fixed seed give the same values in
+        all copies. See `nengo_ocl.operators.batch_operators`.
+    out_of_order : bool (optional)
+        If ``True``, each kernel waits only for the kernels it depends on (as
+        found by `nengo_ocl.planners.plan_dependencies`), rather than for all
+        kernels before it. Kernels are enqueued on an out-of-order command queue
+        (or, if the device does not support one, spread over several queues), so
+        that independent kernels can run concurrently on devices that support it.
+        Cannot be combined with ``n_partitions``.
     """
 
     # --- Store the result of create_some_context so we don't recreate it
@@ -182,11 +286,17 @@ class Simulator:
         seed=None,
         model=None,
         context=None,
-        n_prealloc_probes=32,
+        n_prealloc_probes="auto",
         profiling=None,
+        profiling_every=None,
         if_python_code="none",
         planner=greedy_planner,
         progress_bar=True,
+        probe_dir=None,
+        probe_keep_last=None,
+        n_partitions=1,
+        batch_size=None,
+        out_of_order=False,
     ):
         # --- create these first since they are used in __del__
         self.closed = False
@@ -214,17 +324,66 @@ class Simulator:
             profiling = int(os.getenv("NENGO_OCL_PROFILING", "0"))
         self.context = Simulator.some_context if context is None else context
         self.profiling = profiling
+        if profiling_every is None:
+            profiling_every = int(os.getenv("NENGO_OCL_PROFILING_EVERY", "1"))
+        if not (isinstance(profiling_every, int) and profiling_every >= 1):
+            raise ValueError(
+                "%r not a valid value for `profiling_every`" % profiling_every
+            )
+        self.profiling_every = profiling_every
+        # (start, end, first step, last step, nbytes) of the last probe transfers
+        self._probe_trace = deque(maxlen=TRACE_LENGTH)
         self.queue = cl.CommandQueue(
             self.context, properties=PROFILING_ENABLE if self.profiling else 0
         )
+        self._probe_queue = cl.CommandQueue(self.context, device=self.queue.device)
+        self._host_queue = cl.CommandQueue(self.context, device=self.queue.device)
+
+        if not (isinstance(n_partitions, int) and n_partitions >= 1):
+            raise ValueError("%r not a valid value for `n_partitions`" % n_partitions)
+        self.n_partitions = n_partitions
+        devices = self.context.devices
+        self._partition_queues = [self.queue] + [
+            cl.CommandQueue(
+                self.context,
+                device=devices[p % len(devices)],
+                properties=PROFILING_ENABLE if self.profiling else 0,
+            )
+            for p in range(1, n_partitions)
+        ]
+
+        if out_of_order and n_partitions > 1:
+            raise ValueError("`out_of_order` cannot be used with `n_partitions`")
+        self.out_of_order = out_of_order
+        self._dispatch_queues = []  # queues used by out-of-order plans
+
+        if batch_size is not None and not (
+            isinstance(batch_size, int) and batch_size >= 1
+        ):
+            raise ValueError("%r not a valid value for `batch_size`" % batch_size)
+        self.batch_size = batch_size
 
         if if_python_code not in ["none", "warn", "error"]:
             raise ValueError(
                 "%r not a valid value for `if_python_code`" % if_python_code
             )
         self.if_python_code = if_python_code
+        if n_prealloc_probes != "auto" and not (
+            isinstance(n_prealloc_probes, int) and n_prealloc_probes >= 1
+        ):
+            raise ValueError(
+                "%r not a valid value for `n_prealloc_probes`" % n_prealloc_probes
+            )
         self.n_prealloc_probes = n_prealloc_probes
         self.progress_bar = progress_bar
+        if probe_dir is not None and probe_keep_last is not None:
+            raise ValueError("Cannot use both `probe_dir` and `probe_keep_last`")
+        self.probe_dir = probe_dir
+        self.probe_keep_last = probe_keep_last
+        self._probe_callbacks = {}
+        self._callback_thread = None
+        self._callback_queue = None
+        self._callback_errors = []
 
         # --- Nengo build
         with Timer() as nengo_timer:
@@ -248,6 +407,17 @@ class Simulator:
         with Timer() as planner_timer:
             all_operators = list(self.model.operators)
 
+            # replicate the model state for each element of the batch
+            self._probe_signals = {
+                probe: [self.model.sig[probe]["in"]] for probe in self.model.probes
+            }
+            if batch_size is not None:
+                all_operators, get_copies = batch_operators(all_operators, batch_size)
+                self._probe_signals = {
+                    probe: get_copies(sigs[0])
+                    for probe, sigs in self._probe_signals.items()
+                }
+
             # remove unneeded operators
             operators = simplify_operators(all_operators)
 
@@ -255,14 +425,23 @@ class Simulator:
             operators = list(map(MultiDotInc.convert_to, operators))
             operators = MultiDotInc.compress(operators)
 
+            # split into partitions, which exchange some signals once per step
+            if n_partitions > 1:
+                partitions, exchanged, private = partition_operators(
+                    operators, n_partitions
+                )
+            else:
+                partitions, exchanged, private = [operators], [[]], [[]]
+
             # plan the order of operations, combining where appropriate
-            op_groups = planner(operators)
-            assert (
-                len([typ for typ, _ in op_groups if typ is Reset]) < 2
-            ), "All resets not planned together"
+            partition_groups = [planner(ops) for ops in partitions]
+            for op_groups in partition_groups:
+                assert (
+                    len([typ for typ, _ in op_groups if typ is Reset]) < 2
+                ), "All resets not planned together"
 
             self.operators = operators
-            self.op_groups = op_groups
+            self.op_groups = [group for groups in partition_groups for group in groups]
 
         logger.info("Planning in %0.3f s", planner_timer.duration)
 
@@ -278,6 +457,17 @@ class Simulator:
             for op in all_operators:
                 op.init_signals(sigdict)
 
+            # each partition has its own copy of signals written by other partitions
+            shadows = []  # for each partition, map from bases to their copies
+            for p, bases in enumerate(zip(exchanged, private)):
+                shadows.append({})
+                for base in stable_unique(b for bb in bases for b in bb):
+                    assert not base.sparse
+                    shadow = Signal(sigdict[base], name="%s[%d]" % (base.name, p))
+                    sigdict.init(shadow)
+                    shadows[p][base] = shadow
+                    all_bases.append(shadow)
+
             # separate dense and sparse signals
             sparse_signals = [s for s in all_signals if s.sparse]
             if any(s.is_view for s in sparse_signals):
@@ -286,6 +476,10 @@ class Simulator:
             dense_bases = [sig for sig in all_bases if not sig.sparse]
             sparse_bases = [sig for sig in all_bases if sig.sparse]
 
+            # each partition keeps the signals it uses in its own region of the buffer
+            region = self._partition_regions(partitions, shadows)
+            dense_bases.sort(key=lambda base: region.get(base, 0))
+
             # --- create dense data on host and add views
             dense_data = []  # the actual arrays (from `sigdict`) for each dense base
 
@@ -306,14 +500,35 @@ class Simulator:
                 dtype=np.float32,
             )
 
+            if n_partitions > 1:
+                regions = dense_data.align_regions(
+                    [region.get(base, 0) for base in dense_bases],
+                    n_partitions,
+                    max(d.mem_base_addr_align for d in self.context.devices)
+                    // (8 * dense_data.dtype.itemsize),
+                )
+
             view_builder = ViewBuilder(dense_bases, dense_data, is_sparse=False)
             view_builder.setup_views(operators)
             for probe in self.model.probes:
-                view_builder.append_view(self.model.sig[probe]["in"])
+                for sig in self._probe_signals[probe]:
+                    view_builder.append_view(sig)
+            partition_sidx = [
+                view_builder.shadow_views(
+                    [s for op in ops for s in view_builder.op_signals(op)], shadow
+                )
+                for ops, shadow in zip(partitions, shadows)
+            ]
             view_builder.add_views_to(dense_data)
 
             self.all_bases = dense_bases
             self.sidx = {k: np.int32(v) for k, v in view_builder.sidx.items()}
+            partition_sidx = [
+                {**self.sidx, **{k: np.int32(v) for k, v in sidx.items()}}
+                if sidx
+                else self.sidx
+                for sidx in partition_sidx
+            ]
             self._A_views = view_builder._A_views
             self._X_views = view_builder._X_views
             self._YYB_views = view_builder._YYB_views
@@ -326,6 +541,14 @@ class Simulator:
 
             # Copy data to device
             self.all_data = CLRaggedArray(self.queue, dense_data)
+            self._partition_data = (
+                [
+                    self.all_data.get_sub_region(start, stop, queue)
+                    for (start, stop), queue in zip(regions, self._partition_queues)
+                ]
+                if n_partitions > 1
+                else [self.all_data]
+            )
             self.sparse_data = sparse_data  # sparse data currently handled on host
 
             # Provide an interface to simulation data (build output and probe data)
@@ -345,24 +568,118 @@ class Simulator:
         self.rng = np.random.RandomState(self.seed)
 
         # --- create list of plans
-        self._raggedarrays_to_reset = {}
+        self._raggedarrays_to_reset = []
         self._cl_rngs = {}
+        self._cl_state_arrays = []  # other device state (e.g. buffer positions)
         self._python_rngs = {}
 
-        plans = []
+        partition_plans = []
         with Timer() as plans_timer:
-            for op_type, op_list in op_groups:
-                plans.extend(self._plan_op_group(op_type, op_list))
-            plans.extend(self._plan_probes())
+            # plan each partition on its own queue and buffer, using its copies of
+            # signals
+            all_data, sidx = self.all_data, self.sidx
+            for p, op_groups in enumerate(partition_groups):
+                self.queue = self._partition_queues[p]
+                self.all_data = self._partition_data[p]
+                self.sidx = partition_sidx[p]
+
+                # fuse adjacent elementwise op groups into single kernels
+                if int(os.getenv("NENGO_OCL_FUSE_ELEMENTWISE", "1")):
+                    op_groups = fuse_elementwise(op_groups)
+
+                plans = []
+                accesses = []  # signals read and written by each plan
+                for op_type, op_list in op_groups:
+                    group_plans = self._plan_op_group(op_type, op_list)
+                    plans.extend(group_plans)
+                    accesses.extend(
+                        [self._group_accesses(op_list, len(accesses))]
+                        * len(group_plans)
+                    )
+                partition_plans.append(plans)
+
+            self.queue = self._partition_queues[0]
+            self.all_data, self.sidx = all_data, sidx
+
+            exchange_plans = self._plan_exchange(exchanged, shadows)
+            probe_plans = self._plan_probes(
+                self._initial_probe_depth
+                if self.n_prealloc_probes == "auto"
+                else self.n_prealloc_probes
+            )
 
         logger.info("Plans in %0.3f s", plans_timer.duration)
+        get_default_program_cache().log_stats()
 
         # -- create object to execute list of plans
-        self._plans = Plans(plans, self.profiling)
+        if n_partitions > 1:
+            self._plans = PartitionedPlans(
+                exchange_plans,
+                partition_plans,
+                probe_plans,
+                self.queue,
+                self.profiling,
+                profiling_every=self.profiling_every,
+            )
+        else:
+            probe_bases = {
+                sig.base for sigs in self._probe_signals.values() for sig in sigs
+            }
+            accesses.extend([(probe_bases, set())] * len(probe_plans))
+            dependencies = plan_dependencies(accesses)
+            if out_of_order:
+                self._dispatch_queues = self._create_dispatch_queues()
+                self._plans = DependencyPlans(
+                    partition_plans[0] + probe_plans,
+                    dependencies,
+                    self._dispatch_queues,
+                    self.profiling,
+                    profiling_every=self.profiling_every,
+                )
+            else:
+                self._plans = Plans(
+                    partition_plans[0] + probe_plans,
+                    self.profiling,
+                    dependencies=dependencies,
+                    profiling_every=self.profiling_every,
+                )
+
+        # -- keep a copy of the initial device state on the device, for `reset`
+        self._initial_state = {name: a.copy() for name, a in self._state_arrays()}
+        self.queue.finish()
 
         self.rng = None  # all randomness set, should no longer be used
+
+        # -- create contiguous stores for probe data
+        if self.probe_dir is not None:
+            safe_makedirs(self.probe_dir)
+        self._probe_stores = {
+            probe: self._make_probe_store(i, probe)
+            for i, probe in enumerate(self.model.probes)
+        }
         self._reset_probes()  # clears probes from previous model builds
 
+    def _probe_shape(self, probe):
+        """Shape of one sample of ``probe``, including the batch axis (if any)."""
+        shape = self.model.sig[probe]["in"].shape
+        return shape if self.batch_size is None else (self.batch_size,) + shape
+
+    def _make_probe_store(self, i, probe):
+        shape = self._probe_shape(probe)
+        if isinstance(self.probe_keep_last, dict):
+            keep_last = self.probe_keep_last.get(probe, None)
+        else:
+            keep_last = self.probe_keep_last
+
+        if keep_last is not None:
+            return RingProbeStore(shape, keep_last)
+        elif self.probe_dir is not None:
+            return ProbeStore(
+                shape, path=os.path.join(self.probe_dir, "probe%d.npy" % i)
+            )
+        else:
+            return ProbeStore(shape)
+
     def _create_cl_rngs(self, seeds):
         seeds = [self.rng.randint(npext.maxint) if s is None else s for s in seeds]
         cl_rngs = create_rngs(self.queue, len(seeds))
@@ -371,9 +688,7 @@ class Simulator:
         return cl_rngs
 
     def _reset_rngs(self):
-        for rngs, seeds in self._cl_rngs.items():
-            init_rngs(self.queue, rngs, seeds)
-
+        # device RNG states are reset with the rest of the device state in `reset`
         for rng, state in self._python_rngs.items():
             rng.set_state(state)
 
@@ -470,14 +785,79 @@ class Simulator:
 
         return Accessor()
 
+    # --- Probe callbacks
+    def add_probe_callback(self, probe, callback):
+        """Call ``callback`` with each block of data read for ``probe``.
+
+        Probe data is read from the device in blocks of several timesteps while the
+        simulation runs. Callbacks are called on a background thread, so that they
+        do not delay the simulation, in the order that blocks are read.
+
+        Parameters
+        ----------
+        probe : `nengo.Probe`
+            The probe whose data to pass to ``callback``.
+        callback : callable
+            Called as ``callback(t, data)``, where ``data`` is a read-only array of
+            the samples in the block (with shape ``(n_samples,) + probe shape``,
+            or ``(batch_size, n_samples) + probe shape`` if ``batch_size`` is
+            given) and ``t`` is an array with the time of each sample.
+        """
+        if probe not in self._probe_stores:
+            raise ValidationError("%s is not in this model" % probe, attr="probe")
+
+        self._probe_callbacks.setdefault(probe, []).append(callback)
+        if self._callback_thread is None:
+            self._callback_queue = queue.Queue()
+            self._callback_thread = threading.Thread(
+                target=self._run_probe_callbacks,
+                args=(self._callback_queue,),
+                name="nengo_ocl probe callbacks",
+                daemon=True,
+            )
+            self._callback_thread.start()
+
+    def remove_probe_callback(self, probe, callback):
+        """Stop calling ``callback`` for ``probe``."""
+        self._probe_callbacks[probe].remove(callback)
+
+    def wait_for_probe_callbacks(self):
+        """Wait until callbacks have been called for all data read so far.
+
+        If a callback raised an error, it is raised here (and all following data
+        is still passed to the callbacks).
+        """
+        if self._callback_thread is not None:
+            self._callback_queue.join()
+
+        if self._callback_errors:
+            error = self._callback_errors.pop(0)
+            self._callback_errors.clear()
+            raise error
+
+    def _run_probe_callbacks(self, callback_queue):
+        while True:
+            item = callback_queue.get()
+            try:
+                if item is None:
+                    return
+                callback, t, data = item
+                callback(t, data)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception("Error in probe callback")
+                self._callback_errors.append(e)
+            finally:
+                callback_queue.task_done()
+
     # --- Simulation functions (see ``nengo.Simulator`` for interface)
     def clear_probes(self):
         """Clear all probe histories.
 
         .. versionadded:: 2.0.0
         """
-        for probe in self.model.probes:
-            self._probe_outputs[probe] = []
+        for probe, store in self._probe_stores.items():
+            store.clear()
+            self._probe_outputs[probe] = self._swap_batch_axis(store.data)
         self.data.reset()  # clear probe cache
 
     def close(self):
@@ -487,37 +867,139 @@ class Simulator:
         `.Simulator.step`, and `.Simulator.reset` on a closed simulator raises
         a `nengo.exceptions.SimulatorClosed` exception.
         """
+        for store in getattr(self, "_probe_stores", {}).values():
+            store.flush()
+
+        if getattr(self, "_callback_thread", None) is not None:
+            self._callback_queue.put(None)  # stop the thread when the queue is done
+            self._callback_thread.join()
+            self._callback_thread = None
+
         self.closed = True
         self.context = None
         self.queue = None
+        self._probe_queue = None
+        self._host_queue = None
+        self._partition_queues = None
+        self._dispatch_queues = None
         self.all_data = None
+        self._partition_data = None
+        if getattr(self, "_plans", None) is not None:
+            self._plans.close()
         self._plans = None
         self._raggedarrays_to_reset = None
         self._cl_rngs = None
+        self._cl_state_arrays = None
         self._cl_probe_plan = None
+        self._initial_state = None
 
-    def _probe(self):
-        """Copy all probed signals to buffers."""
-        self._probe_step_time()
+    def _enqueue_probe_read(self, wait_for, steps):
+        """Start reading the current probe bank, and switch to the next bank.
 
+        The buffer positions are read on a separate queue after the events in
+        ``wait_for``, so the device can already fill the next bank. ``steps`` are
+        the (1-based) timesteps simulated into this bank. Returns the arguments
+        for `._probe`, which reads and stores the buffered data.
+        """
         plan = self._cl_probe_plan
-        if plan is None:
-            return  # nothing to probe
+        bank = plan.bank
+
+        # keep the copy event, since deleting it waits for the copy (without
+        # releasing the GIL, which host threads running Python plans may need)
+        bufpositions = np.zeros(len(plan.cl_bufpositions), dtype=np.int32)
+        read = cl.enqueue_copy(
+            self._probe_queue,
+            bufpositions,
+            plan.cl_bufpositions.data,
+            wait_for=wait_for,
+            is_blocking=False,
+        )
+        fill = cl.enqueue_fill_buffer(
+            self._probe_queue,
+            plan.cl_bufpositions.data,
+            np.int32(0),
+            0,
+            bufpositions.nbytes,
+        )
+        self._probe_queue.flush()
+
+        plan.set_bank((bank + 1) % len(plan.banks))
+        self._plans.invalidate()  # the probe plan now uses a different kernel
+        return bank, bufpositions, [read, fill], steps
+
+    def _probe(self, bank, bufpositions, events, steps):
+        """Copy the probe data buffered in ``bank`` into the probe outputs."""
+        cl.wait_for_events(events)
+
+        # only transfer the rows that have been filled, and that will be kept
+        Yra = self._cl_probe_plan.banks[bank][2]
+        skip_rows = self._probe_skip_rows(bufpositions)
+        t0 = time.perf_counter_ns()
+        Y, offsets, done = Yra.get_rows(
+            bufpositions, queue=self._probe_queue, skip_rows=skip_rows
+        )
+        if self.profiling:  # probe transfers are cheap to time, so always profiled
+            self._probe_trace.append(
+                (t0, time.perf_counter_ns(), steps[0], steps[-1], Y.nbytes)
+            )
+
+        # the device must not write to this bank again until it has been read
+        self._probe_bank_events[bank] = [done]
 
-        self.queue.finish()
-        bufpositions = plan.cl_bufpositions.get()
         for i, probe in enumerate(self.model.probes):
+            # the buffers of all copies of a probe (one per batch element) are
+            # adjacent, and all copies have the same number of samples
+            batch = len(self._probe_signals[probe])
+            batch_shape = () if self.batch_size is None else (batch,)
             shape = self.model.sig[probe]["in"].shape
-            n_buffered = bufpositions[i]
+            n_buffered = bufpositions[i * batch]
+            n_skipped = skip_rows[i * batch]
             if n_buffered:
-                # XXX: this syntax retrieves *ALL* of Y from the device
-                #      because the :n_buffered only works on the ndarray
-                #      *after* it has been transferred.
-                raw = plan.Y[i][:n_buffered]
-                shaped = raw.reshape((n_buffered,) + shape)
-                self._probe_outputs[probe].extend(shaped)
-        plan.cl_bufpositions.fill(0)
-        self.queue.finish()
+                raw = Y[offsets[i * batch] : offsets[(i + 1) * batch]]
+                shaped = raw.reshape(batch_shape + (n_buffered - n_skipped,) + shape)
+                store = self._probe_stores[probe]
+                if n_skipped:
+                    store.append(self._swap_batch_axis(shaped), n_skipped=n_skipped)
+                else:
+                    store.append(self._swap_batch_axis(shaped))
+                self._probe_outputs[probe] = self._swap_batch_axis(store.data)
+
+                if self._probe_callbacks.get(probe):
+                    # same sample times as `self.trange`
+                    sample_every = probe.sample_every
+                    period = 1 if sample_every is None else sample_every / self.dt
+                    t = self.dt * steps[steps % period < 1]
+                    assert len(t) == n_buffered
+                    shaped.setflags(write=False)
+                    for callback in self._probe_callbacks[probe]:
+                        self._callback_queue.put((callback, t, shaped))
+
+    def _probe_skip_rows(self, bufpositions):
+        """Number of leading rows of each probe buffer that need not be read.
+
+        Probes that only keep their last samples (see ``probe_keep_last``) do not
+        need older samples, unless they have callbacks.
+        """
+        skip_rows = []
+        for probe in self.model.probes:
+            store = self._probe_stores[probe]
+            n_buffered = bufpositions[len(skip_rows)]
+            n_skipped = (
+                max(n_buffered - store.capacity, 0)
+                if isinstance(store, RingProbeStore)
+                and not self._probe_callbacks.get(probe)
+                else 0
+            )
+            skip_rows.extend([n_skipped] * len(self._probe_signals[probe]))
+        return np.array(skip_rows, dtype=bufpositions.dtype)
+
+    def _swap_batch_axis(self, data):
+        """Swap the batch and sample axes of probe data (if batched).
+
+        Stores hold one sample of all batch elements at a time, while probe
+        outputs have the batch axis first.
+        """
+        return data if self.batch_size is None else np.moveaxis(data, 0, 1)
 
     def _probe_step_time(self):
         self._n_steps = self.signals[self.model.step].item()
@@ -525,10 +1007,16 @@ class Simulator:
 
     def _reset_probes(self):
         if self._cl_probe_plan is not None:
-            self._cl_probe_plan.cl_bufpositions.fill(0)
-
-        for probe in self.model.probes:
-            self._probe_outputs[probe] = []
+            for _, cl_bufpositions, _, _ in self._cl_probe_plan.banks:
+                cl_bufpositions.fill(0)
+            self._cl_probe_plan.set_bank(0)
+            self._plans.invalidate()
+            self.queue.finish()
+        self._clear_probe_bank_events()
+
+        for probe, store in self._probe_stores.items():
+            store.clear()
+            self._probe_outputs[probe] = self._swap_batch_axis(store.data)
         self.data.reset()
 
         self._probe_step_time()
@@ -548,20 +1036,162 @@ class Simulator:
         if seed is not None:
             raise NotImplementedError("Seed changing not implemented")
 
-        # reset signals
-        for base in self.all_bases:
-            # TODO: copy all data on at once
-            if not base.readonly:
-                self.all_data[self.sidx[base]] = base.initial_value
-
-        for clra, ra in self._raggedarrays_to_reset.items():
-            # TODO: copy all data on at once
-            for i, _ in enumerate(clra):
-                clra[i] = ra[i]
+        # reset signals, RNG states, and filter buffers with one copy per buffer
+        for name, a in self._state_arrays():
+            initial = self._initial_state[name]
+            cl.enqueue_copy(
+                self.queue,
+                a.base_data,
+                initial.base_data,
+                byte_count=a.nbytes,
+                src_offset=initial.offset,
+                dst_offset=a.offset,
+            )
+        self.queue.finish()
 
         self._reset_rngs()
         self._reset_probes()
 
+    def _state_arrays(self):
+        """Device arrays holding the simulator state, as (name, array) pairs."""
+        arrays = [("all_data", self.all_data.cl_buf)]
+        arrays.extend(
+            ("rngs%d" % i, rngs.cl_buf) for i, rngs in enumerate(self._cl_rngs)
+        )
+        arrays.extend(
+            ("buffer%d" % i, clra.cl_buf)
+            for i, clra in enumerate(self._raggedarrays_to_reset)
+        )
+        arrays.extend(("state%d" % i, a) for i, a in enumerate(self._cl_state_arrays))
+        if self._cl_probe_plan is not None:
+            arrays.append(("probe_countdowns", self._cl_probe_plan.cl_countdowns))
+        return [(name, a) for name, a in arrays if a.size > 0]
+
+    def save_state(self, path):
+        """Save the current simulator state to a file.
+
+        The file holds the signals, random number generator states, and filter
+        buffers on the device, as well as the probe data collected so far. It can
+        be loaded into any simulator built from the same model with `.load_state`.
+
+        Each device buffer is copied directly into a memory-mapped file, in one
+        transfer per buffer. The state of Python functions run on the host (e.g.
+        nodes that could not be converted to OpenCL) is not saved.
+
+        Parameters
+        ----------
+        path : str
+            Path of the file to write.
+        """
+        if self.closed:
+            raise SimulatorClosed("Cannot save state of closed Simulator.")
+
+        arrays = [(name, a.dtype, a.shape) for name, a in self._state_arrays()]
+        probe_data = [self._probe_stores[probe].data for probe in self.model.probes]
+        arrays.extend(
+            ("probe%d" % i, x.dtype, x.shape) for i, x in enumerate(probe_data)
+        )
+
+        # --- header, followed by each array (aligned so they can be memory-mapped)
+        entries = []
+        offset = 0
+        for name, dtype, shape in arrays:
+            offset = -(-offset // _state_align) * _state_align
+            entries.append(dict(name=name, dtype=np.dtype(dtype).str, shape=shape))
+            entries[-1]["offset"] = offset
+            offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        header = json.dumps(dict(version=1, arrays=entries)).encode("utf-8")
+        data_start = -(-(len(_state_magic) + 8 + len(header)) // 4096) * 4096
+        with open(path, "wb") as fh:
+            fh.write(_state_magic)
+            fh.write(np.uint64(len(header)).tobytes())
+            fh.write(header)
+            fh.truncate(data_start + offset)
+
+        if offset == 0:
+            return
+
+        mm = np.memmap(path, dtype=np.uint8, mode="r+", offset=data_start)
+        for entry, (name, a) in zip(entries, self._state_arrays()):
+            assert entry["name"] == name
+            start = entry["offset"]
+            cl.enqueue_copy(
+                self.queue,
+                mm[start : start + a.nbytes],
+                a.base_data,
+                src_offset=a.offset,
+                is_blocking=False,
+            )
+        for entry, x in zip(entries[len(entries) - len(probe_data) :], probe_data):
+            start = entry["offset"]
+            mm[start : start + x.nbytes] = x.view(np.uint8).ravel()
+        self.queue.finish()
+        mm.flush()
+        del mm
+
+    def load_state(self, path):
+        """Load a simulator state saved with `.save_state`.
+
+        The simulator must have been built from the same model as the one that
+        saved the state. Each device buffer is uploaded in one transfer.
+
+        Parameters
+        ----------
+        path : str
+            Path of the file to read.
+        """
+        if self.closed:
+            raise SimulatorClosed("Cannot load state into closed Simulator.")
+
+        with open(path, "rb") as fh:
+            if fh.read(len(_state_magic)) != _state_magic:
+                raise ValueError("%r is not a simulator state file" % (path,))
+            header_len = int(np.frombuffer(fh.read(8), dtype=np.uint64)[0])
+            header = json.loads(fh.read(header_len).decode("utf-8"))
+        data_start = -(-(len(_state_magic) + 8 + header_len) // 4096) * 4096
+
+        entries = {entry["name"]: entry for entry in header["arrays"]}
+        state_arrays = self._state_arrays()
+        n_probes = len(self.model.probes)
+        if len(entries) != len(state_arrays) + n_probes or any(
+            name not in entries
+            or np.dtype(entries[name]["dtype"]) != a.dtype
+            or tuple(entries[name]["shape"]) != a.shape
+            for name, a in state_arrays
+        ):
+            raise ValueError(
+                "State in %r does not match the model of this simulator" % (path,)
+            )
+
+        def get(mm, entry):
+            dtype = np.dtype(entry["dtype"])
+            start = entry["offset"]
+            size = int(np.prod(entry["shape"])) * dtype.itemsize
+            return mm[start : start + size].view(dtype).reshape(entry["shape"])
+
+        mm = np.memmap(path, dtype=np.uint8, mode="r", offset=data_start)
+        for name, a in state_arrays:
+            cl.enqueue_copy(
+                self.queue,
+                a.base_data,
+                get(mm, entries[name]),
+                dst_offset=a.offset,
+                is_blocking=False,
+            )
+
+        for i, probe in enumerate(self.model.probes):
+            store = self._probe_stores[probe]
+            store.clear()
+            store.append(get(mm, entries["probe%d" % i]))
+            self._probe_outputs[probe] = self._swap_batch_axis(store.data)
+        self.data.reset()
+
+        self.queue.finish()
+        del mm
+
+        self._probe_step_time()
+
     def run(self, time_in_seconds, progress_bar=None):
         """Simulate for the given length of time.
 
@@ -632,10 +1262,16 @@ class Simulator:
         if steps < 0:
             raise ValueError("Cannot run for negative steps (got %r)" % (steps,))
 
-        if self._cl_probe_plan is not None:
+        if self.n_prealloc_probes == "auto":
+            depth = self._auto_probe_depth(steps)
+            if depth > self._probe_depth:
+                self._resize_probes(depth)
+
+        plan = self._cl_probe_plan
+        if plan is not None:
             # -- precondition: the probe buffers have been drained
-            bufpositions = self._cl_probe_plan.cl_bufpositions.get()
-            assert np.all(bufpositions == 0)
+            for _, cl_bufpositions, _, _ in plan.banks:
+                assert np.all(cl_bufpositions.get() == 0)
 
         if progress_bar is None:
             progress_bar = self.progress_bar
@@ -651,17 +1287,51 @@ class Simulator:
 
         with progress:
             # we will go through steps of the simulator in groups of up to B at a time,
-            # draining the probe buffers after each group of B
+            # draining the probe buffers after each group of B. While the device runs
+            # one group (filling one probe bank), the host reads the previous bank.
+            pending = None
+            n_steps = int(round(self.n_steps))
             while steps > 0:
                 B = min(steps, self._max_steps_between_probes)
-                self._plans.call_n_times(B)
-                self._probe()
+                if plan is not None and self._probe_bank_events[plan.bank]:
+                    for cl_queue in [self.queue] + self._dispatch_queues:
+                        cl.enqueue_barrier(
+                            cl_queue, wait_for=self._probe_bank_events[plan.bank]
+                        )
+                last_event = self._plans.enqueue_n_times(B)
+                for cl_queue in [self.queue] + self._dispatch_queues:
+                    cl_queue.flush()
+
+                if pending is not None:
+                    self._probe(*pending)
+                if plan is not None:
+                    pending = self._enqueue_probe_read(
+                        None if last_event is None else [last_event],
+                        np.arange(n_steps + 1, n_steps + B + 1),
+                    )
+
+                n_steps += B
                 steps -= B
                 if hasattr(progress, "total_progress"):
                     progress.total_progress.step(n=B)
                 else:
                     progress.step(n=B)
 
+            if pending is not None:
+                self._probe(*pending)
+
+        # ring-buffered probe data can change without changing length, so clear
+        # the cache used by `self.data`
+        self.data.reset()
+
+        for cl_queue in self._partition_queues + self._dispatch_queues:
+            cl_queue.finish()
+        self._probe_queue.finish()
+        self._plans.finish()  # raise any errors from Python plans
+        if self.profiling:
+            self._plans.update_profiling()
+        self._probe_step_time()
+
         if self.profiling > 1:
             self.print_profiling()
 
@@ -702,27 +1372,40 @@ class Simulator:
         return self.dt * steps[steps % period < 1]
 
     # --- Planning
-    def _plan_probes(self):
+    _initial_probe_depth = 32  # probe buffer length with n_prealloc_probes="auto"
+    _max_auto_probe_depth = 1024  # longer runs alternate between the probe banks
+
+    def _plan_probes(self, n_prealloc):
         plans = []
+        self._probe_depth = n_prealloc
         if len(self.model.probes) == 0:
-            self._max_steps_between_probes = self.n_prealloc_probes
+            self._max_steps_between_probes = n_prealloc
             self._cl_probe_plan = None
         else:
-            n_prealloc = self.n_prealloc_probes
-
             probes = self.model.probes
             periods = [
                 max(1 if p.sample_every is None else p.sample_every / self.dt, 1)
                 for p in probes
             ]
 
-            X = self.all_data[[self.sidx[self.model.sig[p]["in"]] for p in probes]]
-            Y = self.RaggedArray(
-                [np.zeros((n_prealloc, self.model.sig[p]["in"].size)) for p in probes],
-                dtype=np.float32,
-            )
+            # one buffer for each copy of each probe (see `batch_size`)
+            sigs = [sig for p in probes for sig in self._probe_signals[p]]
+            periods = [
+                period
+                for p, period in zip(probes, periods)
+                for _ in self._probe_signals[p]
+            ]
+
+            X = self.all_data[[self.sidx[sig] for sig in sigs]]
+            Ys = [
+                self.RaggedArray(
+                    [np.zeros((n_prealloc, sig.size)) for sig in sigs],
+                    dtype=np.float32,
+                )
+                for _ in range(2)  # double-buffered
+            ]
 
-            cl_plan = plan_probes(self.queue, periods, X, Y)
+            cl_plan = plan_probes(self.queue, periods, X, Ys)
             self._max_steps_between_probes = n_prealloc * int(min(periods))
             self._cl_probe_plan = cl_plan
             plans.append(cl_plan)
@@ -730,6 +1413,99 @@ class Simulator:
         assert self._max_steps_between_probes >= 1
         return plans
 
+    def _auto_probe_depth(self, steps):
+        """Probe buffer length needed to run ``steps`` without draining the buffers.
+
+        The length is limited to ``_max_auto_probe_depth``, so that in longer runs
+        the host reads one probe bank while the device fills the other, and so that
+        both probe banks together use no more than 1/16 of the device memory.
+        """
+        plan = self._cl_probe_plan
+        if plan is None:
+            return min(steps, self._max_auto_probe_depth)
+
+        device = self.queue.device
+        max_bytes = min(device.global_mem_size // 16, device.max_mem_alloc_size)
+        row_bytes = plan.Y.sizes.sum() // self._probe_depth * plan.Y.dtype.itemsize
+        max_depth = max(int(max_bytes // (len(plan.banks) * row_bytes)), 1)
+
+        min_period = int(plan.cl_periods.get().min())
+        return min(-(-steps // min_period), self._max_auto_probe_depth, max_depth)
+
+    def _resize_probes(self, n_prealloc):
+        """Replace the probe buffers with buffers of length ``n_prealloc``."""
+        old_plan = self._cl_probe_plan
+        plans = self._plan_probes(n_prealloc)
+        if old_plan is not None:
+            (new_plan,) = plans
+            cl.enqueue_copy(
+                self.queue, new_plan.cl_countdowns.data, old_plan.cl_countdowns.data
+            )
+            self.queue.finish()
+            self._plans.replace(old_plan, new_plan)
+        self._clear_probe_bank_events()
+
+    def _clear_probe_bank_events(self):
+        """Forget the reads of the probe banks (e.g. after the banks are replaced)."""
+        banks = () if self._cl_probe_plan is None else self._cl_probe_plan.banks
+        self._probe_bank_events = [[] for _ in banks]
+
+    def _partition_regions(self, partitions, shadows):
+        """Map each base to the partition using it (the others have copies)."""
+        region = {}
+        for p, (ops, shadow) in enumerate(zip(partitions, shadows)):
+            for op in ops:
+                for sig in op.all_signals:
+                    base = shadow.get(sig.base, sig.base)
+                    assert region.setdefault(base, p) == p, (
+                        "%s used by several partitions" % base
+                    )
+        return region
+
+    def _plan_exchange(self, exchanged, shadows):
+        """Copy signals updated in one partition to the partitions that read them."""
+        pairs = [
+            (base, shadow[base])
+            for bases, shadow in zip(exchanged, shadows)
+            for base in bases
+        ]
+        if len(pairs) == 0:
+            return []
+
+        X = self.all_data[[self.sidx[base] for base, _ in pairs]]
+        Y = self.all_data[[self.sidx[copy] for _, copy in pairs]]
+        incs = np.zeros(len(pairs), dtype=np.int32)
+        return [plan_copy(self.queue, X, Y, incs, tag="exchange")]
+
+    def _group_accesses(self, ops, group_id):
+        """The bases read and written by the plans of a group of ``ops``.
+
+        The plans of one group also all "write" a token for the group, so that
+        they keep their order (they may share buffers not in the signals).
+        """
+        reads = {sig.base for op in ops for sig in op.reads}
+        writes = {sig.base for op in ops for sig in op.sets + op.incs + op.updates}
+        if self.model.time.base in reads:
+            # some processes read the step rather than the time
+            reads.add(self.model.step.base)
+        writes.add(("group", group_id))
+        return reads, writes
+
+    def _create_dispatch_queues(self):
+        """Create the command queues used with ``out_of_order=True``."""
+        properties = PROFILING_ENABLE if self.profiling else 0
+        device = self.queue.device
+        if device.queue_properties & OUT_OF_ORDER_EXEC_MODE_ENABLE:
+            properties |= OUT_OF_ORDER_EXEC_MODE_ENABLE
+            return [cl.CommandQueue(self.context, device, properties=properties)]
+
+        return [
+            cl.CommandQueue(self.context, device, properties=properties)
+            for _ in range(self._n_dispatch_queues)
+        ]
+
+    _n_dispatch_queues = 4  # in-order queues to use if out-of-order is unsupported
+
     def _plan_op_group(self, op_type, ops):
         return getattr(self, "_plan_" + op_type.__name__)(ops)
 
@@ -800,7 +1576,7 @@ class Simulator:
         if callable(beta):
             beta = RaggedArray([sidx[beta(o)] for o in ops], dtype=np.float32)
 
-        rval = plan_block_gemv(
+        rval = plan_dispatch_gemv(
             self.queue,
             alpha,
             all_data,
@@ -874,22 +1650,81 @@ class Simulator:
         Y = self.all_data[[self.sidx[op.Y] for op in ops]]
         return [plan_elementwise_inc(self.queue, A, X, Y)]
 
+    def _plan_FusedElementwise(self, ops):
+        def dst_view(op):
+            y = elementwise_term(op)[0]
+            return (y.base, y.elemoffset, y.shape, y.elemstrides)
+
+        # ops on the same destination view form one chain, applied in order
+        chains = groupby(ops, dst_view)
+
+        Yinds, Tstarts, Ainds, Xinds, alphas, incs = [], [0], [], [], [], []
+        for _, chain in chains:
+            Yinds.append(self.sidx[elementwise_term(chain[0])[0]])
+            for op in chain:
+                _, A, X = elementwise_term(op)
+                Ainds.append(-1 if A is None else self.sidx[A])
+                Xinds.append(-1 if X is None else self.sidx[X])
+                alphas.append(op.value if type(op) is Reset else 1)
+                incs.append(bool(op.incs))
+            Tstarts.append(len(alphas))
+
+        return [
+            plan_fused_elementwise(
+                self.queue,
+                self.all_data,
+                Yinds,
+                Tstarts,
+                Ainds,
+                Xinds,
+                alphas,
+                incs,
+                tag="fused-%d" % len(ops),
+            )
+        ]
+
+    def _plan_BsrDotInc(self, ops):
+        # the kernel increments Y without atomics, so ops incrementing overlapping
+        # parts of Y (which `greedy_planner` never groups) need separate kernels
+        layers = []
+        for op in ops:
+            for layer in layers:
+                if not any(op.Y.may_share_memory(other.Y) for other in layer):
+                    layer.append(op)
+                    break
+            else:
+                layers.append([op])
+
+        return [self._plan_bsr_layer(layer) for layer in layers]
+
+    def _plan_bsr_layer(self, ops):
+        A = self.all_data[[self.sidx[op.A] for op in ops]]
+        X = self.all_data[[self.sidx[op.X] for op in ops]]
+        Y = self.all_data[[self.sidx[op.Y] for op in ops]]
+        return plan_bsr_dot_inc(
+            self.queue,
+            A,
+            [op.A.shape for op in ops],
+            [op.indices for op in ops],
+            [op.indptr for op in ops],
+            X,
+            Y,
+            inc=True,
+            tag="bsr-%d" % len(ops),
+        )
+
     def _plan_SparseDotInc(self, ops):
-        """Sparse MV algorithm is simulation-wide and can be controlled
-        by setting configuration variable "NENGO_OCL_SPMV_ALGORITHM"
+        """Sparse MV algorithm can be controlled by setting configuration variable
+        "NENGO_OCL_SPMV_ALGORITHM" (which can be "auto", to measure it per matrix)
         """
         assert scipy_sparse is not None
 
-        # currently gives one plan per sparse operation instead of combining them all
-        plans = []
-        for op in ops:
-            A = self.sparse_data[self.sparse_sidx[op.A]]
-            X = self.all_data[[self.sidx[op.X]]]
-            Y = self.all_data[[self.sidx[op.Y]]]
-            rval = plan_sparse_dot_inc(self.queue, A, X, Y)
-            plans += rval.plans
-
-        return plans
+        # combines operations using the same algorithm into ragged plans
+        A = [self.sparse_data[self.sparse_sidx[op.A]] for op in ops]
+        X = self.all_data[[self.sidx[op.X] for op in ops]]
+        Y = self.all_data[[self.sidx[op.Y] for op in ops]]
+        progs = plan_ragged_sparse_dot_inc(self.queue, A, X, Y)
+        return [plan for prog in progs for plan in prog.plans]
 
     def _plan_SimPyFunc(self, ops):
         groups = groupby(ops, lambda op: op.fn)
@@ -1018,20 +1853,159 @@ class Simulator:
         def m2v(x):  # matrix to vector, if appropriate
             return x[:, 0] if x.ndim == 2 and x.shape[1] == 1 else x
 
-        def v2m(x):  # vector to matrix, if appropriate
-            return x[:, None] if x.ndim == 1 else x
-
-        def step():
-            t = float(self.all_data[t_idx][0, 0] if t_in else 0)
-            for ix, iy in ix_iy:
+        # inputs (the time, then each x) and outputs (each y) on the host
+        read_idx = ([t_idx] if t_in else []) + [ix for ix in x_idx if ix is not None]
+        write_idx = [iy for iy in y_idx if iy is not None]
+        read = self._plan_python_read(read_idx, fn_name)
+        write, outputs = self._plan_python_write(write_idx, fn_name)
+        outputs = iter(outputs)
+        outputs = [None if iy is None else next(outputs) for iy in y_idx]
+
+        def compute(inputs):
+            values = iter(inputs)
+            t = float(next(values)[0, 0]) if t_in else 0
+            for (ix, _), y_out in zip(ix_iy, outputs):
                 args = [t] if t_in else []
-                args += [m2v(self.all_data[ix])] if ix is not None else []
+                args += [m2v(next(values))] if ix is not None else []
                 y = fn(*args)
-                if iy is not None:
-                    self.all_data[iy] = v2m(np.asarray(y))
+                if y_out is not None:
+                    y_out[...] = np.reshape(y, y_out.shape)
+
+        def step():
+            # copies are on their own queue, so they do not wait for unrelated
+            # kernels (plans wait for the kernels that they depend on)
+            inputs, events = read(self._host_queue, None)
+            if events:
+                cl.wait_for_events(events)
+            compute(inputs)
+            events = write(self._host_queue, None)
+            if events:
+                cl.wait_for_events(events)
+
+        # outputs can only be copied asynchronously if they are contiguous
+        if write.is_async:
+            return PythonPlan(
+                step,
+                read=read,
+                compute=compute,
+                write=write,
+                name="python_fn",
+                tag=fn_name,
+            )
 
         return PythonPlan(step, name="python_fn", tag=fn_name)
 
+    def _plan_python_read(self, idx, tag):
+        """Make ``read(queue, wait_for)``, which copies signals ``idx`` to the host.
+
+        ``read`` returns the host arrays and the events of their copies. With more
+        than one signal, the signals are gathered into one staging buffer on the
+        device, so that each step needs one transfer, rather than one per signal.
+        """
+        all_data = self.all_data  # the buffer of the partition being planned
+        gather = self._plan_staging(idx, to_staging=True, tag=tag)
+
+        def read(queue, wait_for):
+            if gather is not None:
+                return gather.host_views, gather.transfer(queue, wait_for)
+
+            copies = [
+                all_data.getitem_host(i, queue, wait_for, is_blocking=False)
+                for i in idx
+            ]
+            inputs = [x for x, _ in copies]
+            return inputs, [event for _, event in copies if event is not None]
+
+        return read
+
+    def _plan_python_write(self, idx, tag):
+        """Make ``write(queue, wait_for)``, which copies host arrays to signals ``idx``.
+
+        Returns ``write`` and the host arrays to fill; ``write`` returns the events
+        of the copies. With more than one signal, the signals are scattered from
+        one staging buffer on the device. ``write.is_async`` is whether the copies
+        can wait for ``wait_for`` (rather than being synchronous).
+        """
+        all_data = self.all_data
+        scatter = self._plan_staging(idx, to_staging=False, tag=tag)
+        outputs = (
+            [
+                np.zeros((all_data.shape0s[i], all_data.shape1s[i]), all_data.dtype)
+                for i in idx
+            ]
+            if scatter is None
+            else scatter.host_views
+        )
+
+        def write(queue, wait_for):
+            if scatter is not None:
+                return scatter.transfer(queue, wait_for)
+
+            events = [
+                all_data.setitem_host(
+                    i, y_out, queue, wait_for=wait_for, is_blocking=False
+                )
+                for i, y_out in zip(idx, outputs)
+            ]
+            return [event for event in events if event is not None]
+
+        write.is_async = scatter is not None or all(
+            all_data.is_contiguous(i) for i in idx
+        )
+        return write, outputs
+
+    def _plan_staging(self, idx, to_staging, tag=None):
+        """Plan the transfer of several signals through one staging buffer.
+
+        If ``to_staging``, the signals ``idx`` of ``all_data`` are gathered into
+        a contiguous staging buffer on the device, which is then copied to the
+        host. Otherwise, the host data is copied to the staging buffer, and then
+        scattered to the signals. Returns a `.Plan` for the copy kernel, with
+        ``host_views`` (the host arrays of the signals, which are views of one
+        host buffer) and ``transfer(queue, wait_for)`` (which enqueues the
+        kernel and the copy in the right order, and returns their events). Returns
+        None if there are fewer than two signals, or they cannot be copied.
+        """
+        if len(idx) < 2 or (self.all_data.stride1s[idx] != 1).any():
+            return None
+
+        signals = self.all_data[idx]
+        staging = CLRaggedArray.from_arrays(
+            self.queue,
+            [np.zeros((m, n)) for m, n in zip(signals.shape0s, signals.shape1s)],
+            dtype=self.all_data.dtype,
+        )
+        X, Y = (signals, staging) if to_staging else (staging, signals)
+        plan = plan_copy(self.queue, X, Y, np.zeros(len(idx)), tag=tag)
+        plan.staging = staging
+
+        host = np.zeros(staging.cl_buf.shape, dtype=staging.dtype)
+        plan.host_views = [
+            host[start : start + m * n].reshape(m, n)
+            for start, m, n in zip(staging.starts, staging.shape0s, staging.shape1s)
+        ]
+
+        def transfer(queue, wait_for):
+            if to_staging:
+                copy = plan.enqueue(wait_for=wait_for, queue=queue)
+                return [
+                    cl.enqueue_copy(
+                        queue,
+                        host,
+                        staging.cl_buf.data,
+                        wait_for=[copy],
+                        is_blocking=False,
+                    )
+                ]
+
+            write = cl.enqueue_copy(
+                queue, staging.cl_buf.data, host, wait_for=wait_for, is_blocking=False
+            )
+            return [write, plan.enqueue(wait_for=[write], queue=queue)]
+
+        plan.transfer = transfer
+        return plan
+
     def _plan_SimNeurons(self, all_ops):
         groups = groupby(all_ops, lambda op: op.neurons.__class__)
         plans = []
@@ -1238,9 +2212,10 @@ class Simulator:
         )
         Xbuf = CLRaggedArray(self.queue, Xbuf0)
         Ybuf = CLRaggedArray(self.queue, Ybuf0)
-        self._raggedarrays_to_reset[Xbuf] = Xbuf0
-        self._raggedarrays_to_reset[Ybuf] = Ybuf0
-        return plan_linearfilter(self.queue, X, Y, A, B, Xbuf, Ybuf)
+        self._raggedarrays_to_reset.extend([Xbuf, Ybuf])
+        plans = plan_linearfilter(self.queue, X, Y, A, B, Xbuf, Ybuf)
+        self._cl_state_arrays.extend([plans[0].Xbufpos, plans[0].Ybufpos])
+        return plans
 
     def _plan_WhiteNoise(self, ops):
         assert all(op.input is None for op in ops)
@@ -1394,7 +2369,8 @@ class Simulator:
         Parameters
         ----------
         sort : column to sort by (negative number sorts ascending)
-            (0 = n_calls, 1 = runtime, 2 = q-time, 3 = subtime)
+            (0 = n_calls, 1 = runtime, 2 = GF/s, 3 = GB/s, 4 = 90th percentile
+            of the time per call, 5 = maximum time per call)
         """
         if not self.profiling:
             print("Profiling not enabled!")
@@ -1405,7 +2381,7 @@ class Simulator:
         unknowns = []
         for p in self._plans:
             if isinstance(p, BasePlan):
-                t = sum(p.ctimes)
+                t = p.ctimes.sum
                 calls_per_sec = p.n_calls / t if t > 0 else np.nan
                 gfps = np.nan  # gigaflops / sec
                 gbps = np.nan  # gigabytes / sec
@@ -1413,7 +2389,17 @@ class Simulator:
                     gfps = 1e-9 * p.flops_per_call * calls_per_sec
                 if p.bw_per_call is not None:
                     gbps = 1e-9 * p.bw_per_call * calls_per_sec
-                table.append((p.n_calls, t, gfps, gbps, str(p)))
+                table.append(
+                    (
+                        p.n_calls,
+                        t,
+                        gfps,
+                        gbps,
+                        1e6 * p.ctimes.quantile(0.9),
+                        1e6 * p.ctimes.max,
+                        str(p),
+                    )
+                )
             else:
                 unknowns.append((str(p), getattr(p, "cumtime", "<unknown>")))
 
@@ -1423,10 +2409,13 @@ class Simulator:
 
         # print table
         print(" Profiling ".center(80, "-"))
-        print("%8s|%10s|%10s|%10s|" % ("n_calls", "runtime", "GF/s", "GB/s"))
+        print(
+            "%8s|%10s|%10s|%10s|%10s|%10s|"
+            % ("n_calls", "runtime", "GF/s", "GB/s", "p90 (us)", "max (us)")
+        )
 
         for r in table:
-            print("%8d|%10.3f|%10.3f|%10.3f| %s" % r)
+            print("%8d|%10.3f|%10.3f|%10.3f|%10.1f|%10.1f| %s" % r)
 
         # totals totals
         print("-" * 80)
@@ -1447,3 +2436,157 @@ class Simulator:
             print("\n")
             for r in unknowns:
                 print("%s %s" % r)
+
+    def print_roofline(self):
+        """Print how far each profiled plan is from the peaks of its device.
+
+        The peak bandwidth and floating-point throughput of each device are
+        measured once and cached (see `nengo_ocl.roofline.get_device_peaks`).
+        Each plan is classified as bound by compute or by bandwidth, depending on
+        its arithmetic intensity (flops per byte), and plans are ranked by
+        headroom: the time that would be saved if they ran at the roofline.
+
+        To enable profiling, pass the ``profiling=True`` argument when creating
+        the ``Simulator``.
+        """
+        if not self.profiling:
+            print("Profiling not enabled!")
+            return
+
+        rows = []
+        kernels = [p for p in self._plans if hasattr(p, "queue")]
+        for device in {p.queue.device for p in kernels}:
+            peaks = get_device_peaks(device)
+            print(
+                "%s: %0.1f GB/s, %0.1f GF/s (ridge at %0.2f flops/byte)"
+                % (
+                    device.name,
+                    1e-9 * peaks["bandwidth"],
+                    1e-9 * peaks["flops"],
+                    peaks["flops"] / peaks["bandwidth"],
+                )
+            )
+            rows.extend(
+                roofline([p for p in kernels if p.queue.device == device], peaks)
+            )
+        rows.sort(key=lambda row: row["headroom"], reverse=True)
+
+        print(" Roofline ".center(80, "-"))
+        print(
+            "%10s|%10s|%10s|%10s|%10s|%10s|"
+            % ("headroom", "flops/B", "bound", "GF/s", "GB/s", "efficiency")
+        )
+        for row in rows:
+            print(
+                "%10.3f|%10.2f|%10s|%10.3f|%10.3f|%9.1f%%| %s"
+                % (
+                    row["headroom"],
+                    row["intensity"],
+                    row["bound"],
+                    row["gflops"],
+                    row["gbps"],
+                    100 * row["efficiency"],
+                    row["plan"],
+                )
+            )
+
+    def export_trace(self, path):
+        """Write a timeline of all profiled plan calls to a JSON file.
+
+        The file uses the Chrome trace event format, and can be opened with
+        ``chrome://tracing`` or https://ui.perfetto.dev. Each kernel call is shown
+        on the row of its command queue, and Python plans and probe transfers on
+        the host row. Events are tagged with the plan name, tag, global and local
+        sizes, flops and bytes per call, and the step of the call (counting from
+        the first step). With ``profiling_every``, only the profiled steps are shown,
+        and only the last profiled calls of each plan are kept.
+
+        To enable profiling, pass the ``profiling=True`` argument when creating
+        the ``Simulator``.
+
+        Parameters
+        ----------
+        path : str
+            The file to write.
+        """
+        if not self.profiling:
+            raise RuntimeError("Profiling not enabled!")
+
+        # device timestamps are converted to the host clock by comparing the
+        # time a marker is enqueued on both clocks
+        offsets = {}
+
+        def clock_offset(cl_queue):
+            if cl_queue not in offsets:
+                t0 = time.perf_counter_ns()
+                event = cl.enqueue_marker(cl_queue)
+                t1 = time.perf_counter_ns()
+                event.wait()
+                offsets[cl_queue] = (t0 + t1) // 2 - event.profile.queued
+            return offsets[cl_queue]
+
+        threads = {None: 0}  # the host, then each queue in order of appearance
+        events = []
+        for p in self._plans:
+            args = {"tag": p.tag, "flops": p.flops_per_call, "bytes": p.bw_per_call}
+            if hasattr(p, "gsize"):
+                args.update(gsize=p.gsize, lsize=p.lsize)
+            # plans are called once per step, so their last calls are in the last
+            # profiled steps
+            steps = list(self._plans.profiled_steps)[-len(p.trace) :]
+            for step, (queued, start, end, cl_queue) in zip(steps, p.trace):
+                offset = 0 if cl_queue is None else clock_offset(cl_queue)
+                event_args = dict(args, step=step)
+                if cl_queue is not None:
+                    event_args["queued_us"] = 1e-3 * (start - queued)
+                events.append(
+                    dict(
+                        name=p.name,
+                        cat="python" if cl_queue is None else "kernel",
+                        ts=start + offset,
+                        dur=end - start,
+                        tid=threads.setdefault(cl_queue, len(threads)),
+                        args=event_args,
+                    )
+                )
+
+        for start, end, first_step, last_step, nbytes in self._probe_trace:
+            events.append(
+                dict(
+                    name="probe_read",
+                    cat="probe",
+                    ts=start,
+                    dur=end - start,
+                    tid=threads[None],
+                    args=dict(steps=[int(first_step), int(last_step)], bytes=nbytes),
+                )
+            )
+
+        t_zero = min((e["ts"] for e in events), default=0)
+        for e in events:
+            e.update(ph="X", pid=0, ts=1e-3 * (e["ts"] - t_zero), dur=1e-3 * e["dur"])
+
+        names = {
+            tid: "host" if cl_queue is None else "queue %d" % tid
+            for cl_queue, tid in threads.items()
+        }
+        metadata = [
+            dict(name="thread_name", ph="M", pid=0, tid=tid, args=dict(name=name))
+            for tid, name in names.items()
+        ]
+        metadata.append(
+            dict(
+                name="process_name",
+                ph="M",
+                pid=0,
+                args=dict(name=", ".join(d.name for d in self.context.devices)),
+            )
+        )
+
+        with open(path, "w", encoding="utf-8") as fh:
+            # numpy scalars (e.g. sizes and flops) are written as Python numbers
+            json.dump(
+                {"traceEvents": metadata + events},
+                fh,
+                default=lambda x: np.asarray(x).tolist(),
+            )
@@ -0,0 +1,157 @@
+# pylint: disable=missing-module-docstring,missing-function-docstring
+
+import json
+import os
+
+import numpy as np
+import pyopencl as cl
+
+from nengo_ocl import autotune as autotune_module
+from nengo_ocl import clra_gemv
+from nengo_ocl.autotune import TuningDB, autotune, geometry_key
+from nengo_ocl.clraggedarray import CLRaggedArray as CLRA
+from nengo_ocl.program_cache import device_key
+from nengo_ocl.raggedarray import RaggedArray
+
+
+def test_tuning_db(ctx, tmp_path):
+    device = ctx.devices[0]
+    db = TuningDB(str(tmp_path))
+    assert db.get(device, "kern", "a") is None
+
+    db.set(device, "kern", "a", {"params": {"x": 1}, "time": 0.1})
+    assert db.get(device, "kern", "a")["params"] == {"x": 1}
+    assert os.listdir(str(tmp_path)) == [device_key(device) + ".json"]
+
+    # entries saved by another database are merged, not overwritten
+    db2 = TuningDB(str(tmp_path))
+    db2.set(device, "kern", "b", {"params": {"x": 2}, "time": 0.2})
+    db.set(device, "other", "a", {"params": {"x": 3}, "time": 0.3})
+    db3 = TuningDB(str(tmp_path))
+    assert db3.get(device, "kern", "a")["params"] == {"x": 1}
+    assert db3.get(device, "kern", "b")["params"] == {"x": 2}
+    assert db3.get(device, "other", "a")["params"] == {"x": 3}
+
+    # corrupt files are ignored
+    with open(str(tmp_path / (device_key(device) + ".json")), "w") as fh:
+        fh.write("{")
+    assert TuningDB(str(tmp_path)).get(device, "kern", "a") is None
+
+
+def test_geometry_key():
+    a = np.array([[1, 2], [3, 4]])
+    assert geometry_key(a) == geometry_key(a.copy())
+    assert geometry_key(a) != geometry_key(a.T)
+    assert geometry_key(a) != geometry_key(a.astype(np.int32))
+    assert geometry_key(a, "float32") != geometry_key(a, "float64")
+
+
+def make_gemv(queue, rng, plan_gemv=clra_gemv.plan_block_gemv):
+    RA = lambda arrays: RaggedArray(arrays, dtype=np.float32)
+    A = RA([rng.normal(size=(50, 20)), rng.normal(size=(30, 70))])
+    X = RA([rng.normal(size=20), rng.normal(size=70)])
+    Y = RA([rng.normal(size=50), rng.normal(size=30)])
+    js = RaggedArray([[0], [1]], dtype=np.int32)
+    clY = CLRA(queue, Y)
+    prog = plan_gemv(queue, 1.0, CLRA(queue, A), js, CLRA(queue, X), js, 1.0, clY)
+    refs = [A[i].dot(X[i]) + Y[i] for i in range(2)]
+    return prog, clY, refs
+
+
+def test_autotune_block_gemv(ctx, rng, tmp_path, monkeypatch):
+    queue = cl.CommandQueue(ctx)
+    db = TuningDB(str(tmp_path))
+    monkeypatch.setattr(autotune_module, "_default_tuning_db", db)
+    candidates = [
+        dict(block_y=8, block_x=32, lsize0=4),
+        dict(block_y=16, block_x=32, lsize0=2),
+        dict(block_y=32, block_x=64, lsize0=2),
+    ]
+    monkeypatch.setattr(clra_gemv, "block_impl_candidates", lambda p: candidates)
+
+    # without autotuning, the defaults are used
+    monkeypatch.setenv("NENGO_OCL_AUTOTUNE", "0")
+    prog, _, _ = make_gemv(queue, rng)
+    assert prog.plans[0].params == dict(block_y=32, block_x=128, lsize0=4)
+    assert os.listdir(str(tmp_path)) == []
+
+    # with autotuning, a candidate is chosen and stored
+    monkeypatch.setenv("NENGO_OCL_AUTOTUNE", "1")
+    prog, clY, refs = make_gemv(queue, rng)
+    params = prog.plans[0].params
+    assert params in candidates
+    with open(str(tmp_path / (device_key(ctx.devices[0]) + ".json"))) as fh:
+        (entry,) = json.load(fh)["entries"].values()
+    assert entry["params"] == params
+
+    # outputs written while timing are restored, so results are correct
+    for plan in prog.plans:
+        plan()
+    for i, ref in enumerate(refs):
+        assert np.allclose(clY[i], ref, atol=1e-5)
+
+    # later builds reuse the stored parameters without measuring
+    def fail(*args, **kwargs):
+        raise AssertionError("should not measure")
+
+    monkeypatch.setattr(autotune_module, "time_plans", fail)
+    monkeypatch.setattr(autotune_module, "_default_tuning_db", TuningDB(str(tmp_path)))
+    prog, clY, refs = make_gemv(queue, rng)
+    assert prog.plans[0].params == params
+    for plan in prog.plans:
+        plan()
+    for i, ref in enumerate(refs):
+        assert np.allclose(clY[i], ref, atol=1e-5)
+
+
+def test_autotune_dispatch_block_gemv(ctx, rng, tmp_path, monkeypatch):
+    queue = cl.CommandQueue(ctx)
+    monkeypatch.setattr(autotune_module, "_default_tuning_db", TuningDB(str(tmp_path)))
+    candidates = [
+        dict(block_y=8, block_x=32, lsize0=4),
+        dict(block_y=16, block_x=32, lsize0=2),
+    ]
+    monkeypatch.setattr(clra_gemv, "block_impl_candidates", lambda p: candidates)
+    monkeypatch.setenv("NENGO_OCL_GEMV_ALGORITHM", "block")
+    monkeypatch.setenv("NENGO_OCL_AUTOTUNE", "1")
+
+    # the block kernels of the dispatcher use block sizes tuned for their items
+    prog, clY, refs = make_gemv(queue, rng, plan_gemv=clra_gemv.plan_dispatch_gemv)
+    block_plans = [plan for plan in prog.plans if hasattr(plan, "params")]
+    assert len(block_plans) > 0
+    assert all(plan.params in candidates for plan in block_plans)
+    for plan in prog.plans:
+        plan()
+    for i, ref in enumerate(refs):
+        assert np.allclose(clY[i], ref, atol=1e-5)
+
+    # the cost model uses the tuned block sizes, if they are known
+    assert prog.block_params([0, 1]) in candidates
+    tuned = clra_gemv.gemv_impl_cost(prog, "block", [0, 1])
+    monkeypatch.setattr(
+        autotune_module, "_default_tuning_db", TuningDB(str(tmp_path / "empty"))
+    )
+    assert clra_gemv.gemv_impl_cost(prog, "block", [0, 1]) != tuned
+
+
+def test_autotune_skips_failures(ctx, tmp_path, monkeypatch):
+    queue = cl.CommandQueue(ctx)
+    db = TuningDB(str(tmp_path))
+    monkeypatch.setenv("NENGO_OCL_AUTOTUNE", "1")
+
+    def make_plans(x):
+        if x == 0:
+            raise cl.RuntimeError("out of resources")
+        return ["plans%d" % x]
+
+    times = {"plans1": 2.0, "plans2": 1.0, "plans3": 3.0}
+    monkeypatch.setattr(
+        autotune_module, "time_plans", lambda plans, repeats: times[plans[0]]
+    )
+    candidates = [dict(x=x) for x in range(4)]
+    assert autotune(queue, "k", "g", candidates, make_plans, db=db) == dict(x=2)
+    assert db.get(queue.device, "k", "g") == {"params": dict(x=2), "time": 1.0}
+
+    # stored parameters that are no longer candidates are measured again
+    candidates = [dict(x=1), dict(x=3)]
+    assert autotune(queue, "k", "g", candidates, make_plans, db=db) == dict(x=1)
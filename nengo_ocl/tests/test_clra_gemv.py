@@ -1,6 +1,7 @@
 # pylint: disable=missing-module-docstring,missing-function-docstring
 
 import logging
+import os
 
 import numpy as np
 import pyopencl as cl
@@ -8,17 +9,25 @@ import pyopencl.array  # noqa: F401, pylint: disable=unused-import
 import pytest
 from nengo.utils.stdlib import Timer
 
+from nengo_ocl import autotune as autotune_module
+from nengo_ocl.autotune import TuningDB
 from nengo_ocl.clra_gemv import (
     plan_block_gemv,
+    plan_bsr_dot_inc,
     plan_csr,
+    plan_dispatch_gemv,
     plan_ellpack,
     plan_ellpack_tree,
+    plan_ellpack_twostep,
     plan_many_dots_gemv,
     plan_ragged_gather_gemv,
+    plan_ragged_sparse_dot_inc,
     plan_reduce_gemv,
+    plan_sparse_dot_inc,
     spmv_algorithm_heuristic,
 )
 from nengo_ocl.clraggedarray import CLRaggedArray as CLRA
+from nengo_ocl.program_cache import device_key
 from nengo_ocl.raggedarray import RaggedArray
 from nengo_ocl.utils import HostSparseMatrix
 
@@ -35,6 +44,7 @@ def pytest_generate_tests(metafunc):
                 plan_many_dots_gemv,
                 plan_block_gemv,
                 plan_ragged_gather_gemv,
+                plan_dispatch_gemv,
             ],
         )
     if "sparse_planner" in metafunc.fixturenames:
@@ -42,7 +52,7 @@ def pytest_generate_tests(metafunc):
             "sparse_planner",
             [
                 plan_ellpack,
-                # plan_ellpack_twostep,
+                plan_ellpack_twostep,
                 # plan_ellpack_tree,
                 plan_csr,
             ],
@@ -289,6 +299,76 @@ def test_one_short_segment_many_longer_dots(ctx, planner):
         )
 
 
+def test_dispatch_gemv(ctx, rng, tmp_path, monkeypatch):
+    queue = cl.CommandQueue(ctx)
+    monkeypatch.delenv("NENGO_OCL_GEMV_ALGORITHM", raising=False)
+
+    # encoders (many short rows), a long dot product, many short dot products,
+    # and an output that is not contiguous (every second element of a buffer)
+    A_shapes = [(50, 1)] * 10 + [(8, 1000)] + [(4, 4)] * 8 + [(5, 3)]
+    A_js = [[i] for i in range(11)] + [list(range(11, 19)), [19]]
+    A = RA([rng.normal(size=shape) for shape in A_shapes])
+    X = RA([rng.normal(size=(shape[1], 1)) for shape in A_shapes])
+    Y = RA([rng.normal(size=(A_shapes[js[0]][0], 1)) for js in A_js[:-1]] + [[0] * 10])
+    Y_views = [Y[i] for i in range(len(A_js) - 1)] + [Y[len(A_js) - 1][::2]]
+    refs = [sum(A[j].dot(X[j]) for j in js) + 0.5 * y for js, y in zip(A_js, Y_views)]
+
+    def run():
+        clY = CLRA(queue, Y)
+        strided = CLRA.from_buffer(
+            queue,
+            clY.cl_buf,
+            clY.starts,
+            list(clY.shape0s[:-1]) + [5],
+            clY.shape1s,
+            list(clY.stride0s[:-1]) + [2],
+            clY.stride1s,
+        )
+        js = RA(A_js, dtype=np.int32)
+        prog = plan_dispatch_gemv(
+            queue, 1.0, CLRA(queue, A), js, CLRA(queue, X), js, 0.5, strided
+        )
+        for plan in prog.plans:
+            plan()
+        for i, ref in enumerate(refs):
+            assert np.allclose(strided[i], ref, atol=1e-4)
+        assert np.array_equal(clY[len(refs) - 1][1::2], Y[len(refs) - 1][1::2])
+
+        impls = {}
+        for plan in prog.plans:
+            if hasattr(plan, "description"):
+                impl = plan.description.split("\n")[0].split(": ")[1]
+                n_items = int(plan.tag.split("-" + impl)[1])
+                impls[impl] = impls.get(impl, 0) + n_items
+        assert sum(impls.values()) == len(A_js)
+        assert "block" in impls  # for the non-contiguous output
+        return prog, impls
+
+    # predicted (with the costs in the description)
+    prog, _ = run()
+    assert all(
+        "predicted (block" in plan.description
+        for plan in prog.plans
+        if hasattr(plan, "description")
+    )
+
+    # forced with the environment variable, where supported
+    monkeypatch.setenv("NENGO_OCL_GEMV_ALGORITHM", "many_dots")
+    _, impls = run()
+    assert impls == {"many_dots": len(A_js) - 1, "block": 1}
+
+    # measured, and stored in the tuning database
+    monkeypatch.delenv("NENGO_OCL_GEMV_ALGORITHM")
+    monkeypatch.setenv("NENGO_OCL_AUTOTUNE", "1")
+    monkeypatch.setattr(autotune_module, "_default_tuning_db", TuningDB(str(tmp_path)))
+    prog, _ = run()
+    assert any(
+        "measured" in plan.description
+        for plan in prog.plans
+        if hasattr(plan, "description")
+    )
+
+
 def test_speed(ctx, rng):  # noqa: C901
     try:
         import pyopencl_blas  # pylint: disable=import-outside-toplevel
@@ -461,6 +541,102 @@ def test_sparse(sparse_planner, inc, long_row, sparsity, shape, ctx, rng, allclo
         assert allclose(ref, sim, atol=1e-6)
 
 
+@pytest.mark.parametrize("algorithm", [None, "CSR", "ELLPACK"])
+@pytest.mark.parametrize("inc", [False, True])
+def test_ragged_sparse(algorithm, inc, ctx, rng, allclose, tmp_path, monkeypatch):
+    scipy_sparse = pytest.importorskip("scipy.sparse")
+
+    queue = cl.CommandQueue(ctx)
+    max_wgs = queue.device.max_work_group_size
+    monkeypatch.setattr(autotune_module, "_default_tuning_db", TuningDB(str(tmp_path)))
+
+    shapes = [(20, 30), (50, 10), (1, 7), (40, 1), (5, 5), (64, 64), (3, 2 * max_wgs)]
+    densities = [0.1, 0.3, 0.5, 0.2, 0, 0.9, 0.01]
+    As = [
+        scipy_sparse.random(m, n, density=d, format="csr", random_state=rng)
+        for (m, n), d in zip(shapes, densities)
+    ]
+    As[-1][1, :] = 1  # a row longer than a work group
+    X = RA([rng.uniform(-1, 1, size=n) for _, n in shapes])
+    Y = RA([rng.uniform(-1, 1, size=m) for m, _ in shapes])
+    clX = CLRA(queue, X)
+    clY = CLRA(queue, Y)
+
+    hAs = [HostSparseMatrix(A.astype(np.float32)) for A in As]
+    progs = plan_ragged_sparse_dot_inc(
+        queue, hAs, clX, clY, inc=inc, algorithm=algorithm
+    )
+    if algorithm == "CSR":
+        assert len(progs) == 1
+        assert progs[0].plans[0].description.startswith("groups: %d" % len(As))
+    else:
+        assert len(progs) < len(As)
+
+    for prog in progs:
+        for plan in prog.plans:
+            plan()
+
+    for i, A in enumerate(As):
+        ref = (Y[i] if inc else 0) + A.dot(X[i])
+        assert allclose(clY[i], ref, atol=1e-5)
+
+
+@pytest.mark.parametrize("inc", [False, True])
+def test_bsr_dot_inc(inc, ctx, rng, allclose):
+    scipy_sparse = pytest.importorskip("scipy.sparse")
+
+    queue = cl.CommandQueue(ctx)
+
+    # block shapes and the number of block rows and columns of each matrix
+    blocks = [
+        ((2, 3), (4, 5)),
+        ((1, 1), (10, 10)),
+        ((16, 16), (3, 2)),
+        ((5, 7), (2, 1)),
+    ]
+    As = []
+    for (r, c), (m, n) in blocks:
+        mask = rng.uniform(size=(m, n)) < 0.5
+        mask[0] = False  # an empty block row
+        dense = np.kron(mask, np.ones((r, c))) * rng.uniform(-1, 1, size=(m * r, n * c))
+        As.append(scipy_sparse.bsr_matrix(dense, blocksize=(r, c)))
+
+    X = RA([rng.uniform(-1, 1, size=A.shape[1]) for A in As])
+    Y = RA([rng.uniform(-1, 1, size=A.shape[0]) for A in As])
+    clA = CLRA(queue, RA([A.data.ravel() for A in As]))
+    clX = CLRA(queue, X)
+    clY = CLRA(queue, Y)
+
+    plan = plan_bsr_dot_inc(
+        queue,
+        clA,
+        [A.data.shape for A in As],
+        [A.indices for A in As],
+        [A.indptr for A in As],
+        clX,
+        clY,
+        inc=inc,
+    )
+    plan()
+
+    for i, A in enumerate(As):
+        ref = (Y[i] if inc else 0) + A.dot(X[i])
+        assert allclose(clY[i], ref, atol=1e-5)
+
+    # rows of Y are written without atomics, so they cannot be shared
+    with pytest.raises(AssertionError, match="overlap"):
+        plan_bsr_dot_inc(
+            queue,
+            clA[[0, 0]],
+            [As[0].data.shape] * 2,
+            [As[0].indices] * 2,
+            [As[0].indptr] * 2,
+            clX[[0, 0]],
+            clY[[0, 0]],
+            inc=inc,
+        )
+
+
 @pytest.mark.filterwarnings("ignore:Changing the sparsity structure of a csr_matrix")
 def test_spmv_impl_heuristic(ctx):
     scipy_sparse = pytest.importorskip("scipy.sparse")
@@ -490,3 +666,50 @@ def test_spmv_impl_heuristic(ctx):
             spmv_algorithm_heuristic(queue, hA, footprint_soft_limit=testing_limit)
             == answer
         )
+
+
+def test_spmv_measured(ctx, rng, tmp_path, monkeypatch):
+    scipy_sparse = pytest.importorskip("scipy.sparse")
+
+    queue = cl.CommandQueue(ctx)
+    monkeypatch.delenv("NENGO_OCL_SPMV_ALGORITHM", raising=False)
+    monkeypatch.delenv("NENGO_OCL_AUTOTUNE", raising=False)
+    monkeypatch.setattr(autotune_module, "_default_tuning_db", TuningDB(str(tmp_path)))
+
+    # one row longer than a work group, so ELLPACK-tree cannot be used
+    A = scipy_sparse.random(50, 2000, density=0.05, format="lil", random_state=rng)
+    A[3, :] = 1
+    A = A.tocsr().astype(np.float32)
+    X = RA([rng.uniform(-1, 1, size=A.shape[1])])
+    Y = RA([rng.uniform(-1, 1, size=A.shape[0])])
+
+    def run(A, **kwargs):
+        clY = CLRA(queue, Y)
+        prog = plan_sparse_dot_inc(
+            queue, HostSparseMatrix(A), CLRA(queue, X), clY, inc=True, **kwargs
+        )
+        for plan in prog.plans:
+            plan()
+        assert np.allclose(clY[0], Y[0] + A.dot(X[0]), atol=1e-4)
+        return prog
+
+    # without measuring, the heuristic is used
+    prog = run(A)
+    assert os.listdir(str(tmp_path)) == []
+
+    # measured, and stored by structure
+    prog = run(A, algorithm="auto")
+    assert isinstance(prog, (plan_csr, plan_ellpack_twostep))
+    assert "(measured)" in prog.plans[0].description
+    (entry,) = TuningDB(str(tmp_path))._load(device_key(queue.device)).values()
+    assert entry["params"]["algorithm"] in ("CSR", "ELLPACK-twostep")
+
+    # matrices with the same structure use it without measuring
+    def fail(*args, **kwargs):
+        raise AssertionError("should not measure")
+
+    monkeypatch.setattr(autotune_module, "time_plans", fail)
+    monkeypatch.setattr(autotune_module, "_default_tuning_db", TuningDB(str(tmp_path)))
+    A.data[:] = rng.uniform(-1, 1, size=A.nnz)
+    assert type(run(A)) is type(prog)
+    assert type(run(A, algorithm="auto")) is type(prog)
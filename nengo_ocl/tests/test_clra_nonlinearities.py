@@ -14,6 +14,7 @@ from nengo_ocl import raggedarray as ra
 from nengo_ocl.clra_nonlinearities import (
     plan_copy,
     plan_elementwise_inc,
+    plan_fused_elementwise,
     plan_lif,
     plan_lif_rate,
     plan_linearfilter,
@@ -251,6 +252,43 @@ def test_elementwise_inc_outer(ctx, rng):
         assert np.allclose(y, yref, atol=2e-7)
 
 
+def test_fused_elementwise(ctx, rng, allclose):
+    # destinations 0-2, then operands of various shapes to broadcast
+    shapes = [(32, 64), (457, 342), (100, 1), (1, 1), (1, 64), (32, 64), (457, 342)]
+    data = [rng.normal(size=shape).astype(np.float32) for shape in shapes]
+
+    # chains of (A index, X index, alpha, inc) terms applied to the Y index
+    chains = [
+        (0, [(-1, -1, 2.0, 0), (5, 5, 1.0, 1), (-1, 4, 0.5, 1)]),
+        (1, [(3, -1, 1.0, 1), (3, 6, -0.5, 1)]),
+        (2, [(-1, -1, 0.0, 0), (3, -1, 3.0, 1)]),
+    ]
+    Yinds = [y for y, _ in chains]
+    terms = [term for _, chain in chains for term in chain]
+    Tstarts = np.cumsum([0] + [len(chain) for _, chain in chains])
+    Ainds, Xinds, alphas, incs = (np.array(x) for x in zip(*terms))
+
+    ref = [d.copy() for d in data]
+    for y, chain in chains:
+        for a, x, alpha, inc in chain:
+            ax = alpha * (1 if a < 0 else data[a]) * (1 if x < 0 else data[x])
+            ref[y] = (ref[y] if inc else 0) + ax
+
+    # an unused transposed view must not stop the other arrays from fusing
+    radata = RA(data)
+    radata.add_views([radata.starts[0]], [64], [32], [1], [64])
+
+    queue = cl.CommandQueue(ctx)
+    cldata = CLRA(queue, radata)
+    plan = plan_fused_elementwise(
+        queue, cldata, Yinds, Tstarts, Ainds, Xinds, alphas, incs
+    )
+    plan()
+
+    for k, yref in enumerate(ref):
+        assert allclose(cldata[k], yref, atol=2e-6), "Array %d not close" % k
+
+
 def test_reset(ctx, rng):
     # Yshapes = [(100,), (10, 17), (3, 3)]
     Yshapes = [(1000000,), (1000, 1700), (3, 3)]
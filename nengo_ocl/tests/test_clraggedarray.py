@@ -86,6 +86,25 @@ def test_setitem(ctx, rng):
     assert ra.allclose(A, clA.to_host())
 
 
+def test_get_sub_region(ctx, rng):
+    # items that each fill one aligned block, so the region can start on any of them
+    align = max(d.mem_base_addr_align for d in ctx.devices) // 8 // 4
+    A = RA([rng.normal(size=(4, align // 4)) for _ in range(4)], dtype=np.float32)
+    queue = cl.CommandQueue(ctx)
+    clA = CLRA(queue, A)
+
+    sub = clA.get_sub_region(A.starts[1], A.starts[3])
+    assert sub.cl_buf.size == 2 * align
+    for k in (1, 2):
+        assert np.array_equal(sub[k], A[k])
+
+    # writes to the region are seen in the whole array, and stay in the region
+    sub[2] = 5
+    assert np.all(clA[2] == 5)
+    for k in (0, 1, 3):
+        assert np.array_equal(clA[k], A[k])
+
+
 def test_discontiguous_setitem(ctx, rng):
     A = make_random_ra(3, 2, rng=rng)
     A0 = np.array(A[0])
@@ -115,3 +134,25 @@ def test_discontiguous_setitem(ctx, rng):
     clA[-1] = v
     assert ra.allclose(A, clA.to_host())
     assert np.allclose(clA[-1], v)
+
+
+def test_get_rows(ctx, rng):
+    A, clA = make_random_pair(ctx, 6, 2, rng=rng)
+    n_rows = [A[i].shape[0] for i in range(len(A))]
+    n_rows[1] = 0
+    n_rows[3] = 5
+    n_rows[4] = 1
+
+    out, offsets, event = clA.get_rows(n_rows)
+    assert event.command_execution_status == cl.command_execution_status.COMPLETE
+    assert len(out) == sum(n * A[i].shape[1] for i, n in enumerate(n_rows))
+    for i, n in enumerate(n_rows):
+        x = out[offsets[i] : offsets[i + 1]].reshape(n, A[i].shape[1])
+        assert np.array_equal(x, A[i][:n])
+
+    # skipping leading rows
+    skip_rows = np.minimum(n_rows, 2)
+    out, offsets, _ = clA.get_rows(n_rows, skip_rows=skip_rows)
+    for i, (n, skip) in enumerate(zip(n_rows, skip_rows)):
+        x = out[offsets[i] : offsets[i + 1]].reshape(n - skip, A[i].shape[1])
+        assert np.array_equal(x, A[i][skip:n])
@@ -0,0 +1,28 @@
+# pylint: disable=missing-module-docstring,missing-function-docstring
+
+import numpy as np
+
+from nengo_ocl.plan import TimingStats
+
+
+def test_timing_stats(rng):
+    durations = rng.lognormal(np.log(1e-4), 1, size=1000)
+
+    stats = TimingStats()
+    for t in durations:
+        stats.add(t)
+
+    assert len(stats) == stats.count == len(durations)
+    assert np.allclose(stats.sum, durations.sum())
+    assert np.allclose(stats.mean, durations.mean())
+    assert stats.min == durations.min()
+    assert stats.max == durations.max()
+    assert sum(stats.histogram) == len(durations)
+
+    # quantiles are upper bounds, within a factor of two
+    for q in (0.1, 0.5, 0.9, 1.0):
+        exact = np.quantile(durations, q)
+        assert exact <= stats.quantile(q) <= 2 * exact
+
+    assert np.isnan(TimingStats().mean)
+    assert np.isnan(TimingStats().quantile(0.5))
@@ -1,9 +1,17 @@
 # pylint: disable=missing-module-docstring,missing-function-docstring
 
 import nengo
+import numpy as np
 
 import nengo_ocl
-from nengo_ocl.planners import greedy_planner
+from nengo_ocl.planners import (
+    CachedPlanner,
+    FusedElementwise,
+    fuse_elementwise,
+    greedy_planner,
+    partition_operators,
+    plan_dependencies,
+)
 
 
 def count_op_group(sim, op_group):
@@ -45,3 +53,131 @@ def test_greedy_planner_feedforward():
         check_op_groups(sim)
         assert count_op_group(sim, nengo.builder.neurons.SimNeurons) == 1
         assert len(sim.op_groups) == 10
+
+
+def test_cached_planner(tmp_path):
+    planner = CachedPlanner(greedy_planner, cache_dir=str(tmp_path))
+
+    model, probes = feedforward_network()
+    with nengo_ocl.Simulator(model, planner=planner) as sim0:
+        sim0.run_steps(10)
+    assert planner.hits == 0 and planner.misses == 1
+
+    # same structure with a different seed reuses the plan
+    model.seed = 1
+    with nengo_ocl.Simulator(model, planner=planner) as sim1:
+        sim1.run_steps(10)
+    assert planner.hits == 1 and planner.misses == 1
+
+    check_op_groups(sim1)
+    assert [(t, len(ops)) for t, ops in sim0.op_groups] == [
+        (t, len(ops)) for t, ops in sim1.op_groups
+    ]
+
+    # a different structure is planned anew
+    model2, _ = feedforward_network(extra_node=True)
+    with nengo_ocl.Simulator(model2, planner=planner):
+        pass
+    assert planner.hits == 1 and planner.misses == 2
+
+    # corrupt plans are discarded and recomputed
+    for path in tmp_path.iterdir():
+        path.write_bytes(b"garbage")
+    with nengo_ocl.Simulator(model, planner=planner) as sim2:
+        sim2.run_steps(10)
+    assert planner.hits == 1 and planner.misses == 3
+    assert all(np.isfinite(sim2.data[p]).all() for p in probes)
+
+
+def test_fuse_elementwise(monkeypatch, tmp_path):
+    with nengo.Network(seed=0) as model:
+        u = nengo.Node(np.sin)
+        a = nengo.Ensemble(20, 1)
+        b = nengo.Ensemble(20, 2)
+        nengo.Connection(u, a)
+        nengo.Connection(a, b[0])  # copy into a slice of a reset signal
+        nengo.Connection(b, a, function=lambda x: x[0] * x[1])
+        nengo.Connection(a.neurons, a.neurons, transform=-0.01)  # elementwise
+        probe = nengo.Probe(b, synapse=0.01)
+
+    planner = CachedPlanner(greedy_planner, cache_dir=str(tmp_path))
+    with nengo_ocl.Simulator(model, planner=planner) as sim:
+        check_op_groups(sim)
+        op_groups = fuse_elementwise(sim.op_groups)
+        assert any(op_type is FusedElementwise for op_type, _ in op_groups)
+        n_plans = len(sim._plans)
+        sim.run_steps(100)
+        data = np.array(sim.data[probe])
+
+    monkeypatch.setenv("NENGO_OCL_FUSE_ELEMENTWISE", "0")
+    with nengo_ocl.Simulator(model, planner=planner) as sim:
+        assert len(sim._plans) > n_plans
+        sim.run_steps(100)
+        assert np.allclose(sim.data[probe], data, atol=1e-6)
+
+
+def test_partition_operators():
+    model, _ = feedforward_network()
+    with nengo_ocl.Simulator(model) as sim:
+        operators = sim.operators
+
+    partitions, exchanged, private = partition_operators(operators, 3)
+    assert all(len(part) > 0 for part in partitions)
+
+    # every op is in one partition, except the time update, which is in all
+    is_time = lambda op: isinstance(op, nengo.builder.operator.TimeUpdate)
+    for op in operators:
+        count = sum(op in part for part in partitions)
+        assert count == (3 if is_time(op) else 1)
+
+    # signals written during a step are only used in one partition
+    time_bases = [s.base for op in operators if is_time(op) for s in op.sets]
+    for p, part in enumerate(partitions):
+        written = {s.base for op in part for s in op.sets + op.incs}
+        for q, other in enumerate(partitions):
+            used = {s.base for op in other for s in op.all_signals}
+            if q != p:
+                assert written & used <= set(time_bases)
+
+        # signals read here but updated in other partitions are exchanged
+        updated_elsewhere = {
+            s.base
+            for q, other in enumerate(partitions)
+            if q != p
+            for op in other
+            for s in op.updates
+        }
+        read = {s.base for op in part for s in op.reads}
+        assert set(exchanged[p]) == (read & updated_elsewhere) - set(time_bases)
+
+    # only the time and signals that are never written are copied privately
+    written = {s.base for op in operators for s in op.sets + op.incs + op.updates}
+    assert private[0] == []
+    for p in range(1, 3):
+        assert set(time_bases) <= set(private[p])
+        assert not (set(private[p]) - set(time_bases)) & written
+
+    # with the copies, each base is only used by one partition
+    used_by = {}
+    for p, part in enumerate(partitions):
+        copied = set(exchanged[p]) | set(private[p])
+        for base in {s.base for op in part for s in op.all_signals} - copied:
+            assert used_by.setdefault(base, p) == p
+
+
+def test_plan_dependencies():
+    accesses = [
+        ({"t"}, {"t"}),  # 0: time update
+        ({"t", "x"}, {"a"}),  # 1: reads x, writes a
+        ({"x"}, {"b"}),  # 2: independent of 1
+        ({"a", "b"}, {"c"}),  # 3: needs 1 and 2
+        ({"c"}, {"x"}),  # 4: updates x, after all its readers
+    ]
+    # writes also wait for the readers of the previous step (e.g. 0 waits for 1)
+    assert plan_dependencies(accesses) == [
+        [0, 1],
+        [0, 1, 3, 4],
+        [2, 3, 4],
+        [1, 2, 3, 4],
+        [1, 2, 3, 4],
+    ]
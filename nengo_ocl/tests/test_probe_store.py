@@ -0,0 +1,65 @@
+# pylint: disable=missing-module-docstring,missing-function-docstring
+
+import numpy as np
+import pytest
+
+from nengo_ocl.probe_store import ProbeStore, RingProbeStore
+
+
+@pytest.mark.parametrize("use_file", [False, True])
+def test_probe_store(use_file, tmp_path, rng):
+    path = str(tmp_path / "probe.npy") if use_file else None
+    store = ProbeStore((2, 3), path=path)
+    assert store.data.shape == (0, 2, 3)
+
+    blocks = [rng.uniform(size=(n, 2, 3)).astype(np.float32) for n in [1, 5, 0, 17, 4]]
+    views = []
+    for block in blocks:
+        store.append(block)
+        views.append(store.data)
+
+    x = np.concatenate(blocks)
+    assert len(store) == len(x) and store.capacity >= len(x)
+    assert np.array_equal(store.data, x)
+    assert not store.data.flags.writeable
+
+    # views returned earlier still hold the data from that time
+    for view, n in zip(views, np.cumsum([len(b) for b in blocks])):
+        assert np.array_equal(view, x[:n])
+
+    if use_file:
+        store.flush()
+        assert np.array_equal(np.load(path), x)
+        assert np.array_equal(np.load(path, mmap_mode="r"), x)
+
+    store.clear()
+    assert len(store) == 0 and store.data.shape == (0, 2, 3)
+    store.append(blocks[1])
+    assert np.array_equal(store.data, blocks[1])
+    if use_file:
+        store.flush()
+        assert np.array_equal(np.load(path), blocks[1])
+    else:
+        assert np.array_equal(views[-1], x)
+
+
+def test_ring_probe_store(rng):
+    store = RingProbeStore((3,), 10)
+    assert store.data.shape == (0, 3)
+
+    blocks = [rng.uniform(size=(n, 3)).astype(np.float32) for n in [4, 5, 3, 0, 25, 7]]
+    x = np.zeros((0, 3), dtype=np.float32)
+    for block in blocks:
+        store.append(block)
+        x = np.concatenate([x, block])
+        assert store.n_total == len(x)
+        assert np.array_equal(store.data, x[-10:])
+        assert store.data.base is store._buf  # zero-copy window
+
+    store.clear()
+    assert len(store) == 0 and store.capacity == 10
+    store.append(blocks[0])
+    assert np.array_equal(store.data, blocks[0])
+
+    with pytest.raises(ValueError, match="at least one sample"):
+        RingProbeStore((3,), 0)
@@ -0,0 +1,125 @@
+# pylint: disable=missing-module-docstring,missing-function-docstring
+
+import json
+import os
+import pickle
+
+import numpy as np
+import pyopencl as cl
+import pytest
+
+from nengo_ocl.clraggedarray import to_device
+from nengo_ocl.program_cache import NoProgramCache, ProgramCache, atomic_dump
+
+source = """
+__kernel void scale(__global float *x)
+{
+    x[get_global_id(0)] *= %s;
+}
+"""
+
+
+def run_scale(queue, program, n=5):
+    x = to_device(queue, np.ones(n, dtype=np.float32))
+    program.scale(queue, (n,), None, x.data)
+    return x.get()
+
+
+def test_memory_and_disk_hits(ctx, tmp_path):
+    queue = cl.CommandQueue(ctx)
+    cache = ProgramCache(cache_dir=str(tmp_path))
+
+    prog = cache.build(ctx, source % "2")
+    assert (cache.memory_hits, cache.disk_hits, cache.misses) == (0, 0, 1)
+    assert len(cache.get_files()) == 1
+    assert np.allclose(run_scale(queue, prog), 2)
+
+    assert cache.build(ctx, source % "2") is prog
+    assert (cache.memory_hits, cache.disk_hits, cache.misses) == (1, 0, 1)
+
+    # a new cache (e.g. in a new process) builds from the binary on disk
+    cache2 = ProgramCache(cache_dir=str(tmp_path))
+    prog2 = cache2.build(ctx, source % "2")
+    assert (cache2.memory_hits, cache2.disk_hits, cache2.misses) == (0, 1, 0)
+    assert np.allclose(run_scale(queue, prog2), 2)
+
+    # different source or options are different programs
+    cache2.build(ctx, source % "3")
+    cache2.build(ctx, source % "2", options=["-cl-fast-relaxed-math"])
+    assert cache2.misses == 2
+    assert len(cache2.get_files()) == 3
+
+
+def test_kernels_are_independent(ctx, tmp_path):
+    queue = cl.CommandQueue(ctx)
+    cache = ProgramCache(cache_dir=str(tmp_path))
+    x = to_device(queue, np.ones(3, dtype=np.float32))
+    y = to_device(queue, np.ones(3, dtype=np.float32))
+
+    # the same program can be used by many plans, each setting their own args
+    kern_x = cache.build(ctx, source % "2").scale
+    kern_y = cache.build(ctx, source % "2").scale
+    kern_x.set_args(x.data)
+    kern_y.set_args(y.data)
+    cl.enqueue_nd_range_kernel(queue, kern_x, (3,), None)
+    cl.enqueue_nd_range_kernel(queue, kern_x, (3,), None)
+    cl.enqueue_nd_range_kernel(queue, kern_y, (3,), None)
+    assert np.allclose(x.get(), 4)
+    assert np.allclose(y.get(), 2)
+
+
+def test_lru_eviction(ctx, tmp_path):
+    cache = ProgramCache(cache_dir=str(tmp_path), max_memory_items=2)
+
+    for i in range(4):
+        cache.build(ctx, source % i)
+    assert len(cache._memory) == 2
+    assert len(cache.get_files()) == 4
+
+    # shrink to about the size of one file, keeping the most recently used
+    paths = sorted(cache.get_files())
+    for i, path in enumerate(paths):
+        os.utime(path, (1000 + i, 1000 + i))
+    size = os.stat(paths[-1]).st_size
+    cache.shrink(limit=size)
+    assert cache.get_files() == [paths[-1]]
+    assert cache.get_size() <= size
+
+    cache.clear()
+    assert len(cache.get_files()) == 0
+    assert len(cache._memory) == 0
+
+
+def test_corrupt_file(ctx, tmp_path):
+    cache = ProgramCache(cache_dir=str(tmp_path))
+    cache.build(ctx, source % "2")
+    (path,) = cache.get_files()
+    with open(path, "wb") as fh:
+        fh.write(b"not a program")
+
+    cache2 = ProgramCache(cache_dir=str(tmp_path))
+    cache2.build(ctx, source % "2")
+    assert cache2.misses == 1
+    assert len(cache2.get_files()) == 1
+
+
+def test_no_program_cache(ctx):
+    cache = NoProgramCache()
+    cache.build(ctx, source % "2")
+    cache.build(ctx, source % "2")
+    assert cache.misses == 2
+    assert cache.hits == 0
+
+
+def test_atomic_dump(tmp_path):
+    obj = {"a": [1, 2.5], "b": "c"}
+    for serializer, mode in [(pickle, "rb"), (json, "r")]:
+        path = str(tmp_path / serializer.__name__)
+        atomic_dump(obj, path, serializer=serializer)
+        with open(path, mode) as fh:
+            assert serializer.load(fh) == obj
+
+    # a failed write leaves neither the file nor the temporary file behind
+    with pytest.raises(TypeError):
+        atomic_dump({"a": object()}, str(tmp_path / "bad"), serializer=json)
+    assert sorted(os.listdir(str(tmp_path))) == ["json", "pickle"]
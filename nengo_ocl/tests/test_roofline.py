@@ -0,0 +1,108 @@
+# pylint: disable=missing-module-docstring,missing-function-docstring
+
+import os
+
+import nengo
+import numpy as np
+
+import nengo_ocl
+from nengo_ocl import roofline as roofline_module
+from nengo_ocl.plan import BasePlan
+from nengo_ocl.program_cache import device_key
+from nengo_ocl.roofline import get_device_peaks, measure_device_peaks, roofline
+
+
+def make_plan(name, flops, nbytes, times):
+    plan = BasePlan(name=name, flops_per_call=flops, bw_per_call=nbytes)
+    for t in times:
+        plan.ctimes.add(t)
+        plan.n_calls += 1
+    return plan
+
+
+def test_roofline():
+    peaks = {"bandwidth": 100e9, "flops": 1000e9}  # ridge at 10 flops/byte
+
+    plans = [
+        make_plan("gemv", flops=2e6, nbytes=4e6, times=[1e-4] * 10),
+        make_plan("dense", flops=1e9, nbytes=1e6, times=[2e-3] * 5),
+        make_plan("copy", flops=None, nbytes=2e6, times=[2e-5] * 10),
+        make_plan("python", flops=None, nbytes=None, times=[1e-3] * 10),
+        make_plan("unprofiled", flops=1e6, nbytes=1e6, times=[]),
+    ]
+    rows = roofline(plans, peaks)
+
+    assert [row["plan"].name for row in rows] == ["dense", "gemv", "copy"]
+    dense, gemv, copy = rows
+    assert gemv["bound"] == "bandwidth" and copy["bound"] == "bandwidth"
+    assert dense["bound"] == "compute"
+
+    assert np.allclose(gemv["intensity"], 0.5)
+    assert np.allclose(gemv["gflops"], 20)
+    assert np.allclose(gemv["gbps"], 40)
+    assert np.allclose(gemv["efficiency"], 0.4)  # 40 of 100 GB/s
+    assert np.allclose(gemv["headroom"], 10 * (1e-4 - 4e-5))
+
+    assert np.allclose(dense["efficiency"], 0.5)  # 500 of 1000 GF/s
+    assert np.allclose(dense["headroom"], 5 * 1e-3)
+
+    assert np.isnan(copy["gflops"])
+    assert np.allclose(copy["efficiency"], 1)
+    assert copy["headroom"] == 0
+
+
+def test_device_peaks(ctx, tmp_path, monkeypatch):
+    device = ctx.devices[0]
+    peaks = measure_device_peaks(device, nbytes=1024 ** 2, repeats=1)
+    assert peaks["bandwidth"] > 0 and peaks["flops"] > 0
+
+    calls = []
+
+    def measure(device):
+        calls.append(device)
+        return peaks
+
+    monkeypatch.setattr(roofline_module, "measure_device_peaks", measure)
+    monkeypatch.setattr(roofline_module, "_device_peaks", {})
+
+    # measured once, then found in memory
+    assert get_device_peaks(device, cache_dir=str(tmp_path)) == peaks
+    assert get_device_peaks(device, cache_dir=str(tmp_path)) == peaks
+    assert len(calls) == 1
+    assert os.listdir(str(tmp_path)) == [device_key(device) + ".json"]
+
+    # found on disk
+    monkeypatch.setattr(roofline_module, "_device_peaks", {})
+    assert get_device_peaks(device, cache_dir=str(tmp_path)) == peaks
+    assert len(calls) == 1
+
+    # corrupt files are measured again
+    monkeypatch.setattr(roofline_module, "_device_peaks", {})
+    with open(str(tmp_path / (device_key(device) + ".json")), "w") as fh:
+        fh.write("{")
+    assert get_device_peaks(device, cache_dir=str(tmp_path)) == peaks
+    assert len(calls) == 2
+
+
+def test_print_roofline(ctx, tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("NENGO_OCL_DEVICE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(roofline_module, "_device_peaks", {})
+    monkeypatch.setattr(
+        roofline_module,
+        "measure_device_peaks",
+        lambda device: {"bandwidth": 10e9, "flops": 100e9},
+    )
+
+    with nengo.Network(seed=0) as net:
+        ens = nengo.Ensemble(50, 2)
+        nengo.Connection(ens, ens, synapse=0.01)
+        nengo.Probe(ens)
+
+    with nengo_ocl.Simulator(net, context=ctx, profiling=True) as sim:
+        sim.run_steps(10)
+        capsys.readouterr()
+        sim.print_roofline()
+
+    out = capsys.readouterr().out
+    assert "10.0 GB/s, 100.0 GF/s (ridge at 10.00 flops/byte)" in out
+    assert "clra_gemv" in out and "bandwidth" in out
@@ -1,13 +1,19 @@
 # pylint: disable=missing-module-docstring,missing-function-docstring
 
+import json
+import threading
+
 import nengo
 import numpy as np
 import pytest
 from nengo.builder import Model
-from nengo.builder.operator import DotInc, Reset
+from nengo.builder.operator import BsrDotInc, DotInc, Reset
 from nengo.builder.signal import Signal
 
 import nengo_ocl
+from nengo_ocl.clraggedarray import CLRaggedArray
+from nengo_ocl.plan import PythonPlan
+from nengo_ocl.planners import CachedPlanner
 from nengo_ocl.version import latest_nengo_version_info
 
 
@@ -38,6 +44,47 @@ def test_multidotinc_compress(monkeypatch):
         assert np.allclose(sim.signals[b], [4, -2])
 
 
+def test_bsrdotinc():
+    pytest.importorskip("scipy.sparse")
+
+    # block-diagonal weights, as made by Nengo's optimizer for ensemble arrays
+    rng = np.random.RandomState(0)
+    blocks = rng.uniform(-1, 1, size=(3, 2, 4))
+    x = Signal(rng.uniform(-1, 1, size=12))
+    y = Signal(np.zeros(6))
+    A = Signal(blocks)
+
+    m = Model(dt=0)
+    m.operators += [
+        Reset(y),
+        BsrDotInc(A, x, y, indices=np.arange(3), indptr=np.arange(4), reshape=False),
+    ]
+
+    with nengo_ocl.Simulator(None, model=m) as sim:
+        sim.step()
+        ref = np.concatenate(
+            [blocks[i].dot(x.initial_value[4 * i : 4 * i + 4]) for i in range(3)]
+        )
+        assert np.allclose(sim.signals[y], ref, atol=1e-6)
+
+    # ops incrementing the same output in one group run in separate kernels
+    def planner(operators):
+        groups = {}
+        for op in operators:
+            groups.setdefault(type(op), []).append(op)
+        return list(groups.items())
+
+    bsr = lambda: BsrDotInc(
+        A, x, y, indices=np.arange(3), indptr=np.arange(4), reshape=False
+    )
+    m = Model(dt=0)
+    m.operators += [Reset(y), bsr(), bsr()]
+    with nengo_ocl.Simulator(None, model=m, planner=planner) as sim:
+        assert len([plan for plan in sim._plans if plan.tag == "bsr-1"]) == 2
+        sim.step()
+        assert np.allclose(sim.signals[y], 2 * ref, atol=1e-6)
+
+
 def test_error_on_version_in_blacklist(monkeypatch):
     with nengo.Network() as model:
         nengo.Ensemble(10, 1)
@@ -105,3 +152,563 @@ def test_clear_probes(Simulator, allclose):
         sim.run_steps(12)
         assert len(sim.data[up]) == 12
         assert allclose(sim.data[up], fn(sim.trange()[10:, None]))
+
+
+def test_save_load_state(tmp_path):
+    with nengo.Network(seed=0) as model:
+        u = nengo.Node(nengo.processes.WhiteNoise())
+        a = nengo.Ensemble(20, 1)
+        nengo.Connection(u, a, synapse=nengo.Alpha(0.005))
+        ap = nengo.Probe(a, synapse=nengo.Alpha(0.01))
+        up = nengo.Probe(u, sample_every=0.003)
+
+    path = str(tmp_path / "state.bin")
+    planner = CachedPlanner(cache_dir=str(tmp_path))  # same plan for both simulators
+    with nengo_ocl.Simulator(model, planner=planner) as sim:
+        sim.run_steps(20)
+        sim.save_state(path)
+        sim.run_steps(31)
+        ua, aa, ta = sim.data[up], sim.data[ap], sim.trange()
+
+        sim.load_state(path)
+        assert sim.n_steps == 20 and len(sim.data[ap]) == 20
+        sim.run_steps(31)
+        assert np.array_equal(sim.data[up], ua)
+        assert np.array_equal(sim.data[ap], aa)
+
+    with nengo_ocl.Simulator(model, planner=planner) as sim2:
+        sim2.load_state(path)
+        sim2.run_steps(31)
+        assert np.array_equal(sim2.trange(), ta)
+        assert np.array_equal(sim2.data[up], ua)
+        assert np.array_equal(sim2.data[ap], aa)
+
+    with nengo.Network() as model2:
+        nengo.Ensemble(10, 1)
+
+    with nengo_ocl.Simulator(model2) as sim3:
+        with pytest.raises(ValueError, match="does not match"):
+            sim3.load_state(path)
+
+
+def test_probe_buffering(allclose):
+    fn = lambda t: [np.sin(10 * t), np.cos(10 * t)]
+
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(fn)
+        a = nengo.Ensemble(30, 2)
+        nengo.Connection(u, a)
+        probes = [
+            nengo.Probe(u),
+            nengo.Probe(u, sample_every=0.0035),
+            nengo.Probe(a, synapse=0.01),
+            nengo.Probe(a.neurons, sample_every=0.002),
+        ]
+
+    data = []
+    for n_prealloc_probes in [3, 64, "auto"]:
+        with nengo_ocl.Simulator(net, n_prealloc_probes=n_prealloc_probes) as sim:
+            for steps in [1, 10, 145]:
+                sim.run_steps(steps)
+            data.append([sim.data[p] for p in probes])
+            if n_prealloc_probes == "auto":
+                # buffers have grown to hold the longest run
+                assert sim._probe_depth == 145
+
+        assert allclose(data[-1][0], np.transpose(fn(sim.trange())))
+        assert len(data[-1][1]) == len(sim.trange(sample_every=0.0035))
+
+    for d in data[1:]:
+        for x0, x in zip(data[0], d):
+            assert np.array_equal(x0, x)
+
+    with pytest.raises(ValueError, match="n_prealloc_probes"):
+        nengo_ocl.Simulator(net, n_prealloc_probes=0)
+
+
+def test_auto_probe_depth_chunks(monkeypatch, allclose):
+    monkeypatch.setattr(nengo_ocl.Simulator, "_max_auto_probe_depth", 50)
+
+    with nengo.Network() as net:
+        u = nengo.Node(np.sin)
+        p = nengo.Probe(u)
+
+    with nengo_ocl.Simulator(net) as sim:
+        enqueue = sim._plans.enqueue_n_times
+        groups = []
+        monkeypatch.setattr(
+            sim._plans, "enqueue_n_times", lambda n: groups.append(n) or enqueue(n)
+        )
+        sim.run_steps(145)
+
+        # long runs alternate between the probe banks in fixed-size chunks
+        assert sim._probe_depth == 50
+        assert groups == [50, 50, 45]
+        assert len(sim._probe_bank_events) == len(sim._cl_probe_plan.banks)
+        assert allclose(sim.data[p], np.sin(sim.trange())[:, None])
+
+
+def test_probe_dir(tmp_path):
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(lambda t: [np.sin(10 * t), t])
+        a = nengo.Ensemble(30, 2)
+        nengo.Connection(u, a)
+        probes = [nengo.Probe(u), nengo.Probe(a.neurons, sample_every=0.003)]
+
+    with nengo_ocl.Simulator(net) as sim0:
+        sim0.run_steps(100)
+
+    probe_dir = str(tmp_path / "probes")
+    with nengo_ocl.Simulator(net, probe_dir=probe_dir, n_prealloc_probes=7) as sim:
+        sim.run_steps(40)
+        sim.run_steps(60)
+        for p in probes:
+            assert isinstance(sim.data[p].base, np.memmap)
+            assert np.array_equal(sim.data[p], sim0.data[p])
+
+    for i, p in enumerate(probes):
+        x = np.load(str(tmp_path / "probes" / ("probe%d.npy" % i)))
+        assert np.array_equal(x, sim0.data[p])
+
+
+def test_probe_keep_last():
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(lambda t: [np.sin(10 * t), t])
+        up = nengo.Probe(u)
+        up2 = nengo.Probe(u, sample_every=0.003)
+
+    with nengo_ocl.Simulator(net) as sim0:
+        sim0.run_steps(300)
+
+    for keep_last in [25, {up: 25}]:
+        with nengo_ocl.Simulator(
+            net, probe_keep_last=keep_last, n_prealloc_probes=16
+        ) as sim:
+            sim.run_steps(10)
+            assert np.array_equal(sim.data[up], sim0.data[up][:10])
+            sim.run_steps(150)
+            assert np.array_equal(sim.data[up], sim0.data[up][135:160])
+            nbytes = sim._probe_stores[up]._buf.nbytes
+            sim.run_steps(140)
+            assert np.array_equal(sim.data[up], sim0.data[up][-25:])
+            assert sim._probe_stores[up]._buf.nbytes == nbytes
+
+            n_up2 = 25 if isinstance(keep_last, int) else 100
+            assert np.array_equal(sim.data[up2], sim0.data[up2][-n_up2:])
+
+
+def test_probe_keep_last_reads_kept_rows(monkeypatch, tmp_path):
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(lambda t: [np.sin(10 * t), t])
+        up = nengo.Probe(u)
+
+    with pytest.raises(ValueError, match="probe_dir.*probe_keep_last"):
+        nengo_ocl.Simulator(net, probe_dir=str(tmp_path), probe_keep_last=5)
+
+    with nengo_ocl.Simulator(net) as sim0:
+        sim0.run_steps(300)
+
+    n_read = []
+    get_rows = CLRaggedArray.get_rows
+
+    def counting_get_rows(self, *args, **kwargs):
+        out, offsets, event = get_rows(self, *args, **kwargs)
+        n_read.append(out.size)
+        return out, offsets, event
+
+    monkeypatch.setattr(CLRaggedArray, "get_rows", counting_get_rows)
+    with nengo_ocl.Simulator(net, probe_keep_last=25) as sim:
+        sim.run_steps(300)
+        assert np.array_equal(sim.data[up], sim0.data[up][-25:])
+        assert len(sim._probe_stores[up]) == 25
+        assert sim._probe_stores[up].n_total == 300
+        assert sum(n_read) == 25 * 2
+
+
+def test_probe_callbacks():
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(lambda t: [np.sin(10 * t), t])
+        up = nengo.Probe(u)
+        up2 = nengo.Probe(u, sample_every=0.003)
+
+    blocks = {up: [], up2: []}
+    thread_names = set()
+
+    def make_callback(probe):
+        def callback(t, data):
+            thread_names.add(threading.current_thread().name)
+            blocks[probe].append((t, data))
+
+        return callback
+
+    def bad_callback(t, data):
+        raise RuntimeError("bad callback")
+
+    with nengo_ocl.Simulator(net, n_prealloc_probes=16) as sim:
+        sim.add_probe_callback(up, make_callback(up))
+        sim.add_probe_callback(up2, make_callback(up2))
+        sim.run_steps(50)
+        sim.run_steps(75)
+        sim.wait_for_probe_callbacks()
+
+        for probe in (up, up2):
+            t = np.concatenate([t for t, _ in blocks[probe]])
+            x = np.concatenate([x for _, x in blocks[probe]])
+            assert np.array_equal(x, sim.data[probe])
+            sample_every = probe.sample_every
+            assert np.allclose(t, sim.trange(sample_every=sample_every))
+        assert len(blocks[up]) > 2
+        assert thread_names == {"nengo_ocl probe callbacks"}
+
+        sim.add_probe_callback(up, bad_callback)
+        sim.run_steps(10)
+        with pytest.raises(RuntimeError, match="bad callback"):
+            sim.wait_for_probe_callbacks()
+
+        sim.remove_probe_callback(up, bad_callback)
+        sim.run_steps(10)
+        sim.wait_for_probe_callbacks()
+
+    assert sum(len(x) for _, x in blocks[up]) == 145
+
+
+def test_reset_bulk(monkeypatch):
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(nengo.processes.WhiteNoise())
+        a = nengo.Ensemble(20, 1)
+        nengo.Connection(u, a, synapse=nengo.Alpha(0.005))
+        probes = [
+            nengo.Probe(a, synapse=nengo.Alpha(0.01)),
+            nengo.Probe(u, sample_every=0.003),
+        ]
+
+    with nengo_ocl.Simulator(net) as sim:
+        sim.run_steps(50)
+        data0 = [np.array(sim.data[p]) for p in probes]
+
+        # signals are not reset one at a time
+        def setitem(*args):
+            raise AssertionError("reset should not set individual signals")
+
+        monkeypatch.setattr(
+            nengo_ocl.clraggedarray.CLRaggedArray, "__setitem__", setitem
+        )
+
+        for _ in range(2):
+            sim.reset()
+            assert sim.n_steps == 0 and len(sim.data[probes[0]]) == 0
+            sim.run_steps(50)
+            for p, x0 in zip(probes, data0):
+                assert np.array_equal(sim.data[p], x0)
+
+
+def test_recorded_dispatch(monkeypatch):
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(lambda t: np.sin(10 * t))  # Python node between kernels
+        a = nengo.Ensemble(20, 1)
+        nengo.Connection(u, a)
+        probes = [nengo.Probe(a, synapse=0.01), nengo.Probe(u, sample_every=0.003)]
+
+    with nengo_ocl.Simulator(net) as sim:
+        assert sim._plans.recorded
+        sim.run_steps(100)
+        data0 = [np.array(sim.data[p]) for p in probes]
+
+        # the recorded path does not go through `Plan.enqueue`
+        def enqueue(*args, **kwargs):
+            raise AssertionError("recorded dispatch should not call Plan.enqueue")
+
+        monkeypatch.setattr(nengo_ocl.plan.Plan, "enqueue", enqueue)
+        sim.reset()
+        sim.run_steps(100)
+        for p, x0 in zip(probes, data0):
+            assert np.array_equal(sim.data[p], x0)
+        monkeypatch.undo()
+
+        sim.reset()
+        sim._plans.recorded = False
+        sim.run_steps(100)
+        for p, x0 in zip(probes, data0):
+            assert np.array_equal(sim.data[p], x0)
+
+
+def test_n_partitions(tmp_path):
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(np.sin)
+        ens = [nengo.Ensemble(30, 1) for _ in range(4)]
+        nengo.Connection(u, ens[0])
+        for a, b in zip(ens[:-1], ens[1:]):
+            nengo.Connection(a, b, synapse=0.01, function=np.square)
+        nengo.Connection(ens[-1], ens[0], synapse=0.005, transform=0.5)
+        v = nengo.Node(lambda t, x: -x, size_in=1)  # Python node in a partition
+        nengo.Connection(ens[2], v, synapse=0.01)
+        nengo.Connection(v, ens[1], synapse=0.01)
+        probes = [nengo.Probe(e, synapse=0.01) for e in ens] + [nengo.Probe(v)]
+
+    planner = CachedPlanner(cache_dir=str(tmp_path))
+    with nengo_ocl.Simulator(net, planner=planner) as sim:
+        sim.run_steps(200)
+        data0 = [np.array(sim.data[p]) for p in probes]
+
+    for n_partitions in (2, 3):
+        with nengo_ocl.Simulator(
+            net, planner=planner, n_partitions=n_partitions
+        ) as sim:
+            assert len(sim._plans.partitions) == n_partitions
+            assert len(sim._plans.exchange) == 1
+            for _ in range(2):
+                sim.run_steps(200)
+                for p, x0 in zip(probes, data0):
+                    assert np.allclose(sim.data[p], x0, atol=1e-5)
+                sim.reset()
+
+    with pytest.raises(ValueError, match="n_partitions"):
+        nengo_ocl.Simulator(net, n_partitions=0)
+
+
+def test_batch_size():
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(np.sin)
+        a = nengo.Ensemble(30, 1)
+        b = nengo.Ensemble(40, 2)
+        nengo.Connection(u, a)
+        nengo.Connection(a, b[0], synapse=0.01, function=np.square)
+        nengo.Connection(b[0], b[1], synapse=0.02)
+        noise = nengo.Node(nengo.processes.WhiteNoise())
+        probes = [
+            nengo.Probe(b, synapse=0.01),
+            nengo.Probe(a.neurons, sample_every=0.003),
+        ]
+        p_noise = nengo.Probe(noise)
+
+    with nengo_ocl.Simulator(net) as sim:
+        sim.run_steps(100)
+        data0 = [np.array(sim.data[p]) for p in probes]
+        n_plans = len(sim._plans)
+
+    batch_data = []
+    with nengo_ocl.Simulator(net, batch_size=3) as sim:
+        assert len(sim._plans) == n_plans  # copies run in the same kernels
+        sim.add_probe_callback(probes[0], lambda t, x: batch_data.append(x))
+        for _ in range(2):
+            sim.run_steps(50)
+            sim.run_steps(50)
+            sim.wait_for_probe_callbacks()
+            for p, x0 in zip(probes, data0):
+                assert sim.data[p].shape == (3,) + x0.shape
+                for x in sim.data[p]:
+                    assert np.allclose(x, x0, atol=1e-5)
+
+            # unseeded processes are independent in each copy
+            assert sim.data[p_noise].shape == (3, 100, 1)
+            assert not np.allclose(sim.data[p_noise][0], sim.data[p_noise][1])
+            sim.reset()
+
+    batch_data = np.concatenate(batch_data, axis=1)
+    assert batch_data.shape == (3, 200, 2)
+    assert np.allclose(batch_data[:, :100], data0[0], atol=1e-5)
+
+    with pytest.raises(ValueError, match="batch_size"):
+        nengo_ocl.Simulator(net, batch_size=0)
+
+
+@pytest.mark.parametrize("queue_support", (True, False))
+def test_out_of_order(queue_support, monkeypatch, tmp_path):
+    if not queue_support:
+        monkeypatch.setattr(nengo_ocl.simulator, "OUT_OF_ORDER_EXEC_MODE_ENABLE", 0)
+
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(np.sin)
+        ens = [nengo.Ensemble(30, 1) for _ in range(4)]
+        nengo.Connection(u, ens[0])
+        for a, b in zip(ens[:-1], ens[1:]):
+            nengo.Connection(a, b, synapse=0.01, function=np.square)
+        nengo.Connection(ens[-1], ens[0], synapse=0.005, transform=0.5)
+        v = nengo.Node(lambda t, x: -x, size_in=1)  # Python node between kernels
+        nengo.Connection(ens[2], v, synapse=0.01)
+        nengo.Connection(v, ens[1], synapse=0.01)
+        w = nengo.Node(nengo.processes.WhiteSignal(1, high=5, seed=1))
+        nengo.Connection(w, ens[3])
+        probes = [nengo.Probe(e, synapse=0.01) for e in ens] + [nengo.Probe(v)]
+
+    planner = CachedPlanner(cache_dir=str(tmp_path))
+    with nengo_ocl.Simulator(net, planner=planner) as sim:
+        sim.run_steps(200)
+        data0 = [np.array(sim.data[p]) for p in probes]
+
+    with nengo_ocl.Simulator(net, planner=planner, out_of_order=True) as sim:
+        assert len(sim._plans.queues) == (1 if queue_support else 4)
+        for _ in range(2):
+            sim.run_steps(100)
+            sim.run_steps(100)
+            for p, x0 in zip(probes, data0):
+                assert np.allclose(sim.data[p], x0, atol=1e-6)
+            sim.reset()
+
+    with pytest.raises(ValueError, match="out_of_order"):
+        nengo_ocl.Simulator(net, out_of_order=True, n_partitions=2)
+
+
+def test_async_python_plans():
+    class Step(nengo.Process):
+        """A Python process (processes are never converted to OpenCL)."""
+
+        def __init__(self, scale, fail_at=None, calls=None, **kwargs):
+            super().__init__(default_size_in=1, default_size_out=2, **kwargs)
+            self.scale = scale
+            self.fail_at = fail_at
+            self.calls = [] if calls is None else calls
+
+        def make_step(self, shape_in, shape_out, dt, rng, state):
+            def step(t, x):
+                self.calls.append(t)
+                if self.fail_at is not None and t > self.fail_at:
+                    raise RuntimeError("step failed")
+                return self.scale * np.array([np.sin(t), x[0]])
+
+            return step
+
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(np.cos)
+        ens = nengo.Ensemble(30, 1)
+        nengo.Connection(u, ens)
+        nodes = [nengo.Node(Step(scale)) for scale in (1, -2)]
+        nengo.Connection(u, nodes[0], synapse=None)
+        nengo.Connection(ens, nodes[1], synapse=0.01)
+        nengo.Connection(nodes[0][0], ens, synapse=0.005)
+        probes = [nengo.Probe(node) for node in nodes]
+
+    with nengo_ocl.Simulator(net) as sim:
+        python_plans = [p for p in sim._plans if isinstance(p, PythonPlan)]
+        assert len(python_plans) == 2
+        assert all(p.compute is not None for p in python_plans)
+
+        sim._plans.recorded = False  # Python plans run synchronously
+        sim.run_steps(50)
+        data0 = [np.array(sim.data[p]) for p in probes]
+
+        sim.reset()
+        sim._plans.recorded = True
+        for _ in range(5):
+            sim.run_steps(10)
+        assert sim._plans._executor is not None
+        for p, x0 in zip(probes, data0):
+            assert np.allclose(sim.data[p], x0)
+
+    # the error stops the run, and the process is not stepped again
+    calls = []
+    nodes[1].output = Step(-2, fail_at=0.02, calls=calls)
+    with nengo_ocl.Simulator(net) as sim:
+        with pytest.raises(RuntimeError, match="step failed"):
+            sim.run_steps(2000)
+    assert sum(t > 0.02 for t in calls) == 1
+
+
+def test_python_fn_staging():
+    def fn(t, x):
+        try:  # cannot be converted to OpenCL
+            return [x[0] * t, -x[1], t]
+        finally:
+            pass
+
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(lambda t: [np.sin(t), np.cos(t)])
+        nodes = [nengo.Node(fn, size_in=2) for _ in range(5)]
+        for i, node in enumerate(nodes):
+            nengo.Connection(u, node, transform=i + 1, synapse=None)
+        probes = [nengo.Probe(node) for node in nodes]
+
+    with nengo.Simulator(net, progress_bar=False) as ref:
+        ref.run_steps(20)
+
+    with nengo_ocl.Simulator(net, if_python_code="none") as sim:
+        (plan,) = [p for p in sim._plans if isinstance(p, PythonPlan)]
+        assert plan.compute is not None
+        for recorded in (False, True):
+            sim._plans.recorded = recorded
+            sim.reset()
+            sim.run_steps(20)
+            for p in probes:
+                assert np.allclose(sim.data[p], ref.data[p], atol=1e-6)
+
+
+def test_export_trace(tmp_path):
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(np.sin)
+        ens = nengo.Ensemble(10, 1)
+        nengo.Connection(u, ens)
+        v = nengo.Node(lambda t, x: print(end=""), size_in=1)  # Python plan
+        nengo.Connection(ens, v)
+        nengo.Probe(ens)
+
+    path = str(tmp_path / "trace.json")
+    with nengo_ocl.Simulator(net, profiling=True, if_python_code="none") as sim:
+        sim.run_steps(10)
+        sim.export_trace(path)
+        n_plans = len(sim._plans)
+
+    with open(path, encoding="utf-8") as fh:
+        events = json.load(fh)["traceEvents"]
+
+    calls = [e for e in events if e["ph"] == "X"]
+    assert {e["cat"] for e in calls} == {"kernel", "python", "probe"}
+    assert len([e for e in calls if e["cat"] != "probe"]) == 10 * n_plans
+    assert min(e["ts"] for e in calls) == 0
+    assert all(e["dur"] >= 0 for e in calls)
+    kernel = next(e for e in calls if e["cat"] == "kernel")
+    assert {"tag", "gsize", "lsize", "flops", "bytes", "step"} <= set(kernel["args"])
+
+    names = {e["tid"]: e["args"]["name"] for e in events if e["name"] == "thread_name"}
+    assert names[0] == "host"
+    assert {e["tid"] for e in calls} <= set(names)
+
+    with nengo_ocl.Simulator(net) as sim:
+        with pytest.raises(RuntimeError, match="Profiling not enabled"):
+            sim.export_trace(path)
+
+
+def test_profiling_every(tmp_path):
+    with nengo.Network(seed=0) as net:
+        u = nengo.Node(np.sin)
+        ens = nengo.Ensemble(10, 1)
+        nengo.Connection(u, ens)
+        v = nengo.Node(lambda t, x: -x, size_in=1)
+        nengo.Connection(ens, v, synapse=0.01)
+        probes = [nengo.Probe(ens, synapse=0.01), nengo.Probe(v)]
+
+    with nengo_ocl.Simulator(net) as sim:
+        sim.run_steps(120)
+        data0 = [np.array(sim.data[p]) for p in probes]
+
+    path = str(tmp_path / "trace.json")
+    with nengo_ocl.Simulator(net, profiling=True, profiling_every=10) as sim:
+        sim.run_steps(45)
+        sim.run_steps(55)
+        for p, x0 in zip(probes, data0):
+            assert np.allclose(sim.data[p], x0[:100])
+
+        assert list(sim._plans.profiled_steps) == list(range(0, 100, 10))
+        for plan in sim._plans:
+            if plan is sim._cl_probe_plan:
+                continue  # rebuilt when the probe buffers grow
+            assert plan.n_calls == len(plan.ctimes) == len(plan.trace) == 10
+            assert 0 < plan.ctimes.min <= plan.ctimes.mean <= plan.ctimes.max
+
+        sim.export_trace(path)
+
+        # the recorded steps after a profiled step wait for all of its plans
+        sim.run_steps(1)
+        last_events = sim._plans._events
+        assert last_events[0] is not None
+        assert all(event is last_events[0] for event in last_events)
+        sim.run_steps(19)
+        for p, x0 in zip(probes, data0):
+            assert np.allclose(sim.data[p], x0)
+
+    with open(path, encoding="utf-8") as fh:
+        events = json.load(fh)["traceEvents"]
+    steps = {e["args"]["step"] for e in events if e.get("cat") == "kernel"}
+    assert steps == set(range(0, 100, 10))
+
+    with pytest.raises(ValueError, match="profiling_every"):
+        nengo_ocl.Simulator(net, profiling=True, profiling_every=0)
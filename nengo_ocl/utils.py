@@ -152,7 +152,9 @@ class RefRunner(SimRunner):
 
 
 class OCLRunner(SimRunner):
-    def __init__(self, name=None, n_prealloc_probes=32, spmv_algorithm=None, **kwargs):
+    def __init__(
+        self, name=None, n_prealloc_probes="auto", spmv_algorithm=None, **kwargs
+    ):
         super().__init__(name=name, **kwargs)
 
         context = self.kwargs.get("context", None)